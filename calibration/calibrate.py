@@ -36,6 +36,7 @@ import sys
 import time
 from datetime import date
 
+from calibration.fit import Calibration, write_reference_file
 from calibration.smu import SMU2450
 from rocketlogger.data import RocketLoggerData
 from rocketlogger.calibration import RocketLoggerCalibration, CALIBRATION_SETUP_SMU2450
@@ -63,13 +64,13 @@ def get_rocketlogger_command(measurement_type, filename,
         command += ' --calibration'
 
     # channel options
-    if action == 'v':
+    if measurement_type == 'v':
         command += ' --channel=V1,V2'
         command += ' --comment=\'RocketLogger voltage calibration measurement for FlockLab 2 using automated SMU2450 sweep.\''
-    elif action == 'il':
+    elif measurement_type == 'il':
         command += ' --channel=I1L'
         command += ' --comment=\'RocketLogger current low calibration measurement for FlockLab 2 using automated SMU2450 sweep.\''
-    elif action == 'ih':
+    elif measurement_type == 'ih':
         command += ' --channel=I1H --high-range=I1H'
         command += ' --comment=\'RocketLogger high current calibration measurement for FlockLab 2 using automated SMU2450 sweep.\''
     else:
@@ -89,6 +90,19 @@ def get_rocketlogger_command(measurement_type, filename,
     return command
 
 
+def alias_channel(data, channel_name, alias):
+    """
+    Make a channel of RocketLoggerData available under another name.
+
+    The raw channel data is shared, not copied (unlike get_data(), which
+    returns scaled copies).
+    """
+    index = data._get_channel_index(channel_name)
+    channel_info = data._header['channels'][index].copy()
+    channel_info['name'] = alias
+    data.add_channel(channel_info, data._data[index])
+
+
 if __name__ == "__main__":
 
     # handle first argument
@@ -104,11 +118,15 @@ if __name__ == "__main__":
     filename_v = '{}_v.rld'.format(filename_base)
     filename_il = '{}_il.rld'.format(filename_base)
     filename_ih = '{}_ih.rld'.format(filename_base)
+    filename_ref = {key: '{}_{}_smu.csv'.format(filename_base, key)
+                    for key in ['v', 'il', 'ih']}
     filename_cal = '{}.dat'.format(filename_base)
     filename_log = '{}.log'.format(filename_base)
 
-    # for option "cal" perform calibration using todays measurements
-    if action == 'cal':
+    # for options "cal" and "cal-rl" perform calibration using todays
+    # measurements ("cal-rl" uses the reference implementation of the
+    # rocketlogger package, which loads all measurements into memory)
+    if action in ['cal', 'cal-rl']:
         print('Generating calibration file from measurements.')
 
         if not os.path.isfile(filename_v):
@@ -118,38 +136,46 @@ if __name__ == "__main__":
         elif not os.path.isfile(filename_ih):
             raise FileNotFoundError('Missing current high calibration measurement.')
 
-        # load calibration measurement data
-        data_v = RocketLoggerData(filename_v)
-        data_il = RocketLoggerData(filename_il)
-        data_ih = RocketLoggerData(filename_ih)
-
-        # copy channel V1 to provide (fake) V3, V4 data
-        channel_info3 = data_v._header['channels'][0].copy()
-        channel_info4 = data_v._header['channels'][0].copy()
-        channel_info3['name'] = 'V3'
-        channel_info4['name'] = 'V4'
-        data_v.add_channel(channel_info3, data_v.get_data('V1').squeeze())
-        data_v.add_channel(channel_info4, data_v.get_data('V1').squeeze())
-
-        # copy channel I1L to provide (fake) I2L data
-        channel_info = data_il._header['channels'][0].copy()
-        channel_info['name'] = 'I2L'
-        data_il.add_channel(channel_info, data_il.get_data('I1L').squeeze())
-
-        # copy channel I1H to provide (fake) I2H data
-        channel_info = data_ih._header['channels'][0].copy()
-        channel_info['name'] = 'I2H'
-        data_ih.add_channel(channel_info, data_ih.get_data('I1H').squeeze())
-
-        # perform calibration and print statistics
-        cal = RocketLoggerCalibration(data_v, data_il, data_ih,
-                                      data_il, data_ih)
-        cal.recalibrate(CALIBRATION_SETUP_SMU2450)
-        cal.print_statistics()
-
-        # write calibration file and print statistics
-        cal.write_calibration_file(filename_cal)
-        cal.write_log_file(filename_log)
+        if action == 'cal':
+            # use the SMU readings as reference where available
+            references = {key: filename for key, filename
+                          in filename_ref.items() if os.path.isfile(filename)}
+            print('SMU readings available for: {}'.format(
+                ', '.join(references.keys()) or 'none'))
+            cal = Calibration(filename_v, filename_il, filename_ih,
+                              references)
+            cal.recalibrate(CALIBRATION_SETUP_SMU2450)
+            cal.print_statistics()
+
+            # write calibration file and print statistics
+            cal.write_calibration_file(filename_cal)
+            cal.write_log_file(filename_log)
+
+        elif action == 'cal-rl':
+            # load calibration measurement data
+            data_v = RocketLoggerData(filename_v)
+            data_il = RocketLoggerData(filename_il)
+            data_ih = RocketLoggerData(filename_ih)
+
+            # alias channel V1 to provide (fake) V3, V4 data
+            alias_channel(data_v, 'V1', 'V3')
+            alias_channel(data_v, 'V1', 'V4')
+
+            # alias channel I1L to provide (fake) I2L data
+            alias_channel(data_il, 'I1L', 'I2L')
+
+            # alias channel I1H to provide (fake) I2H data
+            alias_channel(data_ih, 'I1H', 'I2H')
+
+            # perform calibration and print statistics
+            cal = RocketLoggerCalibration(data_v, data_il, data_ih,
+                                          data_il, data_ih)
+            cal.recalibrate(CALIBRATION_SETUP_SMU2450)
+            cal.print_statistics()
+
+            # write calibration file and print statistics
+            cal.write_calibration_file(filename_cal)
+            cal.write_log_file(filename_log)
 
     # for option "deploy" install today generated calibration
     elif action == 'deploy':
@@ -194,12 +220,21 @@ if __name__ == "__main__":
         # start rocketlogger measurement
         rocketlogger_command = get_rocketlogger_command(action, filename)
         print(rocketlogger_command)
+        command_time = time.time_ns()
         os.system(rocketlogger_command)
 
         print('Calibration measurement done.')
         print('Data saved to {}'.format(filename))
 
+        # read the SMU readings for exact reference values and alignment
+        readings = smu.read_buffer()
+        write_reference_file(filename_ref[action], readings,
+                             smu.trigger_time, smu.trigger_uncertainty,
+                             smu.start_delay)
+        print('SMU readings saved to {} (trigger {:.3f} ms before rocketlogger start command)'.format(
+            filename_ref[action], (command_time - smu.trigger_time) / 1e6))
+
         smu.disconnect()
 
     else:
-        print('invalid argument, valid options are: v, il, ih, cal, or deploy')
+        print('invalid argument, valid options are: v, il, ih, cal, cal-rl, or deploy')
@@ -0,0 +1,355 @@
+#!/usr/bin/env python3
+"""
+Automated RocketLogger calibration of multiple observers in parallel.
+
+Each observer is calibrated by its own worker: the three calibration sweeps
+(v, il, ih) are run back to back using a single connection to the SMU2450
+of the observer, the measurements are copied from the observer while the next
+sweep is running, and the calibration is generated as soon as all data is
+available. A summary of all observers including the duration of each stage
+is printed and written to the output directory.
+
+Copyright (c) 2016-2019, ETH Zurich, Computer Engineering Group
+All rights reserved.
+
+Redistribution and use in source and binary forms, with or without
+modification, are permitted provided that the following conditions are met:
+
+* Redistributions of source code must retain the above copyright notice, this
+  list of conditions and the following disclaimer.
+
+* Redistributions in binary form must reproduce the above copyright notice,
+  this list of conditions and the following disclaimer in the documentation
+  and/or other materials provided with the distribution.
+
+* Neither the name of the copyright holder nor the names of its
+  contributors may be used to endorse or promote products derived from
+  this software without specific prior written permission.
+
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+"""
+
+import argparse
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from datetime import date
+
+from calibrate import DATA_DIR, get_rocketlogger_command
+from calibration.fit import Calibration, write_reference_file
+from calibration.smu import SMU2450
+from rocketlogger.calibration import CALIBRATION_SETUP_SMU2450
+
+MEASUREMENT_TYPES = ['v', 'il', 'ih']
+
+STAGES = ['connect', 'v', 'il', 'ih', 'transfer', 'cal', 'deploy']
+
+# share one connection per observer (fast commands for the clock offset)
+SSH_OPTIONS = ['-o', 'BatchMode=yes', '-o', 'ConnectTimeout=10',
+               '-o', 'ControlMaster=auto', '-o', 'ControlPersist=60',
+               '-o', 'ControlPath={}'.format(
+                   os.path.join(tempfile.gettempdir(), 'calibrate_fleet_%C'))]
+
+# number of samples to measure the observer clock offset
+CLOCK_OFFSET_SAMPLES = 5
+
+# max. time for a single remote command (a sweep measurement takes 75 s)
+COMMAND_TIMEOUT = 300
+
+_print_lock = threading.Lock()
+
+
+def log(observer, message):
+    """
+    Print a message prefixed with the observer name.
+    """
+    with _print_lock:
+        print('[{}] {}'.format(observer, message))
+        sys.stdout.flush()
+
+
+@contextmanager
+def stage(timing, name):
+    """
+    Measure the duration of a calibration stage in seconds.
+    """
+    start = time.monotonic()
+    try:
+        yield
+    finally:
+        timing[name] = time.monotonic() - start
+
+
+def run_remote(observer, command, timeout=COMMAND_TIMEOUT):
+    """
+    Run a command on the observer using SSH.
+    """
+    subprocess.run(['ssh'] + SSH_OPTIONS + [observer, command], check=True,
+                   stdout=subprocess.DEVNULL, timeout=timeout)
+
+
+def measure_clock_offset(observer, samples=CLOCK_OFFSET_SAMPLES):
+    """
+    Measure the offset of the observer clock to the local clock using SSH.
+
+    The sample with the shortest round trip is used, assuming the observer
+    time was read in its center.
+
+    :returns: tuple (offset, uncertainty) in ns, the offset converts a local
+              time to the observer time
+    """
+    best = None
+    for _ in range(samples):
+        time_before = time.time_ns()
+        output = subprocess.run(['ssh'] + SSH_OPTIONS + [observer,
+                                                         'date +%s%N'],
+                                check=True, stdout=subprocess.PIPE,
+                                timeout=COMMAND_TIMEOUT).stdout
+        time_after = time.time_ns()
+        round_trip = time_after - time_before
+        if best is None or round_trip < best[1]:
+            best = (int(output) - (time_before + time_after) // 2, round_trip)
+    return (best[0], best[1] // 2)
+
+
+def copy_from_remote(observer, remote_filename, local_filename):
+    """
+    Start copying a file from the observer, returns the running process.
+    """
+    return subprocess.Popen(['scp', '-q'] + SSH_OPTIONS +
+                            ['{}:{}'.format(observer, remote_filename),
+                             local_filename])
+
+
+def copy_to_remote(observer, local_filename, remote_filename):
+    """
+    Copy a file to the observer.
+    """
+    subprocess.run(['scp', '-q'] + SSH_OPTIONS +
+                   [local_filename,
+                    '{}:{}'.format(observer, remote_filename)],
+                   check=True, timeout=COMMAND_TIMEOUT)
+
+
+def calibrate_observer(observer, smu_hostname, output_dir, deploy=False,
+                       smu_port=5025):
+    """
+    Run the calibration sweeps of an observer and generate its calibration.
+
+    :param observer: hostname of the observer (SSH)
+
+    :param smu_hostname: hostname of the SMU2450 connected to the observer
+
+    :param output_dir: local directory for the measurements and calibration
+
+    :param deploy: set True to install the calibration on the observer
+
+    :param smu_port: TCP port of the SMU2450
+
+    :returns: dictionary with the results (observer, status, timing,
+              calibration)
+    """
+    result = {'observer': observer, 'status': 'failed', 'timing': {},
+              'calibration': None}
+    timing = result['timing']
+    basename = '{}_calibration'.format(date.today())
+    local_base = os.path.join(output_dir, observer, basename)
+    remote_base = os.path.join(DATA_DIR, basename)
+    os.makedirs(os.path.dirname(local_base), exist_ok=True)
+
+    smu = None
+    transfers = []
+    try:
+        with stage(timing, 'connect'):
+            smu = SMU2450(smu_hostname, smu_port)
+            smu.connect()
+            run_remote(observer, 'mkdir -p {}'.format(DATA_DIR))
+            # the measurements are timestamped by the observer clock, the
+            # SMU readings by the local clock
+            clock_offset, clock_uncertainty = measure_clock_offset(observer)
+            log(observer, 'clock offset {:.3f} ms (+/- {:.3f} ms)'.format(
+                clock_offset / 1e6, clock_uncertainty / 1e6))
+
+        sweeps = {'v': smu.calibrate_voltage,
+                  'il': smu.calibrate_current_low,
+                  'ih': smu.calibrate_current_high}
+        for measurement_type in MEASUREMENT_TYPES:
+            with stage(timing, measurement_type):
+                log(observer, 'running measurement for {}'.format(
+                    measurement_type))
+                remote_filename = '{}_{}.rld'.format(remote_base,
+                                                     measurement_type)
+                sweeps[measurement_type]()
+
+                # small delay for start beep
+                time.sleep(0.5)
+                run_remote(observer, get_rocketlogger_command(
+                    measurement_type, remote_filename))
+
+                readings = smu.read_buffer()
+                write_reference_file('{}_{}_smu.csv'.format(
+                    local_base, measurement_type), readings,
+                    smu.trigger_time + clock_offset,
+                    smu.trigger_uncertainty + clock_uncertainty,
+                    smu.start_delay)
+
+                # copy the measurement while running the next sweep
+                transfers.append(copy_from_remote(
+                    observer, remote_filename,
+                    '{}_{}.rld'.format(local_base, measurement_type)))
+        smu.disconnect()
+        smu = None
+
+        with stage(timing, 'transfer'):
+            for transfer in transfers:
+                if transfer.wait(timeout=COMMAND_TIMEOUT) != 0:
+                    raise RuntimeError('copying the measurements failed')
+
+        with stage(timing, 'cal'):
+            log(observer, 'generating calibration')
+            references = {key: '{}_{}_smu.csv'.format(local_base, key)
+                          for key in MEASUREMENT_TYPES}
+            cal = Calibration('{}_v.rld'.format(local_base),
+                              '{}_il.rld'.format(local_base),
+                              '{}_ih.rld'.format(local_base), references)
+            # observers are processed in parallel already, no worker
+            # processes (forking a multi-threaded process is unsafe)
+            cal.recalibrate(CALIBRATION_SETUP_SMU2450, processes=1)
+            cal.write_calibration_file('{}.dat'.format(local_base))
+            cal.write_log_file('{}.log'.format(local_base))
+            result['calibration'] = cal
+
+        if deploy:
+            with stage(timing, 'deploy'):
+                log(observer, 'deploying calibration')
+                for extension in ['dat', 'log']:
+                    copy_to_remote(observer,
+                                   '{}.{}'.format(local_base, extension),
+                                   '{}.{}'.format(remote_base, extension))
+                    run_remote(observer, 'sudo cp -f {}.{} '
+                               '/etc/rocketlogger/calibration.{}'.format(
+                                   remote_base, extension, extension))
+
+        result['status'] = 'ok'
+        log(observer, 'calibration done')
+    except Exception as e:
+        result['status'] = 'failed: {}'.format(e)
+        log(observer, 'calibration failed: {}'.format(e))
+    finally:
+        for transfer in transfers:
+            if transfer.poll() is None:
+                transfer.kill()
+        if smu is not None:
+            try:
+                smu.stop()
+                smu.disconnect()
+            except Exception:
+                pass
+    return result
+
+
+def format_summary(results):
+    """
+    Format the fleet summary report.
+    """
+    labels = ['{}[s]'.format(x) for x in STAGES + ['total']]
+    widths = [max(8, len(x)) for x in labels]
+    lines = ['{:20s}  {:>9s}  {}  {}'.format(
+        'Observer', 'Scale[%]',
+        '  '.join('{:>{}s}'.format(x, w) for x, w in zip(labels, widths)),
+        'Status')]
+    for result in results:
+        timing = result['timing']
+        cal = result['calibration']
+        times = [timing.get(x) for x in STAGES] + [sum(timing.values())]
+        lines.append('{:20s}  {:>9s}  {}  {}'.format(
+            result['observer'],
+            '{:.5f}'.format(100 * max(cal.error_scale))
+            if cal is not None else '-',
+            '  '.join('{:{}.1f}'.format(x, w) if x is not None
+                      else '{:>{}s}'.format('-', w)
+                      for x, w in zip(times, widths)),
+            result['status']))
+    success = sum(result['status'] == 'ok' for result in results)
+    lines.append('')
+    lines.append('{:d} of {:d} observers calibrated successfully.'.format(
+        success, len(results)))
+    return '\n'.join(lines)
+
+
+def parse_observers(arguments, filename=None):
+    """
+    Parse observer definitions of the form observer:smu_hostname[:port].
+
+    :returns: list of (observer, SMU hostname, SMU port) tuples
+    """
+    definitions = list(arguments)
+    if filename:
+        with open(filename) as f:
+            definitions += [line.split('#', 1)[0].strip() for line in f]
+    observers = []
+    for definition in definitions:
+        if not definition:
+            continue
+        observer, _, smu_address = definition.partition(':')
+        smu_hostname, _, smu_port = smu_address.partition(':')
+        if not smu_hostname:
+            raise ValueError('no SMU hostname given for observer {}'.format(
+                observer))
+        observers.append((observer, smu_hostname,
+                          int(smu_port) if smu_port else 5025))
+    return observers
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description='Calibrate the RocketLogger of multiple observers.')
+    parser.add_argument('observers', nargs='*',
+                        help='observer and SMU2450 hostname, '
+                             'format: observer:smu_hostname[:port]')
+    parser.add_argument('-f', '--file',
+                        help='file with one observer definition per line')
+    parser.add_argument('-o', '--output', default='calibration_fleet',
+                        help='local output directory')
+    parser.add_argument('-j', '--jobs', type=int, default=8,
+                        help='max. number of observers calibrated in parallel')
+    parser.add_argument('--deploy', action='store_true',
+                        help='install the generated calibration on the '
+                             'observers')
+    args = parser.parse_args()
+
+    observers = parse_observers(args.observers, args.file)
+    if not observers:
+        parser.error('no observers given')
+    os.makedirs(args.output, exist_ok=True)
+
+    with ThreadPoolExecutor(max_workers=args.jobs) as executor:
+        futures = [executor.submit(calibrate_observer, observer, smu_hostname,
+                                   args.output, args.deploy, smu_port)
+                   for observer, smu_hostname, smu_port in observers]
+        results = [future.result() for future in futures]
+
+    summary = format_summary(results)
+    print()
+    print(summary)
+    filename_summary = os.path.join(args.output, '{}_summary.txt'.format(
+        date.today()))
+    with open(filename_summary, 'w') as f:
+        f.write(summary + '\n')
+    print('Summary saved to {}'.format(filename_summary))
+
+    sys.exit(0 if all(x['status'] == 'ok' for x in results) else 1)
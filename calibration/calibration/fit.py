@@ -0,0 +1,460 @@
+"""
+Vectorized RocketLogger calibration from SMU2450 sweep measurements
+
+Copyright (c) 2019, ETH Zurich, Computer Engineering Group
+All rights reserved.
+
+Redistribution and use in source and binary forms, with or without
+modification, are permitted provided that the following conditions are met:
+
+* Redistributions of source code must retain the above copyright notice, this
+  list of conditions and the following disclaimer.
+
+* Redistributions in binary form must reproduce the above copyright notice,
+  this list of conditions and the following disclaimer in the documentation
+  and/or other materials provided with the distribution.
+
+* Neither the name of the copyright holder nor the names of its
+  contributors may be used to endorse or promote products derived from
+  this software without specific prior written permission.
+
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+"""
+
+import warnings
+from multiprocessing import Pool
+
+import numpy as np
+
+from .rld import RldFile
+
+
+# calibration file format (same as the rocketlogger package)
+CALIBRATION_FILE_DTYPE = np.dtype([
+    ('file_magic', '<u4'),
+    ('file_version', '<u2'),
+    ('header_length', '<u2'),
+    ('calibration_time', '<M8[s]'),
+    ('offset', ('<i4', 8)),
+    ('scale', ('<f8', 8)),
+])
+CALIBRATION_FILE_MAGIC = 0x434C5225
+CALIBRATION_FILE_VERSION = 0x02
+CALIBRATION_FILE_HEADER_LENGTH = 0x10
+
+# channel order in the calibration file and scales of the stored values
+CALIBRATION_CHANNEL_NAMES = ['V1', 'V2', 'V3', 'V4',
+                             'I1L', 'I1H', 'I2L', 'I2H']
+CALIBRATION_CHANNEL_SCALES = [1e-8] * 4 + [1e-11, 1e-9] * 2
+CALIBRATION_CHANNEL_SCALES_POSITIVE = [False] * 4 + [True] * 4
+
+# channels without a dedicated measurement, calibrated from the given channel
+CALIBRATION_CHANNEL_ALIASES = {'V3': 'V1', 'V4': 'V1',
+                               'I2L': 'I1L', 'I2H': 'I1H'}
+
+# derivative window and min. plateau length relative to the set-point delay
+_DERIVATIVE_WINDOW = 0.05
+_MIN_PLATEAU_LENGTH = 0.4
+
+
+class CalibrationError(Exception):
+    """Calibration measurement processing errors."""
+
+    pass
+
+
+def detect_plateaus(raw, step, window, min_length):
+    """
+    Detect the set-point plateaus of a sweep measurement.
+
+    A sample is considered stable if the means of the windows before and
+    after it differ by less than half a set-point step. Each plateau is
+    averaged using the cumulative sum that is also used for the window means.
+
+    :param raw: vector of raw (unscaled integer) measurement values
+
+    :param step: the set-point step in raw units
+
+    :param window: length of the derivative window in samples
+
+    :param min_length: min. number of stable samples of a plateau
+
+    :returns: (start, end, mean) vectors of the plateaus, the mean in raw units
+    """
+    csum = np.zeros(len(raw) + 1, dtype=np.int64)
+    np.cumsum(raw, dtype=np.int64, out=csum[1:])
+    if len(raw) < 2 * window + min_length:
+        raise CalibrationError('measurement too short')
+
+    # difference of the means of adjacent windows, centered on sample i + window
+    delta = np.abs(csum[2 * window:] - 2 * csum[window:-window] +
+                   csum[:-2 * window]) / window
+    stable = np.hstack([0, (delta < step / 2).astype(np.int8), 0])
+    boundary = np.diff(stable)
+    start = np.flatnonzero(boundary > 0) + window
+    end = np.flatnonzero(boundary < 0) + window
+    keep = (end - start) >= min_length
+    start, end = start[keep], end[keep]
+    if not len(start):
+        return (start, end, np.zeros(0))
+
+    # merge adjacent plateaus of the same level (split by noise)
+    sums = csum[end] - csum[start]
+    counts = end - start
+    means = sums / counts
+    group = np.hstack([0, np.cumsum(np.abs(np.diff(means)) >= step / 2)])
+    sums = np.bincount(group, weights=sums)
+    counts = np.bincount(group, weights=counts)
+    first = np.flatnonzero(np.diff(np.hstack([-1, group])))
+    last = np.flatnonzero(np.diff(np.hstack([group, group[-1] + 1])))
+    return (start[first], end[last], sums / counts)
+
+
+def select_sweep(means, step, count):
+    """
+    Select the set-point sweep from a sequence of plateaus: the first
+    sequence of count plateaus which all differ by one step from the
+    previous one.
+
+    :param means: vector of plateau means
+
+    :param step: the set-point step
+
+    :param count: the number of set-points of the sweep
+
+    :returns: index of the first plateau of the sweep
+    """
+    diff = np.abs(np.diff(means))
+    valid = ((diff > 0.5 * step) & (diff < 1.5 * step)).astype(np.int64)
+    if len(valid) < count - 1:
+        raise CalibrationError('found {} plateaus, expected at least {}'
+                               .format(len(means), count))
+    window_sum = np.convolve(valid, np.ones(count - 1, dtype=np.int64),
+                             mode='valid')
+    match = np.flatnonzero(window_sum == count - 1)
+    if not len(match):
+        raise CalibrationError('no sweep with {} set-points found'
+                               .format(count))
+    return match[0]
+
+
+def align_sweep(start, reading_index):
+    """
+    Select the set-point sweep from a sequence of plateaus using the sample
+    index of each SMU reading: the plateau of a reading is the last one
+    starting before it.
+
+    :param start: vector of plateau start indices
+
+    :param reading_index: vector of sample indices of the SMU readings
+
+    :returns: vector of plateau indices, one per reading
+    """
+    plateaus = np.searchsorted(start, reading_index, side='right') - 1
+    if np.any(plateaus < 0) or np.any(np.diff(plateaus) != 1):
+        raise CalibrationError('SMU readings not aligned with the plateaus')
+    return plateaus
+
+
+def extract_setpoints(filename, channel_steps, setpoint_count, setpoint_delay,
+                      reading_times=None):
+    """
+    Extract the set-point measurements of the channels of one file.
+
+    :param filename: the RocketLogger data file
+
+    :param channel_steps: dictionary {channel name: set-point step in
+                          measurement units}
+
+    :param setpoint_count: number of set-points of the sweep
+
+    :param setpoint_delay: duration of one set-point in seconds
+
+    :param reading_times: optional vector of the times of the SMU readings
+                          (ns since the epoch), used to align the set-points
+                          instead of searching the sweep (the sweep is
+                          searched if the readings cannot be aligned)
+
+    :returns: tuple (start time, sample rate, {channel name: set-point
+              measurements})
+    """
+    data = RldFile(filename)
+    header = data.get_header()
+    rate = header['sample_rate']
+    window = max(2, int(_DERIVATIVE_WINDOW * rate * setpoint_delay))
+    min_length = max(1, int(_MIN_PLATEAU_LENGTH * rate * setpoint_delay))
+    setpoints = {}
+    for name, step in channel_steps.items():
+        channel = data.get_channel(name)
+        raw_step = step / channel.scale
+        start, end, means = detect_plateaus(channel.get_raw(), raw_step,
+                                            window, min_length)
+        plateaus = None
+        if reading_times is not None:
+            # readings are taken at the end of each set-point, align the
+            # set-point centers to be robust against the timing uncertainty
+            start_time = header['start_time'].astype(np.int64)
+            reading_index = ((reading_times - start_time) * rate / 1e9 -
+                             0.5 * setpoint_delay * rate)
+            try:
+                plateaus = align_sweep(start, reading_index)
+            except CalibrationError as e:
+                warnings.warn('{} ({}), searching the sweep instead'.format(
+                    e, name))
+        if plateaus is None:
+            first = select_sweep(means, raw_step, setpoint_count)
+            plateaus = slice(first, first + setpoint_count)
+        setpoints[name] = means[plateaus] * channel.scale
+    return (header['start_time'], rate, setpoints)
+
+
+def _extract_setpoints_worker(args):
+    return extract_setpoints(*args)
+
+
+def write_reference_file(filename, readings, trigger_time,
+                         trigger_uncertainty, start_delay=0):
+    """
+    Write the SMU readings of a calibration sweep to file (CSV).
+
+    :param filename: name of the file to write
+
+    :param readings: SMU buffer values (fields source, reading, time)
+
+    :param trigger_time: host time of the sweep trigger (ns since the epoch)
+
+    :param trigger_uncertainty: uncertainty of the trigger time in ns
+
+    :param start_delay: time from the trigger to the first reading in ns
+    """
+    header = ('trigger_time={:d}\ntrigger_uncertainty={:d}\n'
+              'start_delay={:d}\nsource,reading,time'.format(
+                  trigger_time, trigger_uncertainty, start_delay))
+    np.savetxt(filename, np.column_stack([readings['source'],
+                                          readings['reading'],
+                                          readings['time']]),
+               fmt='%.12e', delimiter=',', header=header)
+
+
+def read_reference_file(filename):
+    """
+    Read the SMU readings of a calibration sweep from file.
+
+    :param filename: name of the file written by write_reference_file()
+
+    :returns: tuple (source values, reading times in ns since the epoch)
+    """
+    properties = {}
+    with open(filename) as f:
+        for line in f:
+            if not line.startswith('#'):
+                break
+            key, _, value = line[1:].strip().partition('=')
+            if value:
+                properties[key] = int(value)
+    values = np.loadtxt(filename, delimiter=',', ndmin=2)
+    # reading times are relative to the first reading
+    times = (properties['trigger_time'] + properties.get('start_delay', 0) +
+             np.round(values[:, 2] * 1e9).astype(np.int64))
+    return (values[:, 0], times)
+
+
+def regression_linear(measurement, reference, zero_weight=1):
+    """
+    Linear least squares fit of the reference on the measurement, with extra
+    weight on zero values.
+
+    :returns: (offset, scale) tuple of offset and scale values
+    """
+    weight = 1 + np.isclose(np.abs(reference), 0) * (zero_weight - 1)
+    poly_coeffs = np.polyfit(measurement, reference, 1, w=weight)
+    offset = round(poly_coeffs[1] / poly_coeffs[0])
+    scale = poly_coeffs[0]
+    return (offset, scale)
+
+
+class Calibration():
+    """
+    RocketLogger calibration from the voltage, low current and high current
+    sweep measurements.
+
+    Only the plateau means (one value per set-point) are used for the fit.
+    The three measurement files are processed in parallel. If the SMU
+    readings of a sweep are available (see write_reference_file()), the
+    measured source values are used as reference and the plateaus are
+    aligned using the reading times (or searched if this fails).
+    """
+
+    def __init__(self, filename_v, filename_il, filename_ih,
+                 references=None):
+        self.filenames = {'v': filename_v, 'il': filename_il,
+                          'ih': filename_ih}
+        self.references = references or {}
+        self.measurement = None
+        self.calibration_time = None
+        self.offset = None
+        self.scale = None
+        self.error_offset = None
+        self.error_scale = None
+        self.error_rmse = None
+
+    def recalibrate(self, setup, fix_signs=True, target_offset_error=1,
+                    processes=3):
+        """
+        Perform the channel calibration.
+
+        :param setup: calibration setup (RocketLoggerCalibrationSetup)
+
+        :param fix_signs: set True to fix sign errors of the scales
+
+        :param target_offset_error: factor in [1, inf) specifying the multiple
+                                    of the zero error to use as offset error
+
+        :param processes: number of worker processes (1 to disable)
+        """
+        if target_offset_error < 1:
+            raise ValueError('target_offset_error factor needs to be >= 1.')
+
+        v_step = setup.get_voltage_step(calibration=True)
+        il_step = setup.get_current_low_step(calibration=True)
+        ih_step = setup.get_current_high_step(calibration=True)
+        count = setup.get_setpoint_count()
+        delay = setup.get_delay()
+        reference = {
+            'v': setup.get_voltage_setpoints(),
+            'il': setup.get_current_low_setpoints(),
+            'ih': setup.get_current_high_setpoints(),
+        }
+        reading_times = {}
+        for key, filename in self.references.items():
+            reference[key], reading_times[key] = read_reference_file(filename)
+        jobs = [
+            (self.filenames['v'], {'V1': v_step, 'V2': v_step}, count, delay,
+             reading_times.get('v')),
+            (self.filenames['il'], {'I1L': il_step}, count, delay,
+             reading_times.get('il')),
+            (self.filenames['ih'], {'I1H': ih_step}, count, delay,
+             reading_times.get('ih')),
+        ]
+        if processes > 1:
+            with Pool(min(processes, len(jobs))) as pool:
+                results = pool.map(_extract_setpoints_worker, jobs)
+        else:
+            results = [extract_setpoints(*job) for job in jobs]
+
+        sample_rates = [rate for _, rate, _ in results]
+        if not all(x == sample_rates[0] for x in sample_rates):
+            raise CalibrationError(
+                'inconsistent sample rate across measurements!')
+
+        self.measurement = {}
+        for _, _, setpoints in results:
+            self.measurement.update(setpoints)
+        for alias, name in CALIBRATION_CHANNEL_ALIASES.items():
+            self.measurement[alias] = self.measurement[name]
+        self.calibration_time = np.array(
+            min(start_time for start_time, _, _ in results),
+            dtype='datetime64[s]')
+
+        reference = [np.asarray(reference['v'])] * 4 + [
+            np.asarray(reference['il']), np.asarray(reference['ih'])] * 2
+        measurement = [self.measurement[name]
+                       for name in CALIBRATION_CHANNEL_NAMES]
+
+        offsets, scales = zip(*[regression_linear(x, y) for x, y
+                                in zip(measurement, reference)])
+
+        # residuals and errors
+        residual = [(x + offset) * scale - y for x, y, offset, scale
+                    in zip(measurement, reference, offsets, scales)]
+        # zero set-points (measured reference values are not exactly zero)
+        steps = [setup.get_voltage_step()] * 4 + [
+            setup.get_current_low_step(), setup.get_current_high_step()] * 2
+        offset_errors = [
+            np.max(np.abs(res[np.abs(ref) < step / 2])) * target_offset_error
+            for res, ref, step in zip(residual, reference, steps)]
+        scale_errors = [
+            np.abs(np.fmin(np.abs(res - offset_error),
+                           np.abs(res + offset_error)) / ref)
+            for res, ref, offset_error
+            in zip(residual, reference, offset_errors)]
+
+        self.offset = np.array(offsets, dtype='<i4')
+        self.scale = np.array([scale / file_scale for scale, file_scale
+                               in zip(scales, CALIBRATION_CHANNEL_SCALES)],
+                              dtype='<f8')
+        self.error_offset = np.array(offset_errors)
+        self.error_scale = np.array(
+            [np.max(scale_error[np.abs(ref) > 0.1 * np.abs(np.max(ref))])
+             for scale_error, ref in zip(scale_errors, reference)])
+        self.error_rmse = np.array([np.sqrt(np.dot(res, res))
+                                    for res in residual])
+
+        if fix_signs:
+            for ch, pos in enumerate(CALIBRATION_CHANNEL_SCALES_POSITIVE):
+                if pos and self.scale[ch] < 0:
+                    self.scale[ch] = -self.scale[ch]
+
+    def print_statistics(self, file=None):
+        """
+        Print statistics of the calibration.
+
+        :param file: file object to print to (default: sys.stdout)
+        """
+        print('RocketLogger Calibration Statistics', file=file)
+        if self.offset is None:
+            print('no calibration data available', file=file)
+            return
+        print('Measurement time:   {}'.format(self.calibration_time),
+              file=file)
+        print(file=file)
+        print('Calibration values:', file=file)
+        print('  Channel  :  Offset [bit]  :  Scale [unit/bit]', file=file)
+        for i, name in enumerate(CALIBRATION_CHANNEL_NAMES):
+            print('  {:7s}  :  {:12d}  :  {:16.6f}'.format(
+                name, self.offset[i], self.scale[i]), file=file)
+        print(file=file)
+        print('Error calculation values:', file=file)
+        print('  Channel  :  Offset [unit]  :  Scale [%]  :  RMSE [unit]',
+              file=file)
+        for i, name in enumerate(CALIBRATION_CHANNEL_NAMES):
+            print('  {:7s}  :  {:13.6g}  :  {:9.5f}  :  {:11.6g}'.format(
+                name, self.error_offset[i], 100 * self.error_scale[i],
+                self.error_rmse[i]), file=file)
+
+    def write_calibration_file(self, filename='calibration.dat'):
+        """
+        Write the calibration to file (RocketLogger calibration file format).
+
+        :param filename: name of the file to write the calibration values to
+        """
+        if self.offset is None:
+            raise CalibrationError('No calibration data available. '
+                                   'Perform recalibration first.')
+        filedata = np.array([(CALIBRATION_FILE_MAGIC,
+                              CALIBRATION_FILE_VERSION,
+                              CALIBRATION_FILE_HEADER_LENGTH,
+                              self.calibration_time,
+                              self.offset,
+                              self.scale)],
+                            dtype=CALIBRATION_FILE_DTYPE)
+        filedata.tofile(filename)
+
+    def write_log_file(self, filename='calibration.log'):
+        """
+        Write the calibration statistics to file.
+
+        :param filename: name of the file to write the calibration log to
+        """
+        with open(filename, 'w') as f:
+            self.print_statistics(file=f)
@@ -0,0 +1,348 @@
+"""
+Lean RocketLogger binary data file (.rld) reader
+
+Copyright (c) 2019, ETH Zurich, Computer Engineering Group
+All rights reserved.
+
+Redistribution and use in source and binary forms, with or without
+modification, are permitted provided that the following conditions are met:
+
+* Redistributions of source code must retain the above copyright notice, this
+  list of conditions and the following disclaimer.
+
+* Redistributions in binary form must reproduce the above copyright notice,
+  this list of conditions and the following disclaimer in the documentation
+  and/or other materials provided with the distribution.
+
+* Neither the name of the copyright holder nor the names of its
+  contributors may be used to endorse or promote products derived from
+  this software without specific prior written permission.
+
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+"""
+
+import os
+
+import numpy as np
+
+
+# file format, see rocketlogger/rl_file.h
+RLD_FILE_MAGIC = 0x444C5225
+RLD_FILE_VERSION = 0x03
+
+_LEAD_IN_DTYPE = np.dtype([
+    ('file_magic', '<u4'),
+    ('file_version', '<u2'),
+    ('header_length', '<u2'),
+    ('data_block_size', '<u4'),
+    ('data_block_count', '<u4'),
+    ('sample_count', '<u8'),
+    ('sample_rate', '<u2'),
+    ('mac_address', 'u1', 6),
+    ('start_time_sec', '<i8'),
+    ('start_time_ns', '<i8'),
+    ('comment_length', '<u4'),
+    ('channel_binary_count', '<u2'),
+    ('channel_count', '<u2'),
+])
+
+_CHANNEL_DTYPE = np.dtype([
+    ('unit', '<u4'),
+    ('scale', '<i4'),
+    ('data_size', '<u2'),
+    ('valid_link', '<u2'),
+    ('name', 'S16'),
+])
+
+_TIMESTAMP_DTYPE = np.dtype([
+    ('realtime_sec', '<i8'),
+    ('realtime_ns', '<i8'),
+    ('monotonic_sec', '<i8'),
+    ('monotonic_ns', '<i8'),
+])
+
+_BINARY_FIELD = 'bin'
+
+
+class RldChannel():
+    """
+    Lazily scaled view of one channel of a data file.
+
+    The raw values are read from the memory mapped file only for the
+    requested range and scaled on access.
+    """
+
+    def __init__(self, info, blocks, tail, field, length, bit=None):
+        self.info = info
+        self.name = info['name']
+        self.scale = 10.0 ** info['scale']
+        self._blocks = blocks[field] if blocks is not None else None
+        self._tail = tail[field] if tail is not None else None
+        self._bit = bit
+        self._length = length
+        self._block_size = self._blocks.shape[1] if self._blocks is not None else 0
+
+    def __len__(self):
+        return self._length
+
+    def __getitem__(self, key):
+        if isinstance(key, (int, np.integer)):
+            if key < 0:
+                key += self._length
+            return self[key:key + 1][0]
+        if not isinstance(key, slice):
+            raise TypeError('only integer and slice indices are supported')
+        start, stop, step = key.indices(self._length)
+        if stop <= start:
+            return np.empty(0)
+        return self._scale(self._read(start, stop))[::step]
+
+    def __array__(self, dtype=None):
+        values = self[:]
+        if dtype is not None:
+            values = values.astype(dtype)
+        return values
+
+    @property
+    def raw_blocks(self):
+        """
+        Zero-copy view of the raw values of all complete data blocks.
+
+        :returns: array of shape (block count, block size), memory mapped
+        """
+        return self._blocks
+
+    def get_raw(self, start=0, stop=None):
+        """
+        Get the unscaled values of a sample range.
+
+        :param start: index of the first sample
+
+        :param stop: index after the last sample (default: end of file)
+
+        :returns: numpy array of the raw values
+        """
+        start, stop, _ = slice(start, stop).indices(self._length)
+        values = self._read(start, stop)
+        if self._bit is not None:
+            values = (values >> self._bit) & 1
+        return values
+
+    def _read(self, start, stop):
+        pieces = []
+        full_count = self._blocks.size if self._blocks is not None else 0
+        if start < full_count:
+            first = start // self._block_size
+            last = (min(stop, full_count) - 1) // self._block_size + 1
+            rows = self._blocks[first:last].reshape(-1)
+            pieces.append(rows[start - first * self._block_size:
+                               min(stop, full_count) - first * self._block_size])
+        if stop > full_count:
+            pieces.append(self._tail[max(start - full_count, 0):
+                                     stop - full_count])
+        return pieces[0] if len(pieces) == 1 else np.concatenate(pieces)
+
+    def _scale(self, values):
+        if self._bit is not None:
+            return ((values >> self._bit) & 1).astype(np.float64)
+        return values * self.scale
+
+
+class RldFile():
+    """
+    Memory mapped RocketLogger data file.
+
+    Channels are accessed as RldChannel views without loading the file into
+    memory. Aliases for channels can be added at no cost.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self._aliases = {}
+        self._channels = {}
+        self._read_header()
+        self._map_data()
+
+    def _read_header(self):
+        with open(self.filename, 'rb') as f:
+            lead_in = np.frombuffer(f.read(_LEAD_IN_DTYPE.itemsize),
+                                    dtype=_LEAD_IN_DTYPE)
+            if len(lead_in) != 1 or lead_in['file_magic'][0] != RLD_FILE_MAGIC:
+                raise ValueError('{} is not a RocketLogger data file'.format(
+                    self.filename))
+            lead_in = lead_in[0]
+            if lead_in['file_version'] != RLD_FILE_VERSION:
+                raise ValueError('unsupported file version {}'.format(
+                    lead_in['file_version']))
+            comment = f.read(int(lead_in['comment_length']))
+            channel_count = (int(lead_in['channel_binary_count']) +
+                             int(lead_in['channel_count']))
+            channels = np.frombuffer(
+                f.read(channel_count * _CHANNEL_DTYPE.itemsize),
+                dtype=_CHANNEL_DTYPE)
+
+        self._header = {
+            'file_version': int(lead_in['file_version']),
+            'header_length': int(lead_in['header_length']),
+            'data_block_size': int(lead_in['data_block_size']),
+            'data_block_count': int(lead_in['data_block_count']),
+            'sample_count': int(lead_in['sample_count']),
+            'sample_rate': int(lead_in['sample_rate']),
+            'mac_address': ':'.join('{:02x}'.format(x)
+                                    for x in lead_in['mac_address']),
+            'start_time': np.datetime64(int(lead_in['start_time_sec']) *
+                                        1000000000 +
+                                        int(lead_in['start_time_ns']), 'ns'),
+            'comment': comment.split(b'\x00', 1)[0].decode(errors='replace'),
+            'channel_binary_count': int(lead_in['channel_binary_count']),
+            'channel_count': int(lead_in['channel_count']),
+            'channels': [{
+                'unit_index': int(ch['unit']),
+                'scale': int(ch['scale']),
+                'data_size': int(ch['data_size']),
+                'valid_link': int(ch['valid_link']),
+                'name': ch['name'].split(b'\x00', 1)[0].decode(),
+            } for ch in channels],
+        }
+
+    def _map_data(self):
+        header = self._header
+        block_size = header['data_block_size']
+        binary_count = header['channel_binary_count']
+        analog = header['channels'][binary_count:]
+
+        # one row of a data block: binary channels (packed), analog channels
+        row_fields = []
+        if binary_count > 0:
+            row_fields.append((_BINARY_FIELD, '<u4'))
+        for ch in analog:
+            row_fields.append((ch['name'], '<i{:d}'.format(ch['data_size'])))
+        row_dtype = np.dtype(row_fields)
+        block_dtype = np.dtype([('timestamp', _TIMESTAMP_DTYPE),
+                                ('data', row_dtype, (block_size,))])
+
+        data_size = os.path.getsize(self.filename) - header['header_length']
+        block_count = min(data_size // block_dtype.itemsize,
+                          header['data_block_count'])
+        self._blocks = None
+        self._timestamps = None
+        blocks = None
+        if block_count > 0:
+            self._blocks = np.memmap(self.filename, dtype=block_dtype,
+                                     mode='r', offset=header['header_length'],
+                                     shape=(block_count,))
+            self._timestamps = self._blocks['timestamp']
+            blocks = self._blocks['data']
+
+        # last block may be incomplete
+        tail = None
+        tail_offset = (header['header_length'] +
+                       block_count * block_dtype.itemsize)
+        tail_rows = min(
+            (data_size - block_count * block_dtype.itemsize -
+             _TIMESTAMP_DTYPE.itemsize) // row_dtype.itemsize,
+            header['sample_count'] - block_count * block_size)
+        if tail_rows > 0:
+            tail = np.memmap(self.filename, dtype=row_dtype, mode='r',
+                             offset=tail_offset + _TIMESTAMP_DTYPE.itemsize,
+                             shape=(tail_rows,))
+        else:
+            tail_rows = 0
+        length = min(block_count * block_size + tail_rows,
+                     header['sample_count'])
+
+        for index, ch in enumerate(header['channels']):
+            if index < binary_count:
+                channel = RldChannel(ch, blocks, tail, _BINARY_FIELD,
+                                     length, bit=index)
+            else:
+                channel = RldChannel(ch, blocks, tail, ch['name'], length)
+            self._channels[ch['name']] = channel
+
+    def get_header(self):
+        """
+        Get the file header information.
+
+        :returns: dictionary of the header fields (same keys as used by
+                  RocketLoggerData)
+        """
+        return self._header
+
+    def get_channel_names(self):
+        """
+        Get the names of all channels, including aliases.
+        """
+        return list(self._channels.keys()) + list(self._aliases.keys())
+
+    def add_alias(self, alias, channel_name):
+        """
+        Make a channel available under another name (no data is copied).
+
+        :param alias: the additional channel name
+
+        :param channel_name: the name of the existing channel
+        """
+        self.get_channel(channel_name)
+        self._aliases[alias] = channel_name
+
+    def get_channel(self, channel_name):
+        """
+        Get a lazily scaled channel view.
+
+        :param channel_name: the name of the channel or an alias
+
+        :returns: RldChannel view of the channel
+        """
+        name = self._aliases.get(channel_name, channel_name)
+        if name not in self._channels:
+            raise KeyError('Channel "{:s}" not found.'.format(channel_name))
+        return self._channels[name]
+
+    def get_data(self, channel_names=['all']):
+        """
+        Get the scaled data of the specified channels (same interface as
+        RocketLoggerData.get_data()).
+
+        :param channel_names: list of channel names or 'all'
+
+        :returns: numpy array of shape (sample count, channel count)
+        """
+        if not isinstance(channel_names, list):
+            channel_names = [channel_names]
+        if 'all' in channel_names:
+            channel_names = list(self._channels.keys())
+        channels = [self.get_channel(name) for name in channel_names]
+        length = len(channels[0]) if channels else 0
+        values = np.empty((length, len(channels)))
+        for index, channel in enumerate(channels):
+            values[:, index] = channel[:]
+        return values
+
+    def get_time(self):
+        """
+        Get the relative timestamps of the samples in seconds.
+        """
+        length = len(next(iter(self._channels.values()))) \
+            if self._channels else 0
+        return np.arange(length) / self._header['sample_rate']
+
+    def get_block_timestamps(self):
+        """
+        Get the realtime timestamps of the complete data blocks.
+
+        :returns: numpy array of datetime64[ns] values
+        """
+        if self._timestamps is None:
+            return np.empty(0, dtype='datetime64[ns]')
+        return (self._timestamps['realtime_sec'] * 1000000000 +
+                self._timestamps['realtime_ns']).astype('datetime64[ns]')
@@ -31,6 +31,10 @@ OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 
 """
 
+import time
+
+import numpy as np
+
 # pyvisa packet (wrapper for visa backend: pyvisa-py or NI's NI-VISA binary needs to be installed)
 import visa
 
@@ -100,14 +104,67 @@ delay(0.3)
 beeper.beep(0.2, 600)
 '''
 
+# duration of the start beep sequence executed before the trigger in s
+BEEP_START_DURATION = 0.7
+
+# source delay of the sweep commands above in s (reading at the end of each
+# set-point)
+SOURCE_DELAY = 250e-3
+
 _COMMAND_BEEP_END = '''
 beeper.beep(0.8, 600)
 '''
 
+_COMMAND_FORMAT_BINARY = '''
+format.data = format.REAL64
+format.byteorder = format.LITTLEENDIAN
+'''
+
+_COMMAND_FORMAT_ASCII = '''
+format.data = format.ASCII
+'''
+
+_COMMAND_QUERY_BUFFER_COUNT = '''
+waitcomplete()
+print(defbuffer1.n)
+'''
+
 _COMMAND_READ_BUFFER = '''
-printbuffer(1, defbuffer1.n, defbuffer1.sourcevalues, defbuffer1.readings)
+printbuffer(1, defbuffer1.n, defbuffer1.sourcevalues, defbuffer1.readings, defbuffer1.relativetimestamps)
 '''
 
+# buffer values returned by _COMMAND_READ_BUFFER (interleaved per reading)
+BUFFER_DTYPE = np.dtype([
+    ('source', '<f8'),
+    ('reading', '<f8'),
+    ('time', '<f8'),
+])
+
+
+def read_binary_block(read_bytes, size=None):
+    """
+    Read an IEEE 488.2 binary block.
+
+    :param read_bytes: function reading the given number of bytes
+
+    :param size: payload size in bytes, required for indefinite length
+                 blocks (#0)
+
+    :returns: the payload bytes
+    """
+    header = read_bytes(2)
+    if header[0:1] != b'#' or not header[1:2].isdigit():
+        raise ValueError('invalid binary block header {}'.format(header))
+    digits = int(header[1:2])
+    if digits > 0:
+        size = int(read_bytes(digits))
+    elif size is None:
+        raise ValueError('size of indefinite length binary block unknown')
+    payload = read_bytes(size)
+    # consume message termination
+    read_bytes(1)
+    return payload
+
 
 class SMU2450():
     """
@@ -120,10 +177,16 @@ class SMU2450():
         self.socket_address = 'TCPIP::{}::{}::SOCKET'.format(self.hostname,
                                                              self.port)
         self.rm = visa.ResourceManager('@py')
+        self.device = None
+        self.trigger_time = None
+        self.trigger_uncertainty = None
+        self.start_delay = None
+        self._pending_delay = 0
 
     def connect(self):
         print('Connecting SMU2450 at: {}'.format(self.socket_address))
         self.device = self.rm.open_resource(self.socket_address)
+        self.device.read_termination = '\n'
         self.device.clear()
         self.device.timeout = 3000
 
@@ -167,19 +230,63 @@ class SMU2450():
         self.device.write(_COMMAND_SETUP_CURRENT_HIGH_SWEEP)
 
     def start(self):
+        """
+        Start the sweep and record the trigger time.
+
+        The trigger time (host wall clock in ns since the epoch) is the
+        center of the interval during which the trigger command was sent,
+        its uncertainty half of this interval. The start delay (in ns) is
+        the time from the trigger to the first reading: the instrument
+        executes the queued start beeps before the trigger and takes the
+        first reading at the end of the source delay.
+        """
+        time_before = time.time_ns()
         self.device.write(_COMMAND_TRIGGER)
+        time_after = time.time_ns()
+        self.trigger_time = (time_before + time_after) // 2
+        self.trigger_uncertainty = (time_after - time_before) // 2
+        self.start_delay = round((self._pending_delay + SOURCE_DELAY) * 1e9)
+        self._pending_delay = 0
 
     def stop(self):
         self.device.write(_COMMAND_ABORT)
 
-    # def read_buffer(self):
-    #     return self.device.query(_COMMAND_READ_BUFFER)
+    def read_buffer(self, timeout=120000):
+        """
+        Read the source values, readings and reading times of the sweep.
+
+        Waits for the sweep to complete and transfers the buffer in binary
+        format.
+
+        :param timeout: max. time to wait for the sweep to complete in ms
+
+        :returns: numpy array of BUFFER_DTYPE, the time of each reading
+                  relative to the first one in seconds
+        """
+        default_timeout = self.device.timeout
+        self.device.timeout = timeout
+        try:
+            count = int(float(self.device.query(_COMMAND_QUERY_BUFFER_COUNT)))
+        finally:
+            self.device.timeout = default_timeout
+        if count == 0:
+            return np.zeros(0, dtype=BUFFER_DTYPE)
+
+        self.device.write(_COMMAND_FORMAT_BINARY)
+        try:
+            self.device.write(_COMMAND_READ_BUFFER)
+            payload = read_binary_block(self.device.read_bytes,
+                                        count * BUFFER_DTYPE.itemsize)
+        finally:
+            self.device.write(_COMMAND_FORMAT_ASCII)
+        return np.frombuffer(payload, dtype=BUFFER_DTYPE, count=count)
 
     def wait_complete(self):
         self.device.write(_COMMAND_WAIT_COMPLETE)
 
     def beep_start(self):
         self.device.write(_COMMAND_BEEP_START)
+        self._pending_delay += BEEP_START_DURATION
 
     def beep_end(self):
         self.device.write(_COMMAND_BEEP_END)
@@ -0,0 +1,203 @@
+"""
+Mock SMU2450 TSP socket server for testing the calibration without instrument
+
+Copyright (c) 2019, ETH Zurich, Computer Engineering Group
+All rights reserved.
+
+Redistribution and use in source and binary forms, with or without
+modification, are permitted provided that the following conditions are met:
+
+* Redistributions of source code must retain the above copyright notice, this
+  list of conditions and the following disclaimer.
+
+* Redistributions in binary form must reproduce the above copyright notice,
+  this list of conditions and the following disclaimer in the documentation
+  and/or other materials provided with the distribution.
+
+* Neither the name of the copyright holder nor the names of its
+  contributors may be used to endorse or promote products derived from
+  this software without specific prior written permission.
+
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+"""
+
+import re
+import socketserver
+import sys
+import threading
+import time
+
+import numpy as np
+
+from .smu import BUFFER_DTYPE
+
+
+_SWEEP_LINEAR = re.compile(
+    r'smu\.source\.sweeplinear\(\s*"[^"]*"\s*,\s*([^,]+),\s*([^,]+),'
+    r'\s*([^,]+),\s*([^,)]+)(?:,\s*([^,)]+))?(?:,\s*([^,)]+))?'
+    r'(?:,\s*([^,)]+))?(?:,\s*([^,)]+))?')
+_PRINTBUFFER = re.compile(r'printbuffer\(([^)]*)\)')
+_PRINT = re.compile(r'print\(([^)]*)\)')
+_BEEP = re.compile(r'beeper\.beep\(\s*([^,)]+)')
+_DELAY = re.compile(r'delay\(\s*([^,)]+)\)')
+
+
+class MockSMU2450():
+    """
+    Simulated state of the SMU2450 for the commands used by SMU2450.
+
+    The sweep runs in simulated time, which is the real time multiplied by
+    the speedup factor. Like the instrument, beeps and delays block the
+    command queue (the trigger takes effect only after them) and each reading
+    is taken at the end of the source delay of its set-point. Readings are
+    the source values with relative gaussian noise.
+    """
+
+    def __init__(self, speedup=1.0, noise=1e-5, seed=None):
+        self.speedup = speedup
+        self.noise = noise
+        self.rng = np.random.default_rng(seed)
+        self.lock = threading.Lock()
+        self.busy_until = 0
+        self.reset()
+
+    def reset(self):
+        self.sweep = np.zeros(0)
+        self.delay = 0
+        self.readings = np.zeros(0, dtype=BUFFER_DTYPE)
+        self.trigger_time = None
+        self.binary = False
+
+    def setup_sweep(self, start, stop, points, delay, count=1, dual=False):
+        sweep = np.linspace(start, stop, points)
+        if dual:
+            sweep = np.hstack([sweep, sweep[-2::-1]])
+        self.sweep = np.tile(sweep, count)
+        self.delay = delay
+
+    def wait(self, duration):
+        self.busy_until = (max(time.monotonic(), self.busy_until) +
+                           duration / self.speedup)
+
+    def initiate(self):
+        self.trigger_time = max(time.monotonic(), self.busy_until)
+        self.readings = np.zeros(len(self.sweep), dtype=BUFFER_DTYPE)
+        self.readings['source'] = self.sweep
+        self.readings['reading'] = self.sweep * (
+            1 + self.noise * self.rng.standard_normal(len(self.sweep)))
+        # reading at the end of the source delay of each point, relative to
+        # the first reading
+        self.readings['time'] = np.arange(len(self.sweep)) * self.delay
+
+    def abort(self):
+        self.readings = self.readings[:self.get_count()]
+        self.trigger_time = None
+
+    def get_count(self):
+        if self.trigger_time is None:
+            return len(self.readings)
+        elapsed = (time.monotonic() - self.trigger_time) * self.speedup
+        return min(max(int(elapsed / self.delay), 0) if self.delay > 0
+                   else len(self.readings), len(self.readings))
+
+    def wait_complete(self):
+        if self.trigger_time is None:
+            return
+        remaining = (len(self.readings) * self.delay -
+                     (time.monotonic() - self.trigger_time) * self.speedup)
+        if remaining > 0:
+            time.sleep(remaining / self.speedup)
+
+    def print_buffer(self, start, end):
+        readings = self.readings[start - 1:end]
+        if self.binary:
+            return b'#0' + readings.tobytes() + b'\n'
+        return (', '.join('{:.9e}'.format(x) for row in readings.tolist()
+                          for x in row) + '\n').encode()
+
+    def execute(self, line):
+        """
+        Execute one TSP command line.
+
+        :returns: the response bytes (empty if none)
+        """
+        line = line.strip()
+        match = _SWEEP_LINEAR.search(line)
+        if match:
+            args = [(x or '').strip() for x in match.groups()]
+            self.setup_sweep(float(args[0]), float(args[1]), int(args[2]),
+                             float(args[3]),
+                             int(args[4]) if args[4] else 1,
+                             args[7] == 'smu.ON')
+        elif line.startswith('beeper.beep('):
+            self.wait(float(_BEEP.search(line).group(1)))
+        elif line.startswith('delay('):
+            self.wait(float(_DELAY.search(line).group(1)))
+        elif line.startswith('reset()'):
+            self.reset()
+        elif line.startswith('trigger.model.initiate()'):
+            self.initiate()
+        elif line.startswith('trigger.model.abort()'):
+            self.abort()
+        elif line.startswith('waitcomplete()'):
+            self.wait_complete()
+        elif line.startswith('defbuffer1.clear()'):
+            self.readings = np.zeros(0, dtype=BUFFER_DTYPE)
+        elif line.startswith('format.data'):
+            self.binary = not line.endswith('format.ASCII')
+        elif line.startswith('printbuffer('):
+            args = _PRINTBUFFER.search(line).group(1).split(',')
+            end = self.get_count() if args[1].strip() == 'defbuffer1.n' \
+                else int(args[1])
+            return self.print_buffer(int(args[0]), end)
+        elif line.startswith('print('):
+            expression = _PRINT.search(line).group(1).strip()
+            if expression == 'defbuffer1.n':
+                return '{:d}\n'.format(self.get_count()).encode()
+            return b'nil\n'
+        elif line == '*IDN?':
+            return b'KEITHLEY INSTRUMENTS,MODEL 2450,00000000,0.0.0 (mock)\n'
+        return b''
+
+
+class _MockSMU2450Handler(socketserver.StreamRequestHandler):
+
+    def handle(self):
+        for line in self.rfile:
+            line = line.decode(errors='replace')
+            with self.server.smu.lock:
+                response = self.server.smu.execute(line)
+            if response:
+                self.wfile.write(response)
+                self.wfile.flush()
+
+
+class MockSMU2450Server(socketserver.ThreadingTCPServer):
+    """
+    TCP socket server answering TSP commands like the SMU2450 (port 5025).
+    """
+
+    allow_reuse_address = True
+    daemon_threads = True
+
+    def __init__(self, hostname='localhost', port=5025, speedup=1.0):
+        super().__init__((hostname, port), _MockSMU2450Handler)
+        self.smu = MockSMU2450(speedup=speedup)
+
+
+if __name__ == "__main__":
+    port = int(sys.argv[1]) if len(sys.argv) >= 2 else 5025
+    speedup = float(sys.argv[2]) if len(sys.argv) >= 3 else 1.0
+    print('Mock SMU2450 listening on port {:d}'.format(port))
+    with MockSMU2450Server('', port, speedup) as server:
+        server.serve_forever()
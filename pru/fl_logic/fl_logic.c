@@ -93,6 +93,7 @@
 #define EXTRAOPT_USE_BB_PINNAMES    0x00000400      // use BeagleBone pin names instead of FlockLab pin names (only available if option EXTRAOPT_RELATIVE_TIME is selected)
 #define EXTRAOPT_PRINT_TO_STDOUT    0x00000800      // print all log messages to stdout
 #define EXTRAOPT_INCL_MONOTONIC     0x00001000      // include monotonic timestamp in the results csv file
+#define EXTRAOPT_NO_PARSING         0x00002000      // do not convert the tracing data to a csv file, only store the parameters required for the conversion in [filename].meta (written at the start and updated at the end of the sampling)
 
 
 // PARAMETER CHECK
@@ -430,7 +431,32 @@ int pru1_handshake(void)
 }
 
 
-int pru1_run(uint8_t* pru_buffer, FILE* data_file, time_t* starttime, time_t* stoptime)
+// store the parameters required to convert the tracing data (in case the conversion is done by another tool, e.g. testmanagement/lib/fllogic.py)
+void write_meta_file(const char* filename, unsigned long starttime_s, unsigned long stoptime_s, unsigned long offset)
+{
+  char  buffer[SPRINTF_BUFFER_LENGTH];
+  char  tmp_buffer[SPRINTF_BUFFER_LENGTH];
+  FILE* meta_file = NULL;
+
+  // write into a temporary file and rename it, the file may be read at any time by the GPIO converter
+  sprintf(buffer, "%s.meta", filename);
+  sprintf(tmp_buffer, "%s.meta.tmp", filename);
+  meta_file = fopen(tmp_buffer, "w");
+  if (NULL == meta_file) {
+    fl_log(LOG_ERROR, "failed to open file %s", tmp_buffer);
+    return;
+  }
+  fprintf(meta_file, "starttime=%lu\nstoptime=%lu\noffset=%lu\nsamplingrate=%u\nextraoptions=0x%x\n", starttime_s, stoptime_s, offset, sampling_rate, extra_options);
+  fclose(meta_file);
+  if (rename(tmp_buffer, buffer) != 0) {
+    fl_log(LOG_ERROR, "failed to rename file %s", tmp_buffer);
+    return;
+  }
+  fl_log(LOG_INFO, "tracing data not parsed, parameters stored in %s", buffer);
+}
+
+
+int pru1_run(uint8_t* pru_buffer, FILE* data_file, time_t* starttime, time_t* stoptime, const char* filename, uint32_t offset)
 {
   uint32_t readout_count = 0;
   time_t currtime = 0;
@@ -453,6 +479,10 @@ int pru1_run(uint8_t* pru_buffer, FILE* data_file, time_t* starttime, time_t* st
     fl_log(LOG_WARNING, "start time adjusted to %lu", currtime);
     *starttime = currtime;
   }
+  // if the data is converted by another tool while the sampling is running, the parameters are needed now
+  if (extra_options & EXTRAOPT_NO_PARSING) {
+    write_meta_file(filename, *starttime, *stoptime, offset);
+  }
 
   // start sampling
   fl_log(LOG_INFO, "starting sampling loop...");
@@ -488,6 +518,7 @@ int pru1_run(uint8_t* pru_buffer, FILE* data_file, time_t* starttime, time_t* st
     }
     // write to file
     fwrite(curr_buffer, (buffer_size / 2), 1, data_file);
+    fflush(data_file);    // make the data available to readers of the file
     // clear buffer
     memset(curr_buffer, 0, (buffer_size / 2));
     readout_count++;
@@ -955,7 +986,7 @@ int main(int argc, char** argv)
   }
 
   // --- start sampling ---
-  int rs = pru1_run(prubuffer, datafile, &starttime, &stoptime);
+  int rs = pru1_run(prubuffer, datafile, &starttime, &stoptime, filename, offset);
   if (rs != 0) {
     fl_log(LOG_ERROR, "pru1_run() returned with error code %d", rs);
   }
@@ -970,7 +1001,9 @@ int main(int argc, char** argv)
   fl_log(LOG_INFO, "samples stored in %s", filename);
 
   // --- parse data ---
-  if (extra_options & EXTRAOPT_RELATIVE_TIME) {
+  if (extra_options & EXTRAOPT_NO_PARSING) {
+    write_meta_file(filename, starttime, stoptime, offset);
+  } else if (extra_options & EXTRAOPT_RELATIVE_TIME) {
     parse_tracing_data_noscaling(filename);
   } else if (extra_options & EXTRAOPT_SIMPLE_SCALING) {
     parse_tracing_data(filename, starttime, stoptime, (extra_options & EXTRAOPT_INCL_MONOTONIC) != 0);
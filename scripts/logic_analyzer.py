@@ -48,27 +48,41 @@ How to:
   config-pin -a P839 pruin
 - install the flocklab-tools on your computer:
   python3 -m pip install flocklab-tools
+- all commands are sent over one shared SSH connection (ControlMaster), the trace is streamed back compressed
+  (zstd if available on both sides, gzip otherwise) while sampling
+- live mode (-l): the streamed trace is decoded on the fly and the last few seconds are shown in a rolling plot
+  (requires matplotlib), close the plot window or press ctrl+c to stop; the trace is streamed uncompressed in this
+  mode (compressors hold back the data until a block is full), note that fl_logic writes the samples in chunks of 8 KB
 
 """
 
 import sys
 import os
 import time
+import errno
 import getopt
+import shutil
 import traceback
+import select
 import subprocess
+import numpy as np
 import flocklab
 
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "../testmanagement"))
+import lib.fllogic as fllogic
+
 
 # --- config ---
 
 host      = "192.168.7.2"
 outputdir = "/tmp/fl_logic"
 showplot  = True
-
-pinmapping = {
-  "P845": "LED1", "P846": "LED2", "P843": "LED3", "P844": "INT1", "P841": "INT2", "P842": "SIG2", "P839": "SIG2", "P840": "nRST", "P827": "PPS"
-}
+ssh_opts  = []      # options for the shared SSH connection, set by open_session()
+options   = 0x00002701      # fl_logic extra options
+live      = False   # live mode
+window    = 10      # live mode: length of the displayed time window in seconds
+maxedges  = 100000  # live mode: capacity of the edge ring buffer
+framerate = 10      # live mode: max. number of plot updates per second
 
 
 def usage(argv):
@@ -76,13 +90,30 @@ def usage(argv):
 \t%s [options]\n
 \t-H, --host\tthe host name or IP address of the BeagleBone
 \t-o, --out\tthe output directory for the result files
-""" % __file__)
+\t-l, --live\tlive mode, show the last seconds of the trace in a rolling plot while sampling
+\t-w, --window\tlength of the time window in seconds for the live mode (default: %d)
+""" % (__file__, window))
+
+# open a shared SSH connection to the target beaglebone, all subsequent commands are multiplexed over this connection
+def open_session():
+    global ssh_opts
+    ssh_opts = ['-o', 'ControlMaster=auto', '-o', 'ControlPath=%s/.ssh-%%r@%%h:%%p' % outputdir, '-o', 'ControlPersist=60']
+    p = subprocess.Popen(['ssh'] + ssh_opts + ['-f', '-N', host], stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+    out, err = p.communicate(None)
+    if p.returncode != 0:
+        print("failed to connect to %s (%s)" % (host, err.strip()))
+        sys.exit(2)
+
+
+def close_session():
+    subprocess.call(['ssh'] + ssh_opts + ['-O', 'exit', host], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
 
 # execute a command on the target beaglebone
 def execute_cmd(command=None, return_output=True):
     if not command:
         return None
-    cmd = ['ssh' , host, command]
+    cmd = ['ssh'] + ssh_opts + [host, command]
     p = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
     if return_output:
         out, err = p.communicate(None)
@@ -93,24 +124,107 @@ def execute_cmd(command=None, return_output=True):
         return out
 
 
-def transfer_file(filename):
-    if not filename:
-        return
-    cmd = ['scp' , "%s:/tmp/%s" % (host, filename), outputdir]
-    p = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
-    out, err = p.communicate(None)
-    rs = p.returncode
-    if (rs != 0):
-        print("failed to retrieve file '%s'" % (filename))
-        sys.exit(2)
+# stream a file from the target beaglebone while it is being written (until the process with the given PID terminates)
+# returns the process handles of the pipeline (ssh | decompressor > localfile, or ssh | decompressor if pipe is set),
+# the last process provides the data; without compressor, the data is streamed uncompressed (ssh > localfile or ssh)
+def stream_file(remotefile, localfile, pid, compressor="gzip", pipe=False):
+    if not compressor:
+        cmd = ['ssh'] + ssh_opts + [host, "tail -c +1 -F --pid=%d %s 2>/dev/null" % (pid, remotefile)]
+        ssh = subprocess.Popen(cmd, stdout=(subprocess.PIPE if pipe else open(localfile, 'wb')), stderr=subprocess.DEVNULL)
+        return (ssh,)
+    cmd   = ['ssh'] + ssh_opts + [host, "tail -c +1 -F --pid=%d %s 2>/dev/null | %s -1 -c" % (pid, remotefile, compressor)]
+    ssh   = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+    dec   = subprocess.Popen([compressor, '-d', '-c'], stdin=ssh.stdout, stdout=(subprocess.PIPE if pipe else open(localfile, 'wb')))
+    ssh.stdout.close()      # dec is now the only reader
+    return (ssh, dec)
+
+
+# ring buffer for the most recent edges (fixed size)
+class EdgeBuffer():
+
+    def __init__(self, capacity):
+        self.timestamps = np.zeros(capacity)
+        self.pins       = np.zeros(capacity, dtype=np.uint8)
+        self.states     = np.zeros(capacity, dtype=np.uint8)
+        self.head       = 0         # next write position
+        self.count      = 0
+
+    def append(self, timestamps, pins, states):
+        capacity = len(self.timestamps)
+        if len(timestamps) > capacity:
+            timestamps, pins, states = timestamps[-capacity:], pins[-capacity:], states[-capacity:]
+        pos = (self.head + np.arange(len(timestamps))) % capacity
+        self.timestamps[pos] = timestamps
+        self.pins[pos]       = pins
+        self.states[pos]     = states
+        self.head  = (self.head + len(timestamps)) % capacity
+        self.count = min(self.count + len(timestamps), capacity)
+
+    # returns the edges with a timestamp >= since, in chronological order
+    def get(self, since=0.0):
+        order = (self.head - self.count + np.arange(self.count)) % len(self.timestamps)
+        sel   = order[self.timestamps[order] >= since]
+        return (self.timestamps[sel], self.pins[sel], self.states[sel])
+
+
+# decode the stream and show the most recent edges in a rolling plot until the plot window is closed or ctrl+c is pressed
+# the raw data is written to localfile
+def live_view(stream, localfile):
+    import matplotlib.pyplot as plt
+    decoder = fllogic.EdgeDecoder(fllogic.get_sampling_rate(options), fllogic.has_pps(options))
+    edges   = EdgeBuffer(maxedges)
+    fig, ax = plt.subplots()
+    lines   = [ax.plot([], [], drawstyle='steps-post')[0] for name in fllogic.pin_names]
+    ax.set_yticks([i * 1.5 + 0.5 for i in range(len(fllogic.pin_names))])
+    ax.set_yticklabels(fllogic.pin_names)
+    ax.set_ylim(-0.5, len(fllogic.pin_names) * 1.5)
+    ax.set_xlabel("time [s]")
+    plt.show(block=False)
+    fd        = stream.fileno()
+    last_draw = 0.0
+    with open(localfile, 'wb') as f:
+        try:
+            while plt.fignum_exists(fig.number) and not decoder.eof:
+                r, w, e = select.select([fd], [], [], 1.0 / framerate)
+                if r:
+                    data = os.read(fd, 1 << 20)
+                    if not data:
+                        break
+                    f.write(data)
+                    edges.append(*decoder.feed(data))
+                if time.monotonic() - last_draw < 1.0 / framerate:
+                    continue
+                last_draw = time.monotonic()
+                now = decoder.timestamp
+                timestamps, pins, states = edges.get(now - window)
+                for pin, line in enumerate(lines):
+                    sel = (pins == pin)
+                    if not np.any(sel):
+                        continue
+                    # extend the signal to the window borders (the level before the first edge is the inverse of the first state)
+                    x = np.concatenate(([now - window], timestamps[sel], [now]))
+                    y = np.concatenate(([1 - states[sel][0]], states[sel], [states[sel][-1]])) + pin * 1.5
+                    line.set_data(x, y)
+                ax.set_xlim(max(0.0, now - window), max(window, now))
+                fig.canvas.draw_idle()
+                fig.canvas.flush_events()
+        except KeyboardInterrupt:
+            sys.stdout.write("\b\b")
+    plt.close(fig)
+
+
+# write the remaining data of the stream to the file
+def drain_stream(stream, localfile):
+    with open(localfile, 'ab') as f:
+        shutil.copyfileobj(stream, f)
 
 
 def main(argv):
-    global host, outputdir
+    global host, outputdir, live, window
 
     # Get command line parameters.
     try:
-        opts, args = getopt.getopt(argv, "hH:o:", ["help", "host=", "out="])
+        opts, args = getopt.getopt(argv, "hH:o:lw:", ["help", "host=", "out=", "live", "window="])
     except getopt.GetoptError  as err:
         print(str(err), errno.EINVAL)
     for opt, arg in opts:
@@ -121,6 +235,10 @@ def main(argv):
             host = arg
         elif opt in ("-o", "--out"):
             outputdir = arg
+        elif opt in ("-l", "--live"):
+            live = True
+        elif opt in ("-w", "--window"):
+            window = float(arg)
         else:
             flocklab.error_logandexit("Unknown argument %s" % opt, errno.EINVAL)
 
@@ -131,48 +249,69 @@ def main(argv):
             print("failed to create output directory %s" % outputdir)
             sys.exit(1)
 
-    out = execute_cmd("which fl_logic")
-    if "/bin/fl_logic" not in out:
-        print("fl_logic not found on target %s" % host)
-        sys.exit(1)
+    open_session()
 
+    # check for fl_logic and zstd and start the sampling in one round-trip
+    # note: the raw data is parsed locally (option 0x2000), fl_logic only stores the parameters in a .meta file
     filename = "logic_trace_%d" % time.time()
-    execute_cmd("fl_logic /tmp/%s 0 0 0xff 0 0x00000701" % filename, return_output=False)
-
-    try:
-        input("logic analyzer started... (press enter or ctrl+c to stop)\n")
-    except KeyboardInterrupt:
-        sys.stdout.write("\b\b")
-        pass
-
-    out = execute_cmd("pgrep -f fl_logic")
+    out = execute_cmd("which fl_logic || echo 'NOTFOUND'; which zstd; nohup fl_logic /tmp/%s 0 0 0xff 0 0x%x > /dev/null 2>&1 & echo \"PID $!\"" % (filename, options))
+    if "NOTFOUND" in out:
+        print("fl_logic not found on target %s" % host)
+        close_session()
+        sys.exit(1)
     try:
-        pid = int(out)
+        pid = int(out.split("PID ")[-1])
     except:
         print("PID of fl_logic process not found")
+        close_session()
         sys.exit(3)
-    out = execute_cmd("kill -2 %d" % pid)
+    compressor = "zstd" if ("/zstd" in out and shutil.which("zstd")) else "gzip"
+    if live:
+        compressor = None   # the compressors buffer their output until a block is full -> stream uncompressed to keep the plot up to date
+    localfile  = outputdir + '/' + filename
+    stream     = stream_file("/tmp/" + filename, localfile, pid, compressor, live)
+
+    if live:
+        print("logic analyzer started... (close the plot window or press ctrl+c to stop)")
+        live_view(stream[-1].stdout, localfile)
+    else:
+        try:
+            input("logic analyzer started... (press enter or ctrl+c to stop)\n")
+        except KeyboardInterrupt:
+            sys.stdout.write("\b\b")
+            pass
+
+    execute_cmd("kill -2 %d" % pid)
     print("sampling stopped")
-
-    transfer_file(filename + ".csv")
+    if live:
+        drain_stream(stream[-1].stdout, localfile)
+
+    # the stream ends as soon as fl_logic has terminated
+    for p in stream:
+        p.wait()
+    # fetch the parameters and clean up in one round-trip
+    out = execute_cmd("cat /tmp/%s.meta; rm -f /tmp/%s /tmp/%s.meta" % (filename, filename, filename))
+    close_session()
+    with open(localfile + ".meta", 'w') as f:
+        f.write(out)
 
     print("parsing results...")
-    filename = outputdir + '/' + filename + ".csv"
-    with open(filename, 'r') as csvinfile, open(outputdir + '/gpiotracing.csv', 'w') as csvoutfile:
+    filename = localfile
+    samples  = fllogic.load_samples(filename)
+    ticks    = fllogic.get_ticks(samples)
+    rate     = fllogic.read_meta(filename).get('samplingrate', fllogic.sampling_rate_high)
+    with open(outputdir + '/gpiotracing.csv', 'w') as csvoutfile:
         csvoutfile.write("timestamp,node_id,pin_name,value\n")
         csvoutfile.write("0.0000000,1,nRST,1\n")    # required by flocklab-tools for plotting (for plotting)
         timestamp = 0
-        for line in csvinfile.readlines():
-            try:
-                (timestamp, pin, val) = line.split(',', 2)
-                if pin in pinmapping:
-                    pin = pinmapping[pin]     # pins must be renamed such that the flocklab-tools recognize it (for plotting)
-            except:
-                print("failed to parse line %s" % line)
-                continue
-            csvoutfile.write("%s,1,%s,%s" % (timestamp, pin, val))
+        for idx, pins, states in fllogic.iter_edges(samples, fllogic.has_pps(options)):
+            timestamps = ticks[idx] / rate
+            csvoutfile.write("".join(["%.7f,1,%s,%u\n" % (t, fllogic.pin_names[p], v) for t, p, v in zip(timestamps, pins, states)]))
+            timestamp = timestamps[-1]
         csvoutfile.write("%.7f,1,nRST,0\n" % (float(timestamp) + 1.0))    # required by flocklab-tools (for plotting)
+    del samples
     os.remove(filename)
+    os.remove(filename + ".meta")
     if not os.path.isfile(outputdir + '/powerprofiling.csv'):
         with open(outputdir + '/powerprofiling.csv', 'w') as f:
             f.write("timestamp,observer_id,node_id,current_mA,voltage_V\n")   # create empty file to suppress warning of flocklab tools
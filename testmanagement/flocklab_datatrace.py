@@ -37,6 +37,8 @@ import os, sys, getopt, signal, time, subprocess, errno, select, multiprocessing
 import lib.daemon as daemon
 import lib.flocklab as flocklab
 import lib.dwt as dwt
+import lib.jlinksession as jlinksession
+import lib.swo as swo
 
 
 debug     = False
@@ -44,9 +46,51 @@ pidfile   = None
 prescaler = 16     # default prescaler for local timestamps
 loopdelay = 10     # default SWO read loop delay in ms (recommended values: 10 - 100ms)
 
+statustimeout = 60  # max. time in seconds to wait for the daemon to report the configuration status
+
 scriptname = os.path.splitext(os.path.basename(__file__))[0]
 
 
+##############################################################################
+#
+# wait_for_status - waits until the daemon has reported the status of the
+#                   configuration over the pipe, returns the exit code
+#
+##############################################################################
+def wait_for_status(fd, timeout=statustimeout):
+    status = b""
+    end    = time.time() + timeout
+    while time.time() < end:
+        r, w, e = select.select([fd], [], [], max(0, end - time.time()))
+        if not r:
+            break
+        data = os.read(fd, 16)
+        if not data:
+            break       # daemon terminated without reporting a status
+        status += data
+    os.close(fd)
+    try:
+        return int(status)
+    except ValueError:
+        return flocklab.FAILED
+### END wait_for_status()
+
+
+##############################################################################
+#
+# report_status - reports the status of the configuration to the calling
+#                 process (see wait_for_status())
+#
+##############################################################################
+def report_status(fd, status):
+    try:
+        os.write(fd, str(status).encode())
+        os.close(fd)
+    except OSError:
+        pass
+### END report_status()
+
+
 ##############################################################################
 #
 # Usage
@@ -57,9 +101,10 @@ def usage():
     print("Options:")
     print("  --output=<string>\t\toutput filename")
     print("  --platform=<string>\t\tplatform name (e.g. dpp2lora or nrf5)")
-    print("  --config=<string>\t\tDWT configuration, up to 4 comma separated value tuples of variable address, access mode and variable size.")
+    print("  --config=<string>\t\tDWT configuration, comma separated value tuples (one per comparator, max. 4, less if the target implements fewer comparators) of variable address, access mode and variable size.")
     print("  --stop\t\t\tOptional. Causes the program to stop a possibly running instance of the data trace service.")
     print("  --speed\t\t\tOptional. The CPU clock frequency of the target device.")
+    print("  --benchmark\t\t\tOptional. Measure loop jitter and CPU load of the SWO output formats and exit.")
     print("  --help\t\t\tOptional. Print this help.")
 ### END usage()
 
@@ -121,6 +166,7 @@ def main(argv):
     global prescaler
 
     stop     = False
+    bench    = False
     filename = None
     platform = None
     dwtconf  = None
@@ -134,7 +180,7 @@ def main(argv):
 
     # Get command line parameters.
     try:
-        opts, args = getopt.getopt(argv, "eho:p:c:s:vd:t:", ["stop", "help", "output=", "platform=", "config=", "speed=", "debug", "delay=", "timescale="])
+        opts, args = getopt.getopt(argv, "eho:p:c:s:vd:t:b", ["stop", "help", "output=", "platform=", "config=", "speed=", "debug", "delay=", "timescale=", "benchmark"])
     except(getopt.GetoptError) as err:
         flocklab.error_logandexit(str(err), errno.EINVAL)
     for opt, arg in opts:
@@ -143,6 +189,8 @@ def main(argv):
             sys.exit(flocklab.SUCCESS)
         elif opt in ("-e", "--stop"):
             stop = True
+        elif opt in ("-b", "--benchmark"):
+            bench = True
         elif opt in ("-o", "--output"):
             filename = arg
         elif opt in ("-p", "--platform"):
@@ -165,6 +213,11 @@ def main(argv):
         else:
             flocklab.error_logandexit("Unknown option '%s'." % (opt), errno.EINVAL)
 
+    if bench:
+        for fmt, res in swo.benchmark(loop_delay_in_ms=loopdelay).items():
+            print("%-6s loops: %d, CPU load: %.1f%%, lateness mean: %.3fms, p99: %.3fms, max: %.3fms" % (fmt, res['loops'], res['cpu_load'] * 100, res['jitter_mean'] * 1000, res['jitter_p99'] * 1000, res['jitter_max'] * 1000))
+        sys.exit(flocklab.SUCCESS)
+
     # Check mandatory parameters:
     if not stop:
         if not filename or not platform:
@@ -198,11 +251,11 @@ def main(argv):
                 logger.info("SWO speed adjusted to %d" % swospeed)
 
     # DWT config provided?
-    # Note: configure service before daemonizing the process
+    # Note: parse the config before daemonizing the process
+    dwtvalues = []
     if dwtconf:
         try:
             # parse
-            dwtvalues = []
             values = dwtconf.split(',')
             num_triples = int(len(values) / 3) * 3
             idx = 0
@@ -222,35 +275,33 @@ def main(argv):
                     mode = 'r'
                 else:
                     mode = 'w'    # default mode
-                dwtvalues.append([int(var, 0), mode, tracepc, size])
+                dwtvalues.append((int(var, 0), mode, tracepc, size))
             # config valid?
             if len(dwtvalues) > 0:
                 for elem in dwtvalues:
                     logger.info("Config found: addr=0x%x, mode=%s, pc=%s, size=%d" % (elem[0], elem[1], str(elem[2]), elem[3]))
-                # fill up the unused variables with zeros
-                while len(dwtvalues) < 4:
-                    dwtvalues.append([None, None, None, None])
-                # apply config
                 logger.info("Configuring data trace service for MCU %s with prescaler %d and loop delay %dms..." % (flocklab.jlink_mcu_str(platform), prescaler, loopdelay))
-                # if target is in reset state, it will be released by the config function below
-                reset = flocklab.gpio_get(flocklab.gpio_tg_nrst)
-                dwt.config_dwt_for_data_trace(device_name=flocklab.jlink_mcu_str(platform), ts_prescaler=prescaler,
-                                              trace_address0=dwtvalues[0][0], access_mode0=dwtvalues[0][1], trace_pc0=dwtvalues[0][2], size0=dwtvalues[0][3],
-                                              trace_address1=dwtvalues[1][0], access_mode1=dwtvalues[1][1], trace_pc1=dwtvalues[1][2], size1=dwtvalues[1][3],
-                                              trace_address2=dwtvalues[2][0], access_mode2=dwtvalues[2][1], trace_pc2=dwtvalues[2][2], size2=dwtvalues[2][3],
-                                              trace_address3=dwtvalues[3][0], access_mode3=dwtvalues[3][1], trace_pc3=dwtvalues[3][2], size3=dwtvalues[3][3],
-                                              swo_speed=swospeed, cpu_speed=cpuspeed)
-                if not reset:
-                    flocklab.tg_reset(False)  # hold target in reset state
             else:
                 logger.warning("No configuration found for data trace service.")
         except:
-            flocklab.error_logandexit("Failed to configure data trace service (%s).\n%s" % (str(sys.exc_info()[1]), traceback.format_exc()))
+            flocklab.error_logandexit("Failed to parse data trace service config (%s).\n%s" % (str(sys.exc_info()[1]), traceback.format_exc()))
 
     logger.info("Starting SWO read (output file: %s, CPU speed: %s, SWO speed: %s)." % (filename, str(cpuspeed), str(swospeed)))
 
     # run process in background
-    daemon.daemonize(pidfile=pidfile, closedesc=True)
+    # note: the J-Link connection must be opened after daemonizing since all file descriptors are closed
+    # the calling process waits until the configuration is done and returns its status (the config function may release the target from reset)
+    statusread, statuswrite = os.pipe()
+    pid = os.fork()
+    if pid > 0:
+        os.close(statuswrite)
+        rs = wait_for_status(statusread)
+        os.waitpid(pid, 0)
+        if rs != flocklab.SUCCESS:
+            logger.error("Failed to configure data trace service (see %s for details)." % dwt.debuglogfile)
+        sys.exit(rs)
+    os.close(statusread)
+    daemon.daemonize(pidfile=pidfile, closedesc=True, keepfds=(statuswrite,))
 
     # note: 'logger' is not valid anymore at this point
 
@@ -258,8 +309,32 @@ def main(argv):
     signal.signal(signal.SIGTERM, sigterm_handler)
     signal.signal(signal.SIGINT, sigterm_handler)
 
+    # one J-Link session is used for the configuration and the SWO read
+    session = jlinksession.JLinkSession(device_name=flocklab.jlink_mcu_str(platform))
+
+    # apply DWT config
+    if dwtvalues:
+        try:
+            # if target is in reset state, it will be released by the config function below
+            reset = flocklab.gpio_get(flocklab.gpio_tg_nrst)
+            if dwt.config_dwt_for_data_trace(device_name=flocklab.jlink_mcu_str(platform), ts_prescaler=prescaler, comparators=dwtvalues,
+                                             swo_speed=swospeed, cpu_speed=cpuspeed, session=session) != flocklab.SUCCESS:
+                raise Exception("DWT configuration could not be verified")
+            if not reset:
+                flocklab.tg_reset(False)  # hold target in reset state
+        except:
+            dwt.log("Failed to configure data trace service (%s).\n%s" % (str(sys.exc_info()[1]), traceback.format_exc()))
+            report_status(statuswrite, flocklab.FAILED)
+            session.close()
+            if os.path.isfile(pidfile):
+                os.remove(pidfile)
+            sys.exit(flocklab.FAILED)
+
+    report_status(statuswrite, flocklab.SUCCESS)
+
     # Start SWO read
-    dwt.read_swo_buffer(device_name=flocklab.jlink_mcu_str(platform), loop_delay_in_ms=loopdelay, filename=filename, swo_speed=swospeed, cpu_speed=cpuspeed)
+    dwt.read_swo_buffer(device_name=flocklab.jlink_mcu_str(platform), loop_delay_in_ms=loopdelay, filename=filename, swo_speed=swospeed, cpu_speed=cpuspeed, session=session)
+    session.close()
 
     # Remove PID file
     if os.path.isfile(pidfile):
@@ -0,0 +1,292 @@
+#! /usr/bin/env python3
+
+"""
+Copyright (c) 2020, ETH Zurich, Computer Engineering Group
+All rights reserved.
+
+Redistribution and use in source and binary forms, with or without
+modification, are permitted provided that the following conditions are met:
+
+* Redistributions of source code must retain the above copyright notice, this
+  list of conditions and the following disclaimer.
+
+* Redistributions in binary form must reproduce the above copyright notice,
+  this list of conditions and the following disclaimer in the documentation
+  and/or other materials provided with the distribution.
+
+* Neither the name of the copyright holder nor the names of its
+  contributors may be used to endorse or promote products derived from
+  this software without specific prior written permission.
+
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+POSSIBILITY OF SUCH DAMAGE.
+
+"""
+
+import os, sys, time, errno, traceback, getopt, signal, socket, select, json
+import lib.flocklab as flocklab
+import lib.daemon as daemon
+import lib.powertrace as powertrace
+
+
+# globals
+debug        = False
+running      = True
+pidfile      = None
+sockfile     = None
+scriptname   = os.path.splitext(os.path.basename(__file__))[0]
+loopdelay    = 1.0       # update interval in seconds
+waittime     = 60        # max. time in seconds to wait for the power measurement to complete the data file
+
+
+##############################################################################
+#
+# Usage
+#
+##############################################################################
+def usage():
+    print("Usage: %s --input [--gpio] [--output] [--query] [--stop] [--debug] [--help]" % sys.argv[0])
+    print("Options:")
+    print("  --input=<string>\t\tpower measurement data file (.rld) of the RocketLogger, subsequent file segments (_p1, _p2, ...) are followed")
+    print("  --gpio=<string>\t\tOptional. GPIO tracing output (csv format) to account the energy per GPIO state.")
+    print("  --output=<string>\t\tOptional. Summary output filename (default: [input w/o extension].energy.json).")
+    print("  --query\t\t\tOptional. Print the statistics of the running instance.")
+    print("  --stop\t\t\tOptional. Causes the program to stop a possibly running instance of the energy monitor.")
+    print("  --debug\t\t\tOptional. Enable verbose logging.")
+    print("  --help\t\t\tOptional. Print this help.")
+### END usage()
+
+
+##############################################################################
+#
+# sigterm_handler
+#
+##############################################################################
+def sigterm_handler(signum, frame):
+    global running
+    running = False
+### END sigterm_handler()
+
+
+##############################################################################
+#
+# serve_stats - answers pending connections on the local socket with the
+#               current statistics (one JSON line), waits at most timeout
+#
+##############################################################################
+def serve_stats(sock, monitor, timeout):
+    rlist, _, _ = select.select([sock], [], [], timeout)
+    if not rlist:
+        return
+    conn, _ = sock.accept()
+    try:
+        conn.settimeout(1.0)
+        conn.sendall((json.dumps(monitor.get_stats()) + "\n").encode())
+    except socket.error:
+        pass
+    finally:
+        conn.close()
+### END serve_stats()
+
+
+##############################################################################
+#
+# energy_monitor - accounts the energy while the power is being measured
+#
+##############################################################################
+def energy_monitor(inputfile, gpiofile=None, outputfile=None):
+    logger  = flocklab.get_logger(debug=debug)
+    monitor = powertrace.EnergyMonitor(inputfile, gpiofile)
+    if not outputfile:
+        outputfile = os.path.splitext(inputfile)[0] + ".energy.json"
+    sock = None
+    try:
+        if os.path.exists(sockfile):
+            os.remove(sockfile)
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.bind(sockfile)
+        sock.listen(4)
+        while running:
+            monitor.update()
+            serve_stats(sock, monitor, loopdelay)
+        # stopped -> wait until the power measurement has completed the data file
+        timeout = waittime
+        while timeout > 0 and flocklab.get_pid('rocketlogger start') > 0:
+            monitor.update()
+            serve_stats(sock, monitor, loopdelay)
+            timeout = timeout - loopdelay
+        stats = monitor.finish()
+        with open(outputfile, "w") as f:
+            json.dump(stats, f, indent=2)
+        logger.debug("Energy summary written to %s (%.6f J in %.3f s, %d file segments)." % (outputfile, stats['energy'], stats['duration'], monitor.segment + 1))
+    except:
+        logger.error("Failed to monitor the energy: %s\n%s" % (str(sys.exc_info()[1]), traceback.format_exc()))
+        return flocklab.FAILED
+    finally:
+        if sock:
+            sock.close()
+        if os.path.exists(sockfile):
+            os.remove(sockfile)
+    return flocklab.SUCCESS
+### END energy_monitor()
+
+
+##############################################################################
+#
+# query_stats - prints the statistics of the running instance
+#
+##############################################################################
+def query_stats():
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.settimeout(loopdelay + 5)
+        sock.connect(sockfile)
+        data = b""
+        while True:
+            chunk = sock.recv(4096)
+            if not chunk:
+                break
+            data += chunk
+    except socket.error as err:
+        print("No energy monitor running (%s)." % str(err))
+        return errno.ENOPKG
+    finally:
+        sock.close()
+    print(json.dumps(json.loads(data.decode()), indent=2))
+    return flocklab.SUCCESS
+### END query_stats()
+
+
+##############################################################################
+#
+# stop_monitor
+#
+##############################################################################
+def stop_monitor(timeout=waittime + 10):
+    logger = flocklab.get_logger(debug=debug)
+    # take the first PID that isn't our PID
+    pid = 0
+    pids = flocklab.get_pids(scriptname)
+    for p in pids:
+        if p != os.getpid():
+            pid = p
+            break
+    if pid > 0:
+        logger.debug("Sending SIGTERM signal to energy monitor process %d..." % pid)
+        try:
+            os.kill(pid, signal.SIGTERM)
+            # wait until the summary has been written
+            while pid in flocklab.get_pids(scriptname) and timeout > 0:
+                time.sleep(1)
+                timeout = timeout - 1
+            if timeout <= 0:
+                logger.warning("Energy monitor process %d did not stop." % pid)
+                return flocklab.FAILED
+        except OSError:
+            # process probably didn't exist -> ignore error
+            logger.debug("Process %d does not exist." % pid)
+    else:
+        logger.debug("No daemon process found.")
+    return flocklab.SUCCESS
+### END stop_monitor()
+
+
+##############################################################################
+#
+# Main
+#
+##############################################################################
+def main(argv):
+    global pidfile
+    global sockfile
+    global debug
+
+    stop         = False
+    query        = False
+    inputfile    = None
+    gpiofile     = None
+    outputfile   = None
+
+    # Get config:
+    config = flocklab.get_config()
+    if not config:
+        flocklab.error_logandexit("Could not read configuration file.")
+
+    # Get command line parameters.
+    try:
+        opts, args = getopt.getopt(argv, "ehqi:g:o:", ["stop", "help", "query", "input=", "gpio=", "output=", "debug"])
+    except(getopt.GetoptError) as err:
+        flocklab.error_logandexit(str(err), errno.EINVAL)
+    for opt, arg in opts:
+        if opt in ("-h", "--help"):
+            usage()
+            sys.exit(flocklab.SUCCESS)
+        elif opt in ("-i", "--input"):
+            inputfile = arg
+        elif opt in ("-g", "--gpio"):
+            gpiofile = arg
+        elif opt in ("-o", "--output"):
+            outputfile = arg
+        elif opt in ("-q", "--query"):
+            query = True
+        elif opt in ("-e", "--stop"):
+            stop = True
+        elif opt in ("--debug"):
+            debug = True
+        else:
+            flocklab.error_logandexit("Unknown option '%s'." % (opt), errno.EINVAL)
+
+    pidfile  = "%s/%s.pid" % (config.get("observer", "pidfolder"), scriptname)
+    sockfile = "%s/%s.sock" % (config.get("observer", "pidfolder"), scriptname)
+
+    if stop:
+        sys.exit(stop_monitor())
+    if query:
+        sys.exit(query_stats())
+
+    # Check mandatory parameters:
+    if not inputfile:
+        flocklab.error_logandexit("No input file specified.", errno.EINVAL)
+
+    if len(flocklab.get_pids(scriptname)) > 1:
+        flocklab.error_logandexit("There is already an instance of %s running (PIDs: %s)." % (scriptname, str(flocklab.get_pids(scriptname))))
+
+    # Create daemon process
+    daemon.daemonize(pidfile=pidfile, closedesc=True)
+
+    signal.signal(signal.SIGTERM, sigterm_handler)
+    signal.signal(signal.SIGINT, sigterm_handler)
+
+    logger = flocklab.get_logger(debug=debug)
+    if not logger:
+        flocklab.error_logandexit("Could not get logger.")
+
+    logger.info("Starting energy monitor (input file: %s, GPIO tracing output: %s)." % (inputfile, str(gpiofile)))
+
+    rs = energy_monitor(inputfile, gpiofile, outputfile)
+    if rs != flocklab.SUCCESS:
+        logger.warning("Energy monitor stopped with code %d." % rs)
+    else:
+        logger.info("Energy monitor stopped.")
+
+    # Remove PID file
+    if os.path.isfile(pidfile):
+        os.remove(pidfile)
+
+### END main()
+
+
+if __name__ == "__main__":
+    try:
+        main(sys.argv[1:])
+    except Exception:
+        flocklab.error_logandexit("Encountered error: %s\n%s\nCommand line was: %s" % (str(sys.exc_info()[1]), traceback.format_exc(), " ".join(sys.argv)))
@@ -0,0 +1,226 @@
+#! /usr/bin/env python3
+
+"""
+Copyright (c) 2020, ETH Zurich, Computer Engineering Group
+All rights reserved.
+
+Redistribution and use in source and binary forms, with or without
+modification, are permitted provided that the following conditions are met:
+
+* Redistributions of source code must retain the above copyright notice, this
+  list of conditions and the following disclaimer.
+
+* Redistributions in binary form must reproduce the above copyright notice,
+  this list of conditions and the following disclaimer in the documentation
+  and/or other materials provided with the distribution.
+
+* Neither the name of the copyright holder nor the names of its
+  contributors may be used to endorse or promote products derived from
+  this software without specific prior written permission.
+
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+POSSIBILITY OF SUCH DAMAGE.
+
+"""
+
+import os, sys, time, errno, traceback, getopt, signal
+import lib.flocklab as flocklab
+import lib.daemon as daemon
+import lib.fllogic as fllogic
+import lib.gpiotrace as gpiotrace
+
+
+# globals
+debug        = False
+running      = True
+pidfile      = None
+scriptname   = os.path.splitext(os.path.basename(__file__))[0]
+loopdelay    = 1.0       # conversion interval in seconds
+waittime     = 60        # max. time in seconds to wait for the GPIO tracing service to complete the data file
+
+
+##############################################################################
+#
+# Usage
+#
+##############################################################################
+def usage():
+    print("Usage: %s --input [--output] [--format] [--stop] [--debug] [--help]" % sys.argv[0])
+    print("Options:")
+    print("  --input=<string>\t\traw tracing data file of the GPIO tracing service (fl_logic)")
+    print("  --output=<string>\t\tOptional. Output filename (default: [input].csv or [input].gpiotrace).")
+    print("  --format=<string>\t\tOptional. Output format, 'csv' (default) or 'columnar' (compressed, per pin).")
+    print("  --stop\t\t\tOptional. Causes the program to stop a possibly running instance of the GPIO converter.")
+    print("  --debug\t\t\tOptional. Enable verbose logging.")
+    print("  --help\t\t\tOptional. Print this help.")
+### END usage()
+
+
+##############################################################################
+#
+# sigterm_handler
+#
+##############################################################################
+def sigterm_handler(signum, frame):
+    global running
+    running = False
+### END sigterm_handler()
+
+
+##############################################################################
+#
+# gpio_converter - converts the tracing data while it is being recorded
+#
+##############################################################################
+def gpio_converter(inputfile, outputfile=None, outputformat='csv'):
+    logger    = flocklab.get_logger(debug=debug)
+    converter = fllogic.StreamConverter(inputfile, outputfile, logger=logger, output_format=outputformat)
+    try:
+        while running:
+            converter.update()
+            time.sleep(loopdelay)
+        # conversion stopped -> wait until the GPIO tracing service has completed the data file
+        timeout = waittime
+        while not converter.eof and timeout > 0 and flocklab.get_pid('fl_logic') > 0:
+            converter.update()
+            time.sleep(loopdelay)
+            timeout = timeout - loopdelay
+        if not converter.eof:
+            logger.warning("End of tracing data not found in %s." % inputfile)
+        num_lines = converter.finish()
+        logger.debug("%d lines written to %s." % (num_lines, converter.outputfile))
+    except:
+        logger.error("Failed to convert tracing data: %s\n%s" % (str(sys.exc_info()[1]), traceback.format_exc()))
+        return flocklab.FAILED
+    return flocklab.SUCCESS
+### END gpio_converter()
+
+
+##############################################################################
+#
+# stop_converter
+#
+##############################################################################
+def stop_converter(timeout=waittime + 10):
+    logger = flocklab.get_logger(debug=debug)
+    # take the first PID that isn't our PID
+    pid = 0
+    pids = flocklab.get_pids(scriptname)
+    for p in pids:
+        if p != os.getpid():
+            pid = p
+            break
+    if pid > 0:
+        logger.debug("Sending SIGTERM signal to GPIO converter process %d..." % pid)
+        try:
+            os.kill(pid, signal.SIGTERM)
+            # wait until the conversion is complete
+            while pid in flocklab.get_pids(scriptname) and timeout > 0:
+                time.sleep(1)
+                timeout = timeout - 1
+            if timeout <= 0:
+                logger.warning("GPIO converter process %d did not stop." % pid)
+                return flocklab.FAILED
+        except OSError:
+            # process probably didn't exist -> ignore error
+            logger.debug("Process %d does not exist." % pid)
+    else:
+        logger.debug("No daemon process found.")
+    return flocklab.SUCCESS
+### END stop_converter()
+
+
+##############################################################################
+#
+# Main
+#
+##############################################################################
+def main(argv):
+    global pidfile
+    global debug
+
+    stop         = False
+    inputfile    = None
+    outputfile   = None
+    outputformat = 'csv'
+
+    # Get config:
+    config = flocklab.get_config()
+    if not config:
+        flocklab.error_logandexit("Could not read configuration file.")
+
+    # Get command line parameters.
+    try:
+        opts, args = getopt.getopt(argv, "ehi:o:f:", ["stop", "help", "input=", "output=", "format=", "debug"])
+    except(getopt.GetoptError) as err:
+        flocklab.error_logandexit(str(err), errno.EINVAL)
+    for opt, arg in opts:
+        if opt in ("-h", "--help"):
+            usage()
+            sys.exit(flocklab.SUCCESS)
+        elif opt in ("-i", "--input"):
+            inputfile = arg
+        elif opt in ("-o", "--output"):
+            outputfile = arg
+        elif opt in ("-f", "--format"):
+            outputformat = arg.lower()
+            if outputformat not in gpiotrace.output_formats:
+                flocklab.error_logandexit("Invalid output format '%s'." % (arg), errno.EINVAL)
+        elif opt in ("-e", "--stop"):
+            stop = True
+        elif opt in ("--debug"):
+            debug = True
+        else:
+            flocklab.error_logandexit("Unknown option '%s'." % (opt), errno.EINVAL)
+
+    pidfile = "%s/%s.pid" % (config.get("observer", "pidfolder"), scriptname)
+
+    if stop:
+        sys.exit(stop_converter())
+
+    # Check mandatory parameters:
+    if not inputfile:
+        flocklab.error_logandexit("No input file specified.", errno.EINVAL)
+
+    if len(flocklab.get_pids(scriptname)) > 1:
+        flocklab.error_logandexit("There is already an instance of %s running (PIDs: %s)." % (scriptname, str(flocklab.get_pids(scriptname))))
+
+    # Create daemon process
+    daemon.daemonize(pidfile=pidfile, closedesc=True)
+
+    signal.signal(signal.SIGTERM, sigterm_handler)
+    signal.signal(signal.SIGINT, sigterm_handler)
+
+    logger = flocklab.get_logger(debug=debug)
+    if not logger:
+        flocklab.error_logandexit("Could not get logger.")
+
+    logger.info("Starting GPIO converter (input file: %s, output format: %s)." % (inputfile, outputformat))
+
+    rs = gpio_converter(inputfile, outputfile, outputformat)
+    if rs != flocklab.SUCCESS:
+        logger.warning("GPIO converter stopped with code %d." % rs)
+    else:
+        logger.info("GPIO converter stopped.")
+
+    # Remove PID file
+    if os.path.isfile(pidfile):
+        os.remove(pidfile)
+
+### END main()
+
+
+if __name__ == "__main__":
+    try:
+        main(sys.argv[1:])
+    except Exception:
+        flocklab.error_logandexit("Encountered error: %s\n%s\nCommand line was: %s" % (str(sys.exc_info()[1]), traceback.format_exc(), " ".join(sys.argv)))
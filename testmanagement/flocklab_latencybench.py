@@ -0,0 +1,309 @@
+#! /usr/bin/env python3
+
+"""
+Copyright (c) 2020, ETH Zurich, Computer Engineering Group
+All rights reserved.
+
+Redistribution and use in source and binary forms, with or without
+modification, are permitted provided that the following conditions are met:
+
+* Redistributions of source code must retain the above copyright notice, this
+  list of conditions and the following disclaimer.
+
+* Redistributions in binary form must reproduce the above copyright notice,
+  this list of conditions and the following disclaimer in the documentation
+  and/or other materials provided with the distribution.
+
+* Neither the name of the copyright holder nor the names of its
+  contributors may be used to endorse or promote products derived from
+  this software without specific prior written permission.
+
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+POSSIBILITY OF SUCH DAMAGE.
+
+"""
+
+import os, sys, time, errno, traceback, getopt, glob, json, threading
+import numpy as np
+import lib.flocklab as flocklab
+import lib.latency as latency
+
+
+# globals
+debug        = False
+count        = 200       # number of scheduled edges
+period       = 0.05      # average time between two edges in seconds
+leadtime     = 10        # time in seconds between the configuration of the services and the first edge
+waittime     = 5         # time in seconds to wait for the capture paths to complete their output
+
+
+##############################################################################
+#
+# Usage
+#
+##############################################################################
+def usage():
+    print("Usage: %s [--count] [--period] [--serial] [--baudrate] [--swo] [--image] [--platform] [--output] [--simulate] [--debug] [--help]" % sys.argv[0])
+    print("Measures the latency of the capture paths (GPIO tracing, serial, SWO) with a reference target image which echoes each")
+    print("edge of the SIG pins as a text line '<pin> <level>' (e.g. 'SIG1 1') over UART and SWO.")
+    print("Options:")
+    print("  --count=<int>\t\t\tOptional. Number of SIG pin edges (default: %d)." % count)
+    print("  --period=<float>\t\tOptional. Average time between two edges in seconds (default: %.3f)." % period)
+    print("  --serial=<string>\t\tOptional. Serial logging implementation: 'reader' (default), 'service' or 'none'.")
+    print("  --baudrate=<int>\t\tOptional. Baudrate of the serial port (default: 115200).")
+    print("  --swo\t\t\t\tOptional. Measure the latency of the SWO logger (requires --platform).")
+    print("  --image=<string>\t\tOptional. Reference target image to program (requires --platform).")
+    print("  --platform=<string>\t\tOptional. Target platform.")
+    print("  --output=<string>\t\tOptional. Output directory for the results (default: latencyfolder in the config).")
+    print("  --simulate\t\t\tOptional. Use simulated endpoints (pty and actuation device emulation) instead of the hardware.")
+    print("  --debug\t\t\tOptional. Enable verbose logging.")
+    print("  --help\t\t\tOptional. Print this help.")
+### END usage()
+
+
+##############################################################################
+#
+# serial_reader - reads lines from the serial port and writes them with a
+#                 timestamp into a csv file (same as the serial service:
+#                 the timestamp is taken after a complete line is read)
+#
+##############################################################################
+def serial_reader(fd, outputfile, stop_event):
+    with open(fd, "rb", buffering=0, closefd=False) as port, open(outputfile, "w") as f:
+        while not stop_event.is_set():
+            line = port.readline()
+            if line:
+                f.write("%.7f,%s\n" % (time.time(), line.decode(errors='replace').rstrip()))
+                f.flush()
+### END serial_reader()
+
+
+##############################################################################
+#
+# run_simulated - runs the measurement against simulated endpoints
+#
+##############################################################################
+def run_simulated(schedule, start_time, outdir, serial=True, swo=False):
+    gpiofile   = os.path.join(outdir, "gpio_monitor.csv")
+    serialfile = os.path.join(outdir, "serial.csv")
+    swofile    = os.path.join(outdir, "swo.csv") if swo else None
+    master, slave = os.openpty()
+    stop_event = threading.Event()
+    reader     = None
+    if serial:
+        reader = threading.Thread(target=serial_reader, args=(slave, serialfile, stop_event), daemon=True)
+        reader.start()
+    actuator = latency.SimulatedActuator(gpiofile, master if serial else None, swofile)
+    # same command string as written into the actuation device by start_gpio_actuation()
+    act_cmd  = ""
+    last     = 0
+    for cmd, offset in latency.get_act_events(schedule):
+        act_cmd += "%c%u " % (cmd, offset - last)
+        last     = offset
+    actuator.write(act_cmd + "S%u" % start_time)
+    if "OK" not in actuator.read():
+        flocklab.get_logger(debug=debug).error("Configuration of the simulated actuation failed.")
+        return None
+    actuator.join()
+    time.sleep(0.5)
+    stop_event.set()
+    os.write(master, b"\n")     # unblock the reader
+    if reader:
+        reader.join(waittime)
+    os.close(master)
+    os.close(slave)
+    return { 'gpio': gpiofile, 'serial': serialfile if serial else None, 'swo': swofile }
+### END run_simulated()
+
+
+##############################################################################
+#
+# run_hardware - runs the measurement with the actuation device, the GPIO
+#                tracing and the serial / SWO logging services
+#
+##############################################################################
+def run_hardware(schedule, start_time, outdir, serial='reader', baudrate=115200, swo=False, platform=None):
+    logger      = flocklab.get_logger(debug=debug)
+    stop_time   = start_time + int(schedule['time'][-1]) + 1 + waittime
+    tracingfile = os.path.join(outdir, "gpio_monitor")
+    serialfile  = os.path.join(outdir, "serial.csv")
+    swofile     = os.path.join(outdir, "swo.csv")
+    files       = { 'gpio': tracingfile + ".csv", 'serial': None, 'swo': None }
+    flocklab.tg_act_en()
+    try:
+        if swo:
+            flocklab.tg_mux_en(True)
+            if flocklab.start_swo_logger(platform, swofile, None, None, debug) != flocklab.SUCCESS:
+                raise Exception("Failed to start SWO logger.")
+            files['swo'] = swofile
+        if serial == 'reader':
+            if flocklab.start_serial_logging(flocklab.tg_serial_port, baudrate, serialfile, start_time, stop_time - start_time) != flocklab.SUCCESS:
+                raise Exception("Failed to start serial logging.")
+            files['serial'] = serialfile
+        elif serial == 'service':
+            if flocklab.start_serial_service(flocklab.tg_serial_port, baudrate, None, outdir, debug) != flocklab.SUCCESS:
+                raise Exception("Failed to start serial service.")
+        pins = flocklab.pin_abbr2num("SIG1") | flocklab.pin_abbr2num("SIG2")
+        if flocklab.start_gpio_tracing(tracingfile, start_time, stop_time, pins, 0, 0x00002000) != flocklab.SUCCESS:
+            raise Exception("Failed to start GPIO tracing.")
+        open(files['gpio'], 'a').close()
+        if flocklab.start_gpio_converter(tracingfile, None, debug, "csv") != flocklab.SUCCESS:
+            raise Exception("Failed to start GPIO converter.")
+        if flocklab.start_gpio_actuation(start_time, latency.get_act_events(schedule)) != flocklab.SUCCESS:
+            raise Exception("Failed to configure GPIO actuation.")
+        logger.debug("Services started, %d edges scheduled (start: %d, stop: %d)." % (len(schedule), start_time, stop_time))
+        while time.time() < stop_time:
+            time.sleep(1)
+    except:
+        logger.error(str(sys.exc_info()[1]))
+        files = None
+    finally:
+        flocklab.stop_gpio_actuation()
+        flocklab.stop_gpio_tracing()
+        flocklab.stop_gpio_converter()
+        if serial == 'reader':
+            flocklab.stop_serial_logging()
+        elif serial == 'service':
+            flocklab.stop_serial_service()
+        if swo:
+            flocklab.stop_swo_logger()
+    if files and serial == 'service':
+        files['serial'] = sorted(glob.glob(os.path.join(outdir, "serial_*.db")))
+    return files
+### END run_hardware()
+
+
+##############################################################################
+#
+# read_paths - reads the observed edges of each capture path
+#
+##############################################################################
+def read_paths(files):
+    paths = {}
+    if files['gpio'] and os.path.isfile(files['gpio']):
+        paths['gpio'] = latency.read_gpio_edges(files['gpio'])
+    if isinstance(files['serial'], list):
+        # output of the serial service (possibly split into several files)
+        if files['serial']:
+            paths['serial'] = np.concatenate([latency.read_echo_db(f) for f in files['serial']])
+    elif files['serial'] and os.path.isfile(files['serial']):
+        paths['serial'] = latency.read_echo_csv(files['serial'])
+    if files['swo'] and os.path.isfile(files['swo']):
+        paths['swo'] = latency.read_echo_csv(files['swo'])
+    return paths
+### END read_paths()
+
+
+##############################################################################
+#
+# Main
+#
+##############################################################################
+def main(argv):
+    global debug
+    global count
+    global period
+
+    serial     = 'reader'
+    baudrate   = 115200
+    swo        = False
+    image      = None
+    platform   = None
+    outputdir  = None
+    simulate   = False
+
+    # Get config:
+    config = flocklab.get_config()
+    if not config:
+        flocklab.error_logandexit("Could not read configuration file.")
+
+    # Get command line parameters.
+    try:
+        opts, args = getopt.getopt(argv, "hc:p:s:b:wi:t:o:m", ["help", "count=", "period=", "serial=", "baudrate=", "swo", "image=", "platform=", "output=", "simulate", "debug"])
+    except(getopt.GetoptError) as err:
+        flocklab.error_logandexit(str(err), errno.EINVAL)
+    for opt, arg in opts:
+        if opt in ("-h", "--help"):
+            usage()
+            sys.exit(flocklab.SUCCESS)
+        elif opt in ("-c", "--count"):
+            count = flocklab.parse_int(arg)
+        elif opt in ("-p", "--period"):
+            period = flocklab.parse_float(arg)
+        elif opt in ("-s", "--serial"):
+            serial = arg.lower()
+            if serial not in ('reader', 'service', 'none'):
+                flocklab.error_logandexit("Invalid serial logging implementation '%s'." % (arg), errno.EINVAL)
+        elif opt in ("-b", "--baudrate"):
+            baudrate = flocklab.parse_int(arg)
+            if baudrate not in flocklab.tg_baud_rates:
+                flocklab.error_logandexit("Invalid baudrate %s." % (arg), errno.EINVAL)
+        elif opt in ("-w", "--swo"):
+            swo = True
+        elif opt in ("-i", "--image"):
+            image = arg
+        elif opt in ("-t", "--platform"):
+            platform = arg.lower()
+        elif opt in ("-o", "--output"):
+            outputdir = arg
+        elif opt in ("-m", "--simulate"):
+            simulate = True
+        elif opt in ("--debug"):
+            debug = True
+        else:
+            flocklab.error_logandexit("Unknown option '%s'." % (opt), errno.EINVAL)
+
+    if count < 2 or count * 2 > flocklab.max_act_events or period <= 0:
+        flocklab.error_logandexit("Invalid number of edges or period.", errno.EINVAL)
+    if (swo or image) and not simulate and platform not in flocklab.tg_platforms:
+        flocklab.error_logandexit("A valid platform is required for the SWO logger and to program the target.", errno.EINVAL)
+    if not outputdir:
+        outputdir = config.get("observer", "latencyfolder")
+
+    logger = flocklab.get_logger(debug=debug)
+    if not logger:
+        flocklab.error_logandexit("Could not get logger.")
+
+    # the raw output of the capture paths is kept next to the results
+    rawdir = os.path.join(outputdir, time.strftime("%Y%m%d%H%M%S", time.gmtime()))
+    os.makedirs(rawdir, exist_ok=True)
+
+    schedule   = latency.generate_schedule(count, period)
+    if simulate:
+        start_time = int(time.time()) + 1
+        files      = run_simulated(schedule, start_time, rawdir, serial != 'none', swo)
+    else:
+        if image:
+            if flocklab.program_target(image, platform, 0, debug) != flocklab.SUCCESS:
+                flocklab.error_logandexit("Failed to program the target image.")
+        flocklab.tg_reset()
+        start_time = int(time.time()) + leadtime
+        files      = run_hardware(schedule, start_time, rawdir, serial, baudrate, swo, platform)
+    if not files:
+        flocklab.error_logandexit("Latency measurement failed.")
+
+    schedule['time'] += start_time
+    results = latency.analyze(schedule, read_paths(files))
+    results.update({ 'simulated': simulate, 'period': period, 'serial': serial, 'baudrate': baudrate, 'platform': platform, 'rawdata': rawdir })
+    resultfile = latency.store_results(results, outputdir)
+    logger.info("Latency measurement results written to %s." % resultfile)
+    print(json.dumps(results['paths'], indent=2))
+    print("Suggested correction constants: %s" % json.dumps(results['corrections']))
+    sys.exit(flocklab.SUCCESS)
+### END main()
+
+
+if __name__ == "__main__":
+    try:
+        main(sys.argv[1:])
+    except Exception:
+        flocklab.error_logandexit("Encountered error: %s\n%s\nCommand line was: %s" % (str(sys.exc_info()[1]), traceback.format_exc(), " ".join(sys.argv)))
@@ -0,0 +1,236 @@
+#! /usr/bin/env python3
+
+"""
+Copyright (c) 2020, ETH Zurich, Computer Engineering Group
+All rights reserved.
+
+Redistribution and use in source and binary forms, with or without
+modification, are permitted provided that the following conditions are met:
+
+* Redistributions of source code must retain the above copyright notice, this
+  list of conditions and the following disclaimer.
+
+* Redistributions in binary form must reproduce the above copyright notice,
+  this list of conditions and the following disclaimer in the documentation
+  and/or other materials provided with the distribution.
+
+* Neither the name of the copyright holder nor the names of its
+  contributors may be used to endorse or promote products derived from
+  this software without specific prior written permission.
+
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+POSSIBILITY OF SUCH DAMAGE.
+
+"""
+
+import os, sys, time, errno, traceback, getopt, signal, json
+import lib.flocklab as flocklab
+import lib.daemon as daemon
+
+
+# globals
+debug        = False
+running      = True
+pidfile      = None
+scriptname   = os.path.splitext(os.path.basename(__file__))[0]
+loopdelay    = 0.1       # polling interval in seconds
+stoptimeout  = 10        # max. time in seconds to wait for the scheduler to stop
+
+
+##############################################################################
+#
+# Usage
+#
+##############################################################################
+def usage():
+    print("Usage: %s --input [--stop] [--debug] [--help]" % sys.argv[0])
+    print("Options:")
+    print("  --input=<string>\t\tpower measurement plan (json) with the list of capture windows")
+    print("  --stop\t\t\tOptional. Causes the program to stop a possibly running instance of the power scheduler.")
+    print("  --debug\t\t\tOptional. Enable verbose logging.")
+    print("  --help\t\t\tOptional. Print this help.")
+### END usage()
+
+
+##############################################################################
+#
+# sigterm_handler
+#
+##############################################################################
+def sigterm_handler(signum, frame):
+    global running
+    running = False
+### END sigterm_handler()
+
+
+##############################################################################
+#
+# wait_until - sleeps until the given UNIX timestamp, returns False if stopped
+#
+##############################################################################
+def wait_until(timestamp, condition=None):
+    while running and time.time() < timestamp:
+        if condition and not condition():
+            break
+        time.sleep(loopdelay)
+    return running
+### END wait_until()
+
+
+##############################################################################
+#
+# run_schedule - starts the RocketLogger for each capture window
+#
+##############################################################################
+def run_schedule(plan):
+    logger = flocklab.get_logger(debug=debug)
+    rlbusy = lambda: flocklab.get_pid('rocketlogger start') > 0
+    for window in plan['windows']:
+        # skip windows which are already over
+        if window['start'] + window['samples'] / plan['rate'] < time.time():
+            logger.warning("Power capture window at %d skipped (already over)." % window['start'])
+            continue
+        if not wait_until(window['start'] - flocklab.rl_window_lead):
+            break
+        # the previous measurement should be done by now
+        if not wait_until(window['start'], rlbusy):
+            break
+        if rlbusy():
+            logger.warning("RocketLogger still busy, power capture window at %d skipped." % window['start'])
+            continue
+        # the scheduler may have been stopped while checking the RocketLogger
+        if not running:
+            break
+        rs = flocklab.start_pwr_measurement(out_file=window['output'], sampling_rate=plan['rate'], num_samples=window['samples'], start_time=window['start'], aggregation=plan['aggregation'], file_size=plan['file_size'])
+        if rs != flocklab.SUCCESS:
+            logger.error("Failed to start power measurement for capture window at %d." % window['start'])
+        else:
+            logger.debug("Power measurement will start at %d (output: %s, samples: %d)." % (window['start'], window['output'], window['samples']))
+    return flocklab.SUCCESS
+### END run_schedule()
+
+
+##############################################################################
+#
+# stop_scheduler
+#
+##############################################################################
+def stop_scheduler(timeout=stoptimeout):
+    logger = flocklab.get_logger(debug=debug)
+    # take the first PID that isn't our PID
+    pid = 0
+    pids = flocklab.get_pids(scriptname)
+    for p in pids:
+        if p != os.getpid():
+            pid = p
+            break
+    if pid > 0:
+        logger.debug("Sending SIGTERM signal to power scheduler process %d..." % pid)
+        try:
+            os.kill(pid, signal.SIGTERM)
+            # wait until the process has terminated, otherwise it may still start a measurement
+            while pid in flocklab.get_pids(scriptname) and timeout > 0:
+                time.sleep(1)
+                timeout = timeout - 1
+            if timeout <= 0:
+                logger.warning("Power scheduler process %d did not stop." % pid)
+                return flocklab.FAILED
+        except OSError:
+            # process probably didn't exist -> ignore error
+            logger.debug("Process %d does not exist." % pid)
+    else:
+        logger.debug("No daemon process found.")
+    return flocklab.SUCCESS
+### END stop_scheduler()
+
+
+##############################################################################
+#
+# Main
+#
+##############################################################################
+def main(argv):
+    global pidfile
+    global debug
+
+    stop         = False
+    inputfile    = None
+
+    # Get config:
+    config = flocklab.get_config()
+    if not config:
+        flocklab.error_logandexit("Could not read configuration file.")
+
+    # Get command line parameters.
+    try:
+        opts, args = getopt.getopt(argv, "ehi:", ["stop", "help", "input=", "debug"])
+    except(getopt.GetoptError) as err:
+        flocklab.error_logandexit(str(err), errno.EINVAL)
+    for opt, arg in opts:
+        if opt in ("-h", "--help"):
+            usage()
+            sys.exit(flocklab.SUCCESS)
+        elif opt in ("-i", "--input"):
+            inputfile = arg
+        elif opt in ("-e", "--stop"):
+            stop = True
+        elif opt in ("--debug"):
+            debug = True
+        else:
+            flocklab.error_logandexit("Unknown option '%s'." % (opt), errno.EINVAL)
+
+    pidfile = "%s/%s.pid" % (config.get("observer", "pidfolder"), scriptname)
+
+    if stop:
+        sys.exit(stop_scheduler())
+
+    # Check mandatory parameters:
+    if not inputfile or not os.path.isfile(inputfile):
+        flocklab.error_logandexit("No valid input file specified.", errno.EINVAL)
+    with open(inputfile, "r") as f:
+        plan = json.load(f)
+    if not plan.get('windows'):
+        flocklab.error_logandexit("No capture windows found in %s." % inputfile, errno.EINVAL)
+
+    if len(flocklab.get_pids(scriptname)) > 1:
+        flocklab.error_logandexit("There is already an instance of %s running (PIDs: %s)." % (scriptname, str(flocklab.get_pids(scriptname))))
+
+    # Create daemon process
+    daemon.daemonize(pidfile=pidfile, closedesc=True)
+
+    signal.signal(signal.SIGTERM, sigterm_handler)
+    signal.signal(signal.SIGINT, sigterm_handler)
+
+    logger = flocklab.get_logger(debug=debug)
+    if not logger:
+        flocklab.error_logandexit("Could not get logger.")
+
+    logger.info("Starting power scheduler (%d capture windows)." % len(plan['windows']))
+
+    rs = run_schedule(plan)
+    if rs != flocklab.SUCCESS:
+        logger.warning("Power scheduler stopped with code %d." % rs)
+    else:
+        logger.info("Power scheduler stopped.")
+
+    # Remove PID file
+    if os.path.isfile(pidfile):
+        os.remove(pidfile)
+
+### END main()
+
+
+if __name__ == "__main__":
+    try:
+        main(sys.argv[1:])
+    except Exception:
+        flocklab.error_logandexit("Encountered error: %s\n%s\nCommand line was: %s" % (str(sys.exc_info()[1]), traceback.format_exc(), " ".join(sys.argv)))
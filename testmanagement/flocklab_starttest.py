@@ -33,7 +33,7 @@ POSSIBILITY OF SUCH DAMAGE.
 Author: Reto Da Forno
 """
 
-import os, sys, subprocess, getopt, errno, tempfile, time, shutil, serial, xml.etree.ElementTree, traceback
+import os, sys, subprocess, getopt, errno, tempfile, time, shutil, serial, xml.etree.ElementTree, traceback, json
 import lib.flocklab as flocklab
 
 
@@ -146,6 +146,10 @@ def main(argv):
     powerprofilingused  = tree.find('obsPowerprofConf') != None
     teststarttime       = 0
 
+    # make sure the timesync monitor is running (caches the time sync status)
+    if flocklab.start_timesync_monitor(debug) != flocklab.SUCCESS:
+        logger.warning("Failed to start timesync monitor.")
+
     if flocklab.get_timesync_method() == "PTP":
         ptpsynced = True
 
@@ -195,7 +199,10 @@ def main(argv):
         flocklab.stop_swo_logger()
         flocklab.stop_gpio_actuation()
         flocklab.stop_gpio_tracing()
+        flocklab.stop_gpio_converter()
+        flocklab.stop_pwr_scheduler()
         flocklab.stop_pwr_measurement()
+        flocklab.stop_energy_monitor()
         flocklab.stop_gdb_server()
         flocklab.stop_data_trace()
 
@@ -255,6 +262,7 @@ def main(argv):
         pinconfs   = list(subtree.getiterator("pinConf"))
         resets     = []
         act_events = []
+        act_pins   = []     # user actuations as (pin, offset), used to derive power capture windows
         for pinconf in pinconfs:
             pin = pinconf.find('pin').text
             if pin == 'RST':
@@ -271,8 +279,10 @@ def main(argv):
                 periodic_evts = flocklab.generate_periodic_act_events(pin, flocklab.parse_float(pinconf.find('offset').text), float(pinconf.findtext('period')), 0.5, count)
                 if periodic_evts:
                     act_events.extend(periodic_evts)
+                    act_pins.extend([(pin, evt[1] / 1000000.0) for evt in periodic_evts])
             else:
                 act_events.append([cmd, microsecs])
+                act_pins.append((pin, microsecs / 1000000.0))
         # determine test start
         try:
             teststarttime = flocklab.parse_int(resets[0])   # 1st reset actuation is the reset release = start of test
@@ -410,10 +420,27 @@ def main(argv):
         if "swo" in serialport:
             # logging via SWO pin
             cpuspeed = tree.findtext('obsSerialConf/cpuSpeed')
+            # optional: ITM stimulus ports with text / binary output (bitmasks)
+            textports = None
+            binports  = None
+            try:
+                if tree.find('obsSerialConf/swoTextPorts') != None:
+                    textports = int(tree.findtext('obsSerialConf/swoTextPorts').strip(), 0)
+                if tree.find('obsSerialConf/swoBinaryPorts') != None:
+                    binports = int(tree.findtext('obsSerialConf/swoBinaryPorts').strip(), 0)
+            except (ValueError, AttributeError):
+                msg = "Invalid SWO port configuration, using the default ports."
+                if abortonerror:
+                    flocklab.tg_off()
+                    flocklab.error_logandexit(msg)
+                else:
+                    flocklab.log_test_error(testid, msg)
+                textports = None
+                binports  = None
             # MUX must be enabled and target released from reset state
             flocklab.tg_mux_en(True)
             flocklab.tg_reset()
-            if flocklab.start_swo_logger(platform, serialfile, cpuspeed, None, True) != flocklab.SUCCESS:
+            if flocklab.start_swo_logger(platform, serialfile, cpuspeed, None, True, textports, binports) != flocklab.SUCCESS:
                 msg = "Failed to start SWO serial logger."
                 if abortonerror:
                     flocklab.tg_off()
@@ -460,6 +487,11 @@ def main(argv):
             offset = flocklab.parse_int(offset)
         else:
             offset = 1  # default offset of 1 second to avoid tracing of the erratic toggling at MCU startup
+        outputformat = subtree.findtext("format")
+        if outputformat:
+            outputformat = outputformat.strip().lower()
+        if outputformat not in ("csv", "columnar"):
+            outputformat = "csv"    # default: one text line per edge
         # if GPIO actuation service is used, then also trace the SIG pins
         if actuationused:
             pins = pins | flocklab.pin_abbr2num("SIG1") | flocklab.pin_abbr2num("SIG2")
@@ -471,6 +503,7 @@ def main(argv):
         if resetactuationused:
             extra_options = extra_options | 0x00000002    # do not control the reset pin with the PRU
             logger.debug("Target reset actuations scheduled, won't control reset pin with PRU.")
+        extra_options = extra_options | 0x00002000        # do not parse the tracing data, it is converted by the GPIO converter while the test is running
         if flocklab.start_gpio_tracing(tracingfile, teststarttime, teststoptime, pins, offset, extra_options) != flocklab.SUCCESS:
             msg = "Failed to start GPIO tracing service."
             if abortonerror:
@@ -478,9 +511,17 @@ def main(argv):
                 flocklab.error_logandexit(msg)
             else:
                 flocklab.log_test_error(testid, msg)
-        # touch the file
-        open(tracingfile + ".csv", 'a').close()
-        logger.debug("Started GPIO tracing (output file: %s, pins: 0x%x, offset: %u, options: 0x%x)." % (tracingfile, pins, offset, extra_options))
+        if outputformat == "csv":
+            # touch the file
+            open(tracingfile + ".csv", 'a').close()
+        if flocklab.start_gpio_converter(tracingfile, None, debug, outputformat) != flocklab.SUCCESS:
+            msg = "Failed to start GPIO converter."
+            if abortonerror:
+                flocklab.tg_off()
+                flocklab.error_logandexit(msg)
+            else:
+                flocklab.log_test_error(testid, msg)
+        logger.debug("Started GPIO tracing (output file: %s, pins: 0x%x, offset: %u, options: 0x%x, format: %s)." % (tracingfile, pins, offset, extra_options, outputformat))
 
     # Power profiling ---
     if powerprofilingused:
@@ -495,21 +536,67 @@ def main(argv):
         samplingrate = flocklab.parse_int(tree.findtext('obsPowerprofConf/samplingRate'))
         if samplingrate == 0:
             samplingrate = flocklab.rl_default_rate
-        # Start profiling
+        # Capture windows (optional): listed explicitly and/or around the actuations of the given pins, offsets are relative to the test start
+        windows = None
+        subtree = tree.find('obsPowerprofConf/windows')
+        if subtree != None:
+            margin    = flocklab.parse_float(subtree.findtext('margin', default="0.001"))
+            intervals = []
+            for window in subtree.findall('window'):
+                offset = teststarttime + flocklab.parse_float(window.findtext('offset'))
+                intervals.append([offset, offset + flocklab.parse_float(window.findtext('duration'))])
+            actpins = subtree.findtext('actuation')
+            if actpins != None:
+                actpins = actpins.split()
+                intervals.extend([[teststarttime + offset, teststarttime + offset] for pin, offset in act_pins if (not actpins) or (pin in actpins)])
+            # only capture within the configured power profiling period
+            windows = flocklab.get_pwr_capture_windows([[max(t1, starttime), min(t2, starttime + duration)] for t1, t2 in intervals if t2 >= starttime and t1 <= starttime + duration], margin)
+            if not windows:
+                flocklab.log_test_error(testid, "Power profiling: no capture windows within the profiling period.")
+            duration = sum([int(window[1]) + 1 for window in windows])
+        # Plan the measurement (sampling rate, aggregation and file segmentation) and store the plan with the results
         outputfile = "%s/%d/powerprofiling_%s.rld" % (config.get("observer", "testresultfolder"), testid, time.strftime("%Y%m%d%H%M%S", time.gmtime()))
-        if flocklab.start_pwr_measurement(out_file=outputfile, sampling_rate=samplingrate, start_time=starttime, num_samples=int((duration + 1) * samplingrate)) != flocklab.SUCCESS:
-            msg = "Failed to start power measurement."
-            if abortonerror:
-                flocklab.tg_off()
-                flocklab.error_logandexit(msg)
-            else:
-                flocklab.log_test_error(testid, msg)
-        logger.debug("Power measurement will start at %s (output: %s, sampling rate: %dHz, duration: %ds)." % (str(starttime), outputfile, samplingrate, duration))
+        planfile   = os.path.splitext(outputfile)[0] + ".plan.json"
+        plan = flocklab.plan_pwr_measurement(duration, samplingrate, os.path.dirname(outputfile))
+        samplingrate = plan['rate']
+        if windows != None:
+            plan['windows'] = [{ 'start': tstart, 'samples': int(length * samplingrate) + 1, 'output': "%s_w%d.rld" % (os.path.splitext(outputfile)[0], i) } for i, (tstart, length) in enumerate(windows)]
+        with open(planfile, "w") as f:
+            json.dump(plan, f, indent=2)
+        for note in plan['notes']:
+            flocklab.log_test_error(testid, "Power profiling: %s." % note)
+        if windows != None:
+            # Start the capture window schedule
+            if windows and flocklab.start_pwr_scheduler(planfile, debug) != flocklab.SUCCESS:
+                msg = "Failed to start power scheduler."
+                if abortonerror:
+                    flocklab.tg_off()
+                    flocklab.error_logandexit(msg)
+                else:
+                    flocklab.log_test_error(testid, msg)
+            logger.debug("Power measurement scheduled in %d capture windows (sampling rate: %dHz, total duration: %ds)." % (len(windows), samplingrate, duration))
+        else:
+            # Start profiling
+            if flocklab.start_pwr_measurement(out_file=outputfile, sampling_rate=samplingrate, start_time=starttime, num_samples=plan['num_samples'], aggregation=plan['aggregation'], file_size=plan['file_size']) != flocklab.SUCCESS:
+                msg = "Failed to start power measurement."
+                if abortonerror:
+                    flocklab.tg_off()
+                    flocklab.error_logandexit(msg)
+                else:
+                    flocklab.log_test_error(testid, msg)
+            logger.debug("Power measurement will start at %s (output: %s, sampling rate: %dHz, duration: %ds)." % (str(starttime), outputfile, samplingrate, duration))
+            # Start the energy accounting (per GPIO state if the GPIO tracing output is available as csv)
+            gpiofile = None
+            if tracingserviceused and outputformat == "csv":
+                gpiofile = tracingfile + ".csv"
+            if flocklab.start_energy_monitor(outputfile, gpiofile, debug) != flocklab.SUCCESS:
+                flocklab.log_test_error(testid, "Failed to start energy monitor.")
 
     # Timesync log ---
     try:
         flocklab.log_timesync_info(testid=testid)
         flocklab.store_pps_count(testid)
+        flocklab.start_timesync_log(testid)
     except:
         msg = "Failed to collect timesync info (%s, %s)." % (str(sys.exc_info()[0]), str(sys.exc_info()[1]))
         if abortonerror:
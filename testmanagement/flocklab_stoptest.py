@@ -33,8 +33,11 @@ POSSIBILITY OF SUCH DAMAGE.
 Author: Reto Da Forno
 """
 
-import os, sys, getopt, errno, subprocess, serial, time, configparser, shutil, xml.etree.ElementTree, traceback, datetime
+import os, sys, getopt, errno, subprocess, serial, time, configparser, shutil, xml.etree.ElementTree, traceback, datetime, glob
 import lib.flocklab as flocklab
+import lib.swo as swo
+import lib.powertrace as powertrace
+import lib.timecorrection as timecorrection
 
 
 flashdefaultimage = False
@@ -55,6 +58,56 @@ def usage():
 ### END usage()
 
 
+##############################################################################
+#
+# read_log_tail - returns the (timestamp, level, message) tuples of all lines
+#                 in a log file which are not older than starttime (in
+#                 chronological order); the file is read backwards and the
+#                 reading stops at the first line older than starttime
+#
+##############################################################################
+def read_log_tail(filename, starttime=0, blocksize=65536):
+    memo    = {}        # timestamp string -> UNIX timestamp (log has a resolution of 1s)
+    entries = []
+
+    def parse_line(line):
+        try:
+            (timestamp, level, msg) = line.decode(errors='replace').split("\t", 2)
+            t = memo.get(timestamp)
+            if t is None:
+                t = time.mktime(datetime.datetime.strptime(timestamp, "%Y-%m-%d %H:%M:%S").timetuple())   # convert to UNIX timestamp
+                memo[timestamp] = t
+            return (t, level, msg)
+        except ValueError:
+            return None     # probably invalid line / empty line
+
+    with open(filename, 'rb') as f:
+        pos  = f.seek(0, os.SEEK_END)
+        rest = b""          # first (possibly incomplete) line of the previous block
+        done = False
+        while pos > 0 and not done:
+            readsize = min(blocksize, pos)
+            pos     -= readsize
+            f.seek(pos)
+            lines = (f.read(readsize) + rest).split(b"\n")
+            rest  = lines.pop(0)
+            for line in reversed(lines):
+                entry = parse_line(line)
+                if not entry:
+                    continue
+                if entry[0] < starttime:
+                    done = True
+                    break
+                entries.append(entry)
+        if not done:
+            entry = parse_line(rest)
+            if entry and entry[0] >= starttime:
+                entries.append(entry)
+    entries.reverse()
+    return entries
+### END read_log_tail()
+
+
 ##############################################################################
 #
 # collect_error_logs
@@ -70,31 +123,15 @@ def collect_error_logs(testid=None, starttime=0):
     errorlog = open(errorlogfile, 'a')
     if os.path.isfile(flocklab.tracinglog):
         flocklab.logger.debug("Log file %s found." % flocklab.tracinglog)
-        with open(flocklab.tracinglog) as logfile:
-            lines = logfile.read().split("\n")
-            for line in lines:
-                try:
-                    (timestamp, level, msg) = line.split("\t", 2)
-                    t = time.mktime(datetime.datetime.strptime(timestamp, "%Y-%m-%d %H:%M:%S").timetuple())   # convert to UNIX timestamp
-                    if t >= starttime:
-                        errorlog.write("%s,GPIO tracing error: %s\n" % (t, msg))
-                except ValueError:
-                    continue        # probably invalid line / empty line
+        for (t, level, msg) in read_log_tail(flocklab.tracinglog, starttime):
+            errorlog.write("%s,GPIO tracing error: %s\n" % (t, msg))
 
     # collect RL error log
     if os.path.isfile(flocklab.rllog):
         flocklab.logger.debug("Log file %s found." % flocklab.rllog)
-        with open(flocklab.rllog) as logfile:
-            lines = logfile.read().split("\n")
-            for line in lines:
-                try:
-                    (timestamp, level, msg) = line.split("\t", 2)
-                    if level in ("ERROR", "WARN"):
-                        t = time.mktime(datetime.datetime.strptime(timestamp, "%Y-%m-%d %H:%M:%S").timetuple())   # convert to UNIX timestamp
-                        if t >= starttime:
-                            errorlog.write("%s,RocketLogger error: %s\n" % (t, msg))
-                except ValueError:
-                    continue        # probably invalid line / empty line
+        for (t, level, msg) in read_log_tail(flocklab.rllog, starttime):
+            if level in ("ERROR", "WARN"):
+                errorlog.write("%s,RocketLogger error: %s\n" % (t, msg))
 
     errorlog.close()
 ### END collect_error_messages()
@@ -156,6 +193,8 @@ def main(argv):
     platform = None
     teststarttime = 0
     imagepath = []
+    serialport = None
+    baudrate = None
     if not xmlfile:
         xmlfile = "%s/%d/config.xml" % (config.get("observer", "testconfigfolder"), testid)
     try:
@@ -172,6 +211,10 @@ def main(argv):
                 imagepath.append(img.text)
         else:
             errors.append("Could not find element <obsTargetConf> in %s" % xmlfile)
+        # serial config (for the timestamp correction)
+        if tree.find('obsSerialConf') != None:
+            serialport = (tree.findtext('obsSerialConf/port') or flocklab.get_default_serialport(platform)).lower()
+            baudrate   = flocklab.parse_int(tree.findtext('obsSerialConf/baudrate'))
         # extract start time
         subtree  = tree.find('obsGpioSettingConf')
         pinconfs = list(subtree.getiterator("pinConf"))
@@ -204,10 +247,16 @@ def main(argv):
         errors.append("Failed to stop SWO serial logger.")
     if flocklab.stop_gpio_tracing() != flocklab.SUCCESS:
         errors.append("Failed to stop GPIO tracing service.")
+    if flocklab.stop_gpio_converter() != flocklab.SUCCESS:
+        errors.append("Failed to stop GPIO converter.")
     if flocklab.stop_gpio_actuation() != flocklab.SUCCESS:
         errors.append("Failed to stop GPIO actuation service.")
+    if flocklab.stop_pwr_scheduler() != flocklab.SUCCESS:
+        errors.append("Failed to stop power scheduler.")
     if flocklab.stop_pwr_measurement() != flocklab.SUCCESS:
         errors.append("Failed to stop power measurement.")
+    if flocklab.stop_energy_monitor() != flocklab.SUCCESS:
+        errors.append("Failed to stop energy monitor.")
     if flocklab.stop_gdb_server() != flocklab.SUCCESS:
         errors.append("Failed to stop debug service.")
     if flocklab.stop_data_trace() != flocklab.SUCCESS:
@@ -224,6 +273,7 @@ def main(argv):
             flocklab.log_timesync_info(testid=testid, includepps=True)
         else:
             flocklab.log_timesync_info(testid=testid, includepps=False)
+        flocklab.stop_timesync_log()
     except:
         errors.append("An error occurred while collecting timesync info: %s, %s" % (str(sys.exc_info()[0]), str(sys.exc_info()[1])))
 
@@ -233,6 +283,33 @@ def main(argv):
     except:
         errors.append("An error occurred while collecting error logs: %s, %s" % (str(sys.exc_info()[0]), str(sys.exc_info()[1])))
 
+    # align the timestamps of all outputs (latency of the capture path and clock offset) ---
+    try:
+        result = timecorrection.correct_results("%s/%d" % (config.get("observer", "testresultfolder"), testid), serialport, baudrate)
+        if result:
+            logger.debug("Timestamps of %d files corrected (%d clock samples)." % (len(result['files']), result['clock_samples']))
+    except:
+        errors.append("An error occurred while correcting the timestamps: %s, %s" % (str(sys.exc_info()[0]), str(sys.exc_info()[1])))
+
+    # convert data trace output (binary SWO frames) into the legacy text format ---
+    try:
+        for datatracefile in glob.glob("%s/%d/datatrace_*.log" % (config.get("observer", "testresultfolder"), testid)):
+            if swo.bin_to_text(datatracefile):
+                logger.debug("Data trace file %s converted to text format." % datatracefile)
+    except:
+        errors.append("An error occurred while converting the data trace output: %s, %s" % (str(sys.exc_info()[0]), str(sys.exc_info()[1])))
+
+    # compute the min/mean/max pyramids of the power profiling data ---
+    try:
+        for rldfile in glob.glob("%s/%d/powerprofiling_*.rld" % (config.get("observer", "testresultfolder"), testid)):
+            if powertrace.is_rld_segment(rldfile):
+                continue    # included in the pyramid of the first file segment
+            pyramidfile = powertrace.build_pyramid(rldfile)
+            if pyramidfile:
+                logger.debug("Power profiling pyramid written to %s." % pyramidfile)
+    except:
+        errors.append("An error occurred while processing the power profiling data: %s, %s" % (str(sys.exc_info()[0]), str(sys.exc_info()[1])))
+
     # Flash target with default image ---
     if flashdefaultimage:
         if platform:
@@ -33,18 +33,23 @@ POSSIBILITY OF SUCH DAMAGE.
 Author: Reto Da Forno
 """
 
-import os, sys, time, errno, traceback, getopt, subprocess, signal
+import os, sys, time, errno, traceback, getopt, signal
 import lib.flocklab as flocklab
 import lib.daemon as daemon
+import lib.jlinksession as jlinksession
+import lib.itm as itm
+import lib.swo as swo
 
 
 # globals
 debug        = False
 running      = True
 pidfile      = None
-jlinkswopath = '/opt/jlink/JLinkSWOViewerCLExe'
 scriptname   = os.path.splitext(os.path.basename(__file__))[0]
-waitfor      = "-----------------------------------------------"
+loopdelay    = 0.01      # SWO read loop delay in seconds
+flushdelay   = 1.0       # max. time in seconds before the output is written to the file
+textports    = 0x1       # ITM stimulus ports with text output (line-assembled)
+binports     = 0x0       # ITM stimulus ports with binary output (length-framed)
 
 
 ##############################################################################
@@ -53,12 +58,14 @@ waitfor      = "-----------------------------------------------"
 #
 ##############################################################################
 def usage():
-    print("Usage: %s --output --platform [--cpuspeed] [--swospeed] [--stop] [--debug] [--help]" % sys.argv[0])
+    print("Usage: %s --output --platform [--cpuspeed] [--swospeed] [--textports] [--binports] [--stop] [--debug] [--help]" % sys.argv[0])
     print("Options:")
     print("  --output=<string>\t\toutput filename")
     print("  --platform=<string>\t\tplatform name (e.g. dpp2lora or nrf5)")
     print("  --cpuspeed\t\t\tThe CPU clock frequency of the target device.")
     print("  --swospeed\t\t\tThe SWO speed (baudrate).")
+    print("  --textports\t\t\tOptional. Bitmask of the ITM stimulus ports with text output (default: 0x1).")
+    print("  --binports\t\t\tOptional. Bitmask of the ITM stimulus ports with binary output (default: 0x0).")
     print("  --stop\t\t\tOptional. Causes the program to stop a possibly running instance of the serial reader service.")
     print("   --debug\t\t\tOptional. Enable verbose logging.")
     print("  --help\t\t\tOptional. Print this help.")
@@ -78,42 +85,149 @@ def sigterm_handler(signum, frame):
 
 ##############################################################################
 #
-# start_logger
+# port_filename - returns the output filename for an ITM stimulus port
+#                 (port 0 text output goes into the main output file)
 #
 ##############################################################################
-def start_logger(outputfile=None):
+def port_filename(outputfile, port, binary=False):
+    if port == 0 and not binary:
+        return outputfile
+    base, ext = os.path.splitext(outputfile)
+    if binary:
+        ext = ".dat"
+    return "%s_port%d%s" % (base, port, ext)
+### END port_filename()
+
+
+##############################################################################
+#
+# TextPortStream - assembles the data of a text port into timestamped lines
+#
+##############################################################################
+class TextPortStream():
+
+    def __init__(self, filename):
+        self.file   = open(filename, 'w')
+        self.line   = bytearray()
+        self.output = []
+
+    def write(self, timestamp, payload):
+        self.line += payload
+        # split into lines, keep the incomplete last line for the next readout
+        if b"\n" in self.line:
+            lines     = self.line.split(b"\n")
+            self.line = lines.pop()
+            for l in lines:
+                self.output.append("%.7f,%s\n" % (timestamp, l.decode(errors='replace').rstrip()))
+
+    def flush(self):
+        if self.output:
+            self.file.write("".join(self.output))
+            self.file.flush()
+            self.output = []
+
+    def close(self):
+        if self.line:
+            self.output.append("%.7f,%s\n" % (time.time(), self.line.decode(errors='replace').rstrip()))
+        self.flush()
+        self.file.close()
+### END TextPortStream
+
+
+##############################################################################
+#
+# BinaryPortStream - writes the data of a binary port as timestamped frames
+#                    (see lib/swo.py for the file format)
+#
+##############################################################################
+class BinaryPortStream():
+
+    def __init__(self, filename, port):
+        self.file = open(filename, 'wb')
+        self.file.write(("ITM stimulus port %d\n" % port).encode())
+        self.file.write(swo.bin_magic)
+        self.writer = swo.SwoFrameWriter(self.file, flush_interval=None)
+
+    def write(self, timestamp, payload):
+        self.writer.write(int(timestamp * 1e9), payload)
+
+    def flush(self):
+        self.writer.flush()
+
+    def close(self):
+        self.writer.flush()
+        self.file.close()
+### END BinaryPortStream
+
+
+##############################################################################
+#
+# swo_logger - reads the SWO data via the J-Link, decodes the ITM stimulus
+#              packets and writes the received lines with a timestamp into
+#              the output file
+#
+##############################################################################
+def swo_logger(outputfile=None, platform=None, cpuspeed=None, swospeed=None):
     logger = flocklab.get_logger(debug=debug)
     if not outputfile:
         logger.error("Invalid output file.")
         return flocklab.FAILED
-    logger.debug("Writing STDIN to file %s..." % outputfile)
-    # start logging
+    session = jlinksession.JLinkSession(device_name=flocklab.jlink_mcu_str(platform))
+    portmask = textports | binports
+    decoder  = itm.StimulusDecoder(portmask)
+    streams  = {}
     try:
-        with open(outputfile, 'w') as f:
-            startfound = False
-            if not waitfor:
-                startfound = True
-            # read from standard input in a loop
-            for line in sys.stdin:
-                line = line.rstrip()
-                if "Shutting down" in line:
-                    break
-                if not startfound:
-                    if waitfor in line and len(waitfor) == len(line):
-                        startfound = True
-                        logger.debug("Start sequence found.")
-                        sys.stdin.flush()   # discard input
-                else:
-                    try:
-                        f.write("%.7f,%s\n" % (time.time(), line))
-                    except UnicodeEncodeError:
-                        pass
+        session.open(verbose=False)
+        jlink = session.jlink
+        if not swospeed:
+            if cpuspeed:
+                swospeed = jlink.swo_supported_speeds(cpuspeed, 10)[0]    # pick the fastest supported speed
+            else:
+                swospeed = flocklab.max_swo_speed
+        if cpuspeed:
+            jlink.swo_enable(cpu_speed=cpuspeed, swo_speed=swospeed, port_mask=portmask)   # configures ITM and TPIU of the target
+        else:
+            jlink.swo_start(swospeed)     # rely on the target to configure ITM and TPIU
+        jlink.swo_flush()
+        logger.debug("Reading SWO data (SWO speed: %d, text ports: 0x%x, binary ports: 0x%x), writing to file %s..." % (swospeed, textports, binports, outputfile))
+        # one output stream per stimulus port (binary takes precedence if a port is in both masks)
+        for port in range(32):
+            if (binports >> port) & 1:
+                streams[port] = BinaryPortStream(port_filename(outputfile, port, True), port)
+            elif (textports >> port) & 1:
+                streams[port] = TextPortStream(port_filename(outputfile, port))
+        lastflush = time.monotonic()
+        deadline  = lastflush
+        while running:
+            timestamp = time.time()     # read time
+            num_bytes = jlink.swo_num_bytes()
+            if num_bytes:
+                data = decoder.decode(jlink.swo_read(0, num_bytes, remove=True))
+                for port, payload in data.items():
+                    streams[port].write(timestamp, payload)
+            now = time.monotonic()
+            if (now - lastflush) > flushdelay:
+                for stream in streams.values():
+                    stream.flush()
+                lastflush = now
+            deadline += loopdelay
+            if deadline > now:
+                time.sleep(deadline - now)
+            else:
+                deadline = now
+        jlink.swo_stop()
     except Exception:
         logger.error("Encountered error: %s\n%s" % (str(sys.exc_info()[1]), traceback.format_exc()))
         return flocklab.FAILED
+    finally:
+        for stream in streams.values():
+            stream.close()
+        session.close()
+    if decoder.num_overflows:
+        logger.warning("%d ITM overflow packets received, some data may be lost." % decoder.num_overflows)
     logger.debug("Logging stopped.")
     return flocklab.SUCCESS
-### END start_logger()
+### END swo_logger()
 
 
 ##############################################################################
@@ -123,18 +237,8 @@ def start_logger(outputfile=None):
 ##############################################################################
 def stop_logger():
     logger = flocklab.get_logger(debug=debug)
-    # first, send sigterm to the JLink process
-    pid = flocklab.get_pid(jlinkswopath)
-    if pid > 0:
-        logger.debug("Sending SIGTERM signal to JLink process %d..." % pid)
-        try:
-            os.kill(pid, signal.SIGTERM)
-            os.waitpid(pid, 0)
-        except OSError:
-            pass
-        # before continuing, wait a bit
-        time.sleep(3)
     # take the first PID that isn't our PID
+    pid = 0
     pids = flocklab.get_pids(scriptname)
     for p in pids:
         if p != os.getpid():
@@ -162,11 +266,11 @@ def stop_logger():
 def main(argv):
     global pidfile
     global debug
+    global textports
+    global binports
 
     stop      = False
     filename  = None
-    waitfor   = None
-    logger    = False
     cpuspeed  = None
     swospeed  = None
     platform  = None
@@ -178,7 +282,7 @@ def main(argv):
 
     # Get command line parameters.
     try:
-        opts, args = getopt.getopt(argv, "eho:p:ls:b:", ["stop", "help", "output=", "platform=", "logger", "cpuspeed=", "swospeed=", "debug"])
+        opts, args = getopt.getopt(argv, "eho:p:s:b:t:n:", ["stop", "help", "output=", "platform=", "cpuspeed=", "swospeed=", "textports=", "binports=", "debug"])
     except(getopt.GetoptError) as err:
         flocklab.error_logandexit(str(err), errno.EINVAL)
     for opt, arg in opts:
@@ -191,18 +295,25 @@ def main(argv):
             platform = arg
         elif opt in ("-e", "--stop"):
             stop = True
-        elif opt in ("-l", "--logger"):
-            logger = True
         elif opt in ("--debug"):
             debug = True
         elif opt in ("-s", "--cpuspeed"):
             cpuspeed = flocklab.parse_int(arg)
             if cpuspeed < 1000000 or cpuspeed > 100000000:
-                flocklab.error_logandexit("Invalid CPU speed '%s'." (arg), errno.EINVAL)
+                flocklab.error_logandexit("Invalid CPU speed '%s'." % (arg), errno.EINVAL)
         elif opt in ("-b", "--swospeed"):
             swospeed = flocklab.parse_int(arg)
             if swospeed < 9600 or swospeed > 4000000:
-                flocklab.error_logandexit("Invalid SWO speed '%s'." (arg), errno.EINVAL)
+                flocklab.error_logandexit("Invalid SWO speed '%s'." % (arg), errno.EINVAL)
+        elif opt in ("-t", "--textports", "-n", "--binports"):
+            try:
+                mask = int(arg, 0) & 0xffffffff
+            except ValueError:
+                flocklab.error_logandexit("Invalid port mask '%s'." % (arg), errno.EINVAL)
+            if opt in ("-t", "--textports"):
+                textports = mask
+            else:
+                binports = mask
         else:
             flocklab.error_logandexit("Unknown option '%s'." % (opt), errno.EINVAL)
 
@@ -210,8 +321,6 @@ def main(argv):
 
     if stop:
         sys.exit(stop_logger())
-    elif logger:
-        sys.exit(start_logger(filename))
 
     # Check mandatory parameters:
     if not filename or not flocklab.jlink_mcu_str(platform):
@@ -241,27 +350,16 @@ def main(argv):
         flocklab.tg_reset()
         logger.debug("Target reset released.")
 
-    cmd = [jlinkswopath, '-device', flocklab.jlink_mcu_str(platform)]
-    if cpuspeed:
-        cmd.append('-cpufreq')
-        cmd.append(str(cpuspeed))
-    if swospeed:
-        cmd.append('-swofreq')
-        cmd.append(str(swospeed))
-    jlinkproc = subprocess.Popen(cmd, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
-    cmd = [config.get("observer", "swologger"), '--logger', '--output=%s' % filename]
-    if debug:
-        cmd.append("--debug")
-    loggerproc = subprocess.Popen(cmd, stdin=jlinkproc.stdout, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-
-    # wait for the process to finish
-    #rs = jlinkproc.wait()
-    rs = loggerproc.wait()
-    if rs != 0:
+    rs = swo_logger(filename, platform, cpuspeed, swospeed)
+    if rs != flocklab.SUCCESS:
         logger.warning("SWO logger stopped with code %d." % rs)
     else:
         logger.info("SWO logger stopped.")
 
+    # Remove PID file
+    if os.path.isfile(pidfile):
+        os.remove(pidfile)
+
 ### END main()
 
 
@@ -0,0 +1,231 @@
+#! /usr/bin/env python3
+
+"""
+Copyright (c) 2020, ETH Zurich, Computer Engineering Group
+All rights reserved.
+
+Redistribution and use in source and binary forms, with or without
+modification, are permitted provided that the following conditions are met:
+
+* Redistributions of source code must retain the above copyright notice, this
+  list of conditions and the following disclaimer.
+
+* Redistributions in binary form must reproduce the above copyright notice,
+  this list of conditions and the following disclaimer in the documentation
+  and/or other materials provided with the distribution.
+
+* Neither the name of the copyright holder nor the names of its
+  contributors may be used to endorse or promote products derived from
+  this software without specific prior written permission.
+
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+POSSIBILITY OF SUCH DAMAGE.
+
+"""
+
+import os, sys, time, errno, traceback, getopt, signal, json
+import lib.flocklab as flocklab
+import lib.daemon as daemon
+
+
+# globals
+debug        = False
+running      = True
+pidfile      = None
+scriptname   = os.path.splitext(os.path.basename(__file__))[0]
+interval     = 10        # polling interval in seconds
+
+
+##############################################################################
+#
+# Usage
+#
+##############################################################################
+def usage():
+    print("Usage: %s [--interval] [--stop] [--debug] [--help]" % sys.argv[0])
+    print("Options:")
+    print("  --interval=<int>\t\tOptional. Polling interval in seconds (default: %d)." % interval)
+    print("  --stop\t\t\tOptional. Causes the program to stop a possibly running instance of the timesync monitor.")
+    print("  --debug\t\t\tOptional. Enable verbose logging.")
+    print("  --help\t\t\tOptional. Print this help.")
+### END usage()
+
+
+##############################################################################
+#
+# sigterm_handler
+#
+##############################################################################
+def sigterm_handler(signum, frame):
+    global running
+    running = False
+### END sigterm_handler()
+
+
+##############################################################################
+#
+# update_cache - atomically replaces the cached time sync status
+#
+##############################################################################
+def update_cache(status):
+    tmpfile = flocklab.timesynccache + ".tmp"
+    with open(tmpfile, "w") as f:
+        json.dump(status, f)
+    os.replace(tmpfile, flocklab.timesynccache)
+### END update_cache()
+
+
+##############################################################################
+#
+# log_status - appends the time sync status to the series of the running test
+#
+##############################################################################
+def log_status(status):
+    try:
+        with open(flocklab.timesynctarget, "r") as f:
+            logfile = f.read().strip()
+    except IOError:
+        return      # no test running
+    if not logfile or not os.path.isdir(os.path.dirname(logfile)):
+        return
+    flocklab.append_timesync_record(logfile, status)
+### END log_status()
+
+
+##############################################################################
+#
+# timesync_monitor - polls chronyd in regular intervals, keeps running across
+#                    tests until stopped with --stop
+#
+##############################################################################
+def timesync_monitor():
+    logger = flocklab.get_logger(debug=debug)
+    while running:
+        t_next = time.time() + interval
+        status = flocklab.query_timesync_status(tracking=True)
+        if status:
+            try:
+                update_cache(status)
+                log_status(status)
+            except:
+                logger.error("Failed to store time sync status: %s, %s" % (str(sys.exc_info()[0]), str(sys.exc_info()[1])))
+        else:
+            logger.debug("Failed to query time source.")
+        while running and time.time() < t_next:
+            time.sleep(0.5)
+    # remove the cache, it will not be updated anymore
+    if os.path.isfile(flocklab.timesynccache):
+        os.remove(flocklab.timesynccache)
+    return flocklab.SUCCESS
+### END timesync_monitor()
+
+
+##############################################################################
+#
+# stop_monitor
+#
+##############################################################################
+def stop_monitor():
+    logger = flocklab.get_logger(debug=debug)
+    # take the first PID that isn't our PID
+    pid = 0
+    pids = flocklab.get_pids(scriptname)
+    for p in pids:
+        if p != os.getpid():
+            pid = p
+            break
+    if pid > 0:
+        logger.debug("Sending SIGTERM signal to timesync monitor process %d..." % pid)
+        try:
+            os.kill(pid, signal.SIGTERM)
+        except OSError:
+            # process probably didn't exist -> ignore error
+            logger.debug("Process %d does not exist." % pid)
+    else:
+        logger.debug("No daemon process found.")
+    return flocklab.SUCCESS
+### END stop_monitor()
+
+
+##############################################################################
+#
+# Main
+#
+##############################################################################
+def main(argv):
+    global pidfile
+    global debug
+    global interval
+
+    stop         = False
+
+    # Get config:
+    config = flocklab.get_config()
+    if not config:
+        flocklab.error_logandexit("Could not read configuration file.")
+
+    # Get command line parameters.
+    try:
+        opts, args = getopt.getopt(argv, "ehi:", ["stop", "help", "interval=", "debug"])
+    except(getopt.GetoptError) as err:
+        flocklab.error_logandexit(str(err), errno.EINVAL)
+    for opt, arg in opts:
+        if opt in ("-h", "--help"):
+            usage()
+            sys.exit(flocklab.SUCCESS)
+        elif opt in ("-i", "--interval"):
+            interval = max(1, flocklab.parse_int(arg))
+        elif opt in ("-e", "--stop"):
+            stop = True
+        elif opt in ("--debug"):
+            debug = True
+        else:
+            flocklab.error_logandexit("Unknown option '%s'." % (opt), errno.EINVAL)
+
+    pidfile = "%s/%s.pid" % (config.get("observer", "pidfolder"), scriptname)
+
+    if stop:
+        sys.exit(stop_monitor())
+
+    if len(flocklab.get_pids(scriptname)) > 1:
+        flocklab.error_logandexit("There is already an instance of %s running (PIDs: %s)." % (scriptname, str(flocklab.get_pids(scriptname))))
+
+    # Create daemon process
+    daemon.daemonize(pidfile=pidfile, closedesc=True)
+
+    signal.signal(signal.SIGTERM, sigterm_handler)
+    signal.signal(signal.SIGINT, sigterm_handler)
+
+    logger = flocklab.get_logger(debug=debug)
+    if not logger:
+        flocklab.error_logandexit("Could not get logger.")
+
+    logger.info("Starting timesync monitor (interval: %ds)." % interval)
+
+    rs = timesync_monitor()
+    if rs != flocklab.SUCCESS:
+        logger.warning("Timesync monitor stopped with code %d." % rs)
+    else:
+        logger.info("Timesync monitor stopped.")
+
+    # Remove PID file
+    if os.path.isfile(pidfile):
+        os.remove(pidfile)
+
+### END main()
+
+
+if __name__ == "__main__":
+    try:
+        main(sys.argv[1:])
+    except Exception:
+        flocklab.error_logandexit("Encountered error: %s\n%s\nCommand line was: %s" % (str(sys.exc_info()[1]), traceback.format_exc(), " ".join(sys.argv)))
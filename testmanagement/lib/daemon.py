@@ -56,9 +56,11 @@ else:
 #    pidfile: File to store the PID in. This files needs to be deleted when 
 #        closing the daemon
 #    closedesc: When set to True, all file descriptors will be closed.
+#    keepfds: File descriptors to keep open (e.g. a pipe to report a status
+#        to the calling process), only relevant if closedesc is set.
 #
 ##############################################################################
-def daemonize(pidfile, closedesc):
+def daemonize(pidfile, closedesc, keepfds=()):
     """Detach a process from the controlling terminal and run it in the
     background as a daemon.
     """
@@ -107,6 +109,8 @@ def daemonize(pidfile, closedesc):
         
         # Iterate through and close all file descriptors.
         for fd in range(0, maxfd):
+            if fd in keepfds:
+                continue
             try:
                 os.close(fd)
             except OSError:    # ERROR, fd wasn't open to begin with (ignored)
@@ -32,30 +32,41 @@ Author: Lukas Daschinger
 """
 
 """
-    usage from command line: python3.7 config_read_parse.py  jlink_serial, device_name, ts_prescaler,
-                                                            trace_address0, access_mode0, trace_pc0,
-                                                            trace_address1, access_mode1, trace_pc1,
-                                                            trace_address2, access_mode2, trace_pc2,
-                                                            trace_address3, access_mode3, trace_pc3)
+    DWT configuration and SWO readout for the data trace service (see flocklab_datatrace.py):
+        config_dwt_for_data_trace(jlink_serial, device_name, ts_prescaler, comparators, swo_speed, cpu_speed, session)
+    with one (trace_address, access_mode, trace_pc, size) tuple per traced variable in comparators. At most
+    dwt_max_trace_comp variables can be traced (the data trace packets only hold the comparator index 0..3).
 """
-import pylink
-try:
-    import StringIO
-except ImportError:
-    import io as StringIO
 import sys
 import time
 import datetime
 import traceback
 import numpy as np
 import lib.flocklab as flocklab
+import lib.jlinksession as jlinksession
+import lib.swo as swo
 
 
-jlinklibpath = '/opt/jlink/libjlinkarm.so'
 logging_on   = False      # debug prints enabled?
 running      = True
 debuglogfile = '/home/flocklab/log/dwt_daemon.log'
 
+swo_host_buffer_size = 262144     # size of the SWO buffer on the host in bytes
+swo_fill_low         = 0.125      # poll period is halved if the buffer fill level exceeds this value
+swo_fill_high        = 0.5        # poll period is set to the minimum if the buffer fill level exceeds this value
+swo_min_delay_factor = 0.25       # min. poll period relative to the loop delay (but at least 1ms)
+swo_max_delay_factor = 4          # max. poll period relative to the loop delay (when idle)
+dwt_ctrl             = 0xe0001000   # Control register, DWT_CTRL (bits 31:28 = NUMCOMP)
+dwt_comp0            = 0xe0001020   # Comparator registers, DWT_COMP0
+dwt_comp_stride      = 0x10         # address offset between the register blocks of two comparators
+dwt_default_num_comp = 4            # number of comparators assumed if NUMCOMP cannot be read
+dwt_max_trace_comp   = 4            # max. number of comparators for data trace (2-bit comparator index in the packets)
+# DWT_FUNCTIONn values:  read    write   read/write
+dwt_function_values  = { True:  { 'r': 0xe, 'w': 0xf, 'rw': 0x3 },     # data + PC
+                         False: { 'r': 0xc, 'w': 0xd, 'rw': 0x2 } }    # data only
+
+swo_stats            = { 'reads': 0, 'hwm_bytes': 0, 'buffer_full': 0, 'late': 0 }
+
 
 def stop_swo_read():
     global running
@@ -93,105 +104,76 @@ def measure_sleep_overhead(numSamples=100, sleepTime=0.001):
     return np.mean(diff) - sleepTime
 
 
-def disable_and_reset_all_comparators(jlink_serial=None, device_name='STM32L433CC'):
+def get_num_comparators(session):
     """
-    Writes 0 as the tracing address for all comparators and disable them
+    Reads the number of implemented comparators from the DWT control register (DWT_CTRL.NUMCOMP)
 
     Parameters:
-        jlink_serial (int): the serial number of the jlink emulator (eg 801012958)
-        device_name (string): the device name (eg STM32L433CC)
+        session (JLinkSession): an open J-Link session
 
     Returns:
-      int: True if configuration reset was successful
+      int: number of comparators
 
     """
+    num_comp = (session.read32(dwt_ctrl, 1)[0] >> 28) & 0xf
+    if num_comp == 0:
+        log("DWT_CTRL.NUMCOMP is zero, assuming %d comparators" % dwt_default_num_comp)
+        num_comp = dwt_default_num_comp
+    return num_comp
 
-    # convert in case wrong type given as input
-    try:
-        jlink_serial = int(jlink_serial)
-    except TypeError:  # if the type is None we just pass
-        pass
-    if not isinstance(device_name, str):
-        log('the device name must be a string like "STM32L433CC" ')
-        log('setting the device name to default: "STM32L433CC"')
-        device_name = 'STM32L433CC'
 
+def disable_and_reset_all_comparators(jlink_serial=None, device_name='STM32L433CC', session=None):
+    """
+    Writes 0 as the tracing address for all comparators and disable them
 
-    buf = StringIO.StringIO()
-    jlinklib = pylink.library.Library(dllpath=jlinklibpath)
-    jlink = pylink.JLink(lib=jlinklib, log=buf.write, detailed_log=buf.write)
+    Parameters:
+        jlink_serial (int): the serial number of the jlink emulator (eg 801012958)
+        device_name (string): the device name (eg STM32L433CC)
+        session (JLinkSession): an open J-Link session to use (if None, a temporary session is opened)
 
-    if jlink_serial:  # if have several emulators connected, user can specify one by the serial number
-        jlink.open(serial_no=jlink_serial)
-    else:
-        jlink.open()
+    Returns:
+      int: True if configuration reset was successful
 
-    jlink.set_tif(pylink.enums.JLinkInterfaces.SWD)
+    """
+
+    own_session = session is None
+    if own_session:
+        session = jlinksession.JLinkSession(jlink_serial, device_name)
 
     if not flocklab.tg_reset_state():
         flocklab.tg_reset()   # release from reset
         log("target released from reset")
 
-    jlink.connect(device_name, verbose=True)
-    jlink.coresight_configure()
-    jlink.set_reset_strategy(pylink.enums.JLinkResetStrategyCortexM3.RESETPIN)
+    session.open()
 
     # halt MCU before config
-    try:
-        jlink.halt()
-    except:
+    if not session.halt():
         log("failed to halt target")
 
-    # now disable all comparators
-    dwt_fun0 = 0xe0001028  # Comparator Function registers, DWT_FUNCTIONn
-    dwt_comp0 = 0xe0001020  # Comparator registers, DWT_COMP0
-    jlink.memory_write32(dwt_fun0, [0x0])  # zero will disable the comparator
-    jlink.memory_write32(dwt_comp0, [0x0])  # set tracing address to zero
-
-    dwt_fun1 = 0xe0001038  # Comparator Function registers, DWT_FUNCTIONn
-    dwt_comp1 = 0xe0001030  # Comparator registers, DWT_COMP1
-    jlink.memory_write32(dwt_fun1, [0x0])  # zero will disable the comparator
-    jlink.memory_write32(dwt_comp1, [0x0])  # set tracing address to zero
-
-    dwt_fun2 = 0xe0001048  # Comparator Function registers, DWT_FUNCTIONnKipeli46
-    dwt_comp2 = 0xe0001040  # Comparator registers, DWT_COMP1
-    jlink.memory_write32(dwt_fun2, [0x0])  # zero will disable the comparator
-    jlink.memory_write32(dwt_comp2, [0x0])  # set tracing address to zero
-
-    dwt_fun3 = 0xe0001058  # Comparator Function registers, DWT_FUNCTIONn
-    dwt_comp3 = 0xe0001050  # Comparator registers, DWT_COMP1
-    jlink.memory_write32(dwt_fun3, [0x0])  # zero will disable the comparator
-    jlink.memory_write32(dwt_comp3, [0x0])  # set tracing address to zero
-
-    jlink.close()
-
-    time.sleep(0.5)
-
-    # reconnect in order to check the reset values
-    jlink.open(serial_no=jlink_serial)
-    jlink.set_tif(pylink.enums.JLinkInterfaces.SWD)
-    jlink.connect(device_name, verbose=True)
-    jlink.coresight_configure()
-    jlink.set_reset_strategy(pylink.enums.JLinkResetStrategyCortexM3.RESETPIN)
-    jlink.halt()
-
+    # now disable all comparators: DWT_COMPn, DWT_MASKn and DWT_FUNCTIONn are contiguous -> one write per comparator
+    num_comp = get_num_comparators(session)
+    regs = []
+    for i in range(num_comp):
+        dwt_comp = dwt_comp0 + dwt_comp_stride * i
+        regs.extend([(dwt_comp, 0x0),        # set tracing address to zero
+                     (dwt_comp + 0x4, 0x0),  # clear mask
+                     (dwt_comp + 0x8, 0x0)]) # zero will disable the comparator
+    session.write32(regs)
+
+    # read back the reset values over the same connection
     if logging_on:
         log("\nall comparators are reset. To be sure the comparators are disabled check if the last four bits of the function value are zero")
-        log("reset value comp0 function = " + hex(jlink.memory_read32(dwt_fun0, 1)[0]))
-        log("reset value comp1 function = " + hex(jlink.memory_read32(dwt_fun1, 1)[0]))
-        log("reset value comp2 function = " + hex(jlink.memory_read32(dwt_fun2, 1)[0]))
-        log("reset value comp3 function = " +  hex(jlink.memory_read32(dwt_fun3, 1)[0]) + "\n")
+        for i in range(num_comp):
+            log("reset value comp%d function = %s" % (i, hex(session.read32(dwt_comp0 + dwt_comp_stride * i + 0x8, 1)[0])))
+
+    if own_session:
+        session.close()
 
     return 0
 
 
-# trace address must be in hex
-def config_dwt_for_data_trace(jlink_serial=None, device_name='STM32L433CC', ts_prescaler=64,
-                              trace_address0=None, access_mode0='w', trace_pc0=0, size0=4,
-                              trace_address1=None, access_mode1='w', trace_pc1=0, size1=4,
-                              trace_address2=None, access_mode2='w', trace_pc2=0, size2=4,
-                              trace_address3=None, access_mode3='w', trace_pc3=0, size3=4,
-                              swo_speed=4000000, cpu_speed=80000000):
+def config_dwt_for_data_trace(jlink_serial=None, device_name='STM32L433CC', ts_prescaler=64, comparators=None,
+                              swo_speed=4000000, cpu_speed=80000000, session=None):
     """
     Configures the coresight components to trace variables with the DWT module
 
@@ -200,120 +182,34 @@ def config_dwt_for_data_trace(jlink_serial=None, device_name='STM32L433CC', ts_p
         device_name (string): the device name (eg STM32L433CC)
         ts_prescaler (int): the prescaler for local timestamps on the processor
 
-        trace_address0 (int): the address of the variable that should be traced by comparator 0
-        trace_address1 (int): the address of the variable that should be traced by comparator 1
-        trace_address2 (int): the address of the variable that should be traced by comparator 2
-        trace_address3 (int): the address of the variable that should be traced by comparator 3
-
-        access_mode0 (string): specifies if should generate packet on ro, wo or on rw access of variable 0
-        access_mode1 (string): specifies if should generate packet on ro, wo or on rw access of variable 1
-        access_mode2 (string): specifies if should generate packet on ro, wo or on rw access of variable 2
-        access_mode3 (string): specifies if should generate packet on ro, wo or on rw access of variable 3
-
-        trace_pc0 (int): specifies if the PC should also be traced for variable 0 (if non-zero, PC is traced)
-        trace_pc1 (int): specifies if the PC should also be traced for variable 1 (if non-zero, PC is traced)
-        trace_pc2(int): specifies if the PC should also be traced for variable 2 (if non-zero, PC is traced)
-        trace_pc3 (int): specifies if the PC should also be traced for variable 3 (if non-zero, PC is traced)
+        comparators (list): one tuple (trace_address, access_mode, trace_pc, size) per variable, comparator n is
+                            assigned to the n-th element (unused comparators are disabled, at most
+                            dwt_max_trace_comp variables are traced)
+            trace_address (int or string): the address of the variable that should be traced
+            access_mode (string): specifies if should generate packet on ro, wo or on rw access of the variable
+            trace_pc (int): specifies if the PC should also be traced (if non-zero, PC is traced)
+            size (int): size of the traced variable in bytes (allowed values: 1, 2 and 4)
 
-        sizen (int): size of the traced variable in bytes (allowed values: 1, 2 and 4)
+        session (JLinkSession): an open J-Link session to use (if None, a temporary session is opened)
 
     Returns:
-      int: True if configuration was successful
+      int: flocklab.SUCCESS if the configuration was successful and verified, flocklab.FAILED otherwise
 
     """
 
     def determine_config_value(trace_pc, access_mode):
         """
-        The function implements this configuration table
-                    read    write   read/write
-                ----------------------------------
-        data+PC |    0xe     0xf     0x3
-        PC      |    n/a     n/a     0x1
-        data    |    0xc     0xd     0x2
-
-        Parameters:
-            trace_pc (int): specifies if the PC should also be traced (if non-zero, PC is traced)
-            access_mode (string): specifies if should generate packet on ro, wo or on rw access of variable
-
-        Returns:
-            config (int): The value that needs to be written into the function function register of the comparator
-
-        """
-
-        if trace_pc:  # tracing data and PC
-            if access_mode == 'r':
-                config = 0xe
-            elif access_mode == 'w':
-                config = 0xf
-            elif access_mode == 'rw':
-                config = 0x3
-            else:
-                config = 0x1    # PC only
-
-        else:  # tracing data only
-            if access_mode == 'r':
-                config = 0xc
-            elif access_mode == 'w':
-                config = 0xd
-            elif access_mode == 'rw':
-                config = 0x2
-            else:
-                if logging_on:
-                    log("access_mode must be r,w or rw. default is w")
-                config = 0xd
-
-        return config
+        Looks up the value for the comparator function register in dwt_function_values (PC only if access mode is invalid)
 
-    def convert_type(jlink_ser, dev_name, ts_pres, trace_addr0, trace_addr1,
-                     trace_addr2, trace_addr3, swo_speed, cpu_speed):
         """
-        takes the raw input values from function call and converts them to the right type (int or string)
-        if type is "None", it stays
-
-        """
-        # convert in case wrong type given as input
-        try:
-            jlink_ser = int(jlink_ser)
-        except TypeError:  # if the type is None we just pass
-            pass
-        if not isinstance(dev_name, str):
-            log('the device name must be a string like "STM32L433CC" ')
-            log('setting the device name to default: "STM32L433CC"')
-            dev_name = 'STM32L433CC'
-        try:
-            ts_pres = int(ts_pres)
-        except TypeError:  # if the type is None we just pass
-            pass
-        try:
-            trace_addr0 = int(trace_addr0, 16)
-        except TypeError:
-            pass
-        try:
-            trace_addr1 = int(trace_addr1, 16)
-        except TypeError:  # if the type is None we just pass
-            pass
-        try:
-            trace_addr2 = int(trace_addr2, 16)
-        except TypeError:
-            pass
-        try:
-            trace_addr3 = int(trace_addr3, 16)
-        except TypeError:  # if the type is None we just pass
-            pass
-        try:
-            swo_speed = int(swo_speed)
-            if swo_speed == 0 or swo_speed > 4000000:
-                swo_speed = 4000000
-        except:
-            swo_speed = 4000000   # use default value
-        try:
-            cpu_speed = int(cpu_speed)
-            if cpu_speed == 0:
-                cpu_speed = 80000000
-        except:
-            cpu_speed = 80000000      # use default value
-
-        return jlink_ser, dev_name, ts_pres, trace_addr0, trace_addr1, trace_addr2, trace_addr3, swo_speed, cpu_speed
+        values = dwt_function_values[bool(trace_pc)]
+        if access_mode in values:
+            return values[access_mode]
+        if trace_pc:
+            return 0x1      # PC only
+        if logging_on:
+            log("access_mode must be r,w or rw. default is w")
+        return values['w']
 
     def convert_varsize(size):
         # convert variable size in bytes to the corresponding DWT mask register value
@@ -329,61 +225,55 @@ def config_dwt_for_data_trace(jlink_serial=None, device_name='STM32L433CC', ts_p
             logsize = logsize + 1
         return logsize
 
+    def convert_int(value, default=None, base=0):
+        # convert in case wrong type given as input
+        if isinstance(value, str):
+            return int(value, base)
+        try:
+            return int(value)
+        except TypeError:
+            return default
 
     # convert in case wrong type given as input
-    result = convert_type(jlink_serial, device_name, ts_prescaler, trace_address0, trace_address1,
-                          trace_address2, trace_address3, swo_speed, cpu_speed)
-    jlink_serial = result[0]
-    device_name = result[1]
-    ts_prescaler = result[2]
-    trace_address0 = result[3]
-    trace_address1 = result[4]
-    trace_address2 = result[5]
-    trace_address3 = result[6]
-    swo_speed = result[7]
-    cpu_speed = result[8]
-
-    buf = StringIO.StringIO()
-    jlinklib = pylink.library.Library(dllpath=jlinklibpath)
-    jlink = pylink.JLink(lib=jlinklib, log=buf.write, detailed_log=buf.write)
-
-    if jlink_serial:  # if have several emulators connected, user can specify one by the serial number
-        jlink.open(serial_no=jlink_serial)
-    else:
-        jlink.open()
-
-    jlink.set_tif(pylink.enums.JLinkInterfaces.SWD)
+    jlink_serial = convert_int(jlink_serial)
+    if not isinstance(device_name, str):
+        log('the device name must be a string like "STM32L433CC" ')
+        log('setting the device name to default: "STM32L433CC"')
+        device_name = 'STM32L433CC'
+    ts_prescaler = convert_int(ts_prescaler)
+    swo_speed    = convert_int(swo_speed, 0)
+    if not swo_speed or swo_speed > 4000000:
+        swo_speed = 4000000   # use default value
+    cpu_speed    = convert_int(cpu_speed, 0)
+    if not cpu_speed:
+        cpu_speed = 80000000  # use default value
+    comparators  = [(convert_int(addr, base=16), mode, pc, size) for (addr, mode, pc, size) in (comparators or [])]
+
+    own_session = session is None
+    if own_session:
+        session = jlinksession.JLinkSession(jlink_serial, device_name)
 
     # In case the reset pin is not low must halt MCU before config, throws error in case reset pin is low
     if not flocklab.tg_reset_state():
         flocklab.tg_reset()   # release from reset
         #log("target released from reset")
 
-    jlink.connect(device_name, verbose=True)
-    jlink.coresight_configure()
-    jlink.set_reset_strategy(pylink.enums.JLinkResetStrategyCortexM3.RESETPIN)
+    session.open()
 
     # halt MCU before config
-    try:
-        jlink.halt()
-    except:
+    if not session.halt():
         log("failed to halt target")
 
-    dwt_fun0 = 0xe0001028
-    dwt_fun1 = 0xe0001038
-    dwt_fun2 = 0xe0001048
-    dwt_fun3 = 0xe0001058
-
     """general registers"""
     demcr = 0xe000edfc  # Debug Exception and Monitor Control Register, DEMCR
-    enable_dwt_itm = [0x01000000]
+    enable_dwt_itm = 0x01000000
 
     tpiu_sppr = 0xe00400f0  # Selected Pin Protocol Register, TPIU_SPPR
-    async_swo_nrz = [0x00000002]  # Asynchronous SWO, using NRZ encoding. Manchester is not supported
+    async_swo_nrz = 0x00000002  # Asynchronous SWO, using NRZ encoding. Manchester is not supported
 
     tpiu_acpr = 0xe0040010  # Asynchronous Clock Prescaler Register, TPIU_ACPR
     # SWO freq = Clock/(SWOSCALAR +1). 0x27 for 2MHz, 0x13 for 4MHz
-    swo_rate_prescaler = [int(cpu_speed / swo_speed - 1)]
+    swo_rate_prescaler = int(cpu_speed / swo_speed - 1)
     if logging_on:
         log("using SWO rate prescaler %d" % int(cpu_speed / swo_speed - 1))
 
@@ -393,162 +283,109 @@ def config_dwt_for_data_trace(jlink_serial=None, device_name='STM32L433CC', ts_p
     # bit 4 = 1 enables TPIU async counter freq (NOT WORKING)
     # the value 0001010f,0001020f,0001030f are prescaler 4,16,64
     if ts_prescaler == 0 or ts_prescaler == 1:
-        itm_tcr_config = [0x0001000f]
+        itm_tcr_config = 0x0001000f
     elif ts_prescaler == 4:
-        itm_tcr_config = [0x0001010f]
+        itm_tcr_config = 0x0001010f
     elif ts_prescaler == 16:
-        itm_tcr_config = [0x0001020f]
+        itm_tcr_config = 0x0001020f
     elif ts_prescaler == 64:
-        itm_tcr_config = [0x0001030f]
+        itm_tcr_config = 0x0001030f
     else:
         if logging_on:
             log("no or invalid ts_prescaler chosen. Setting it to 64\n")
-        itm_tcr_config = [0x0001030f]
+        itm_tcr_config = 0x0001030f
 
     int_prio1 = 0xe0000040  # Interrupt Priority Registers, NVIC_IPR0-NVIC_IPR123
     int_prio2 = 0xe0000000  # Interrupt Priority Registers, NVIC_IPR0-NVIC_IPR123
 
-    dwt_ctrl = 0xe0001000  # Control register, DWT_CTRL
-    dwt_ctrl_value = [0x000003ff]
+    dwt_ctrl_value = 0x000003ff
 
     """comparator configuration"""
-    # comp0
-    if trace_address0:
-        dwt_comp0 = 0xe0001020  # Comparator registers, DWT_COMP0
-        dwt_comp0_value = [trace_address0]
-        dwt_mask0 = 0xe0001024  # Comparator Mask registers, DWT_MASKn
-        dwt_mask0_value = [convert_varsize(size0)]  # size of the mask
-
-        config_value = determine_config_value(trace_pc0, access_mode0)
-        dwt_fun0 = 0xe0001028  # Comparator Function registers, DWT_FUNCTIONn
-        dwt_fun0_value = [config_value]
-
-        jlink.memory_write32(dwt_comp0, dwt_comp0_value)
-        jlink.memory_write32(dwt_mask0, dwt_mask0_value)
-        jlink.memory_write32(dwt_fun0, dwt_fun0_value)
-        if logging_on:
-            log("function0 = " + hex(config_value))
-            log("new value comp0 = " + hex(jlink.memory_read32(dwt_comp0, 1)[0]) + "\n")
-    else:  # if comparator0 is not used, configure it to not trace anything
-        dwt_fun0 = 0xe0001028  # Comparator Function registers, DWT_FUNCTIONn
-        jlink.memory_write32(dwt_fun0, [0x0])  # zero will disable the comparator
-
-    # comp1
-    if trace_address1:
-        dwt_comp1 = 0xe0001030  # Comparator registers, DWT_COMP1
-        dwt_comp1_value = [trace_address1]
-        dwt_mask1 = 0xe0001034  # Comparator Mask registers, DWT_MASKn
-        dwt_mask1_value = [convert_varsize(size1)]  # size of the mask
-
-        config_value1 = determine_config_value(trace_pc1, access_mode1)
-        dwt_fun1 = 0xe0001038  # Comparator Function registers, DWT_FUNCTIONn
-        dwt_fun1_value = [config_value1]
-
-        jlink.memory_write32(dwt_comp1, dwt_comp1_value)
-        jlink.memory_write32(dwt_mask1, dwt_mask1_value)
-        jlink.memory_write32(dwt_fun1, dwt_fun1_value)
-        if logging_on:
-            log("function1 = " + hex(config_value1))
-            log("new value comp1 = %" % hex(jlink.memory_read32(dwt_comp1, 1)[0]) + "\n")
-    else:  # if comparator0 is not used, configure it to not trace anything
-        dwt_fun1 = 0xe0001038  # Comparator Function registers, DWT_FUNCTIONn
-        jlink.memory_write32(dwt_fun1, [0x0])  # zero will disable the comparator
-
-    # comp2
-    if trace_address2:
-        dwt_comp2 = 0xe0001040  # Comparator registers, DWT_COMP2
-        dwt_comp2_value = [trace_address2]
-        dwt_mask2 = 0xe0001044  # Comparator Mask registers, DWT_MASKn
-        dwt_mask2_value = [convert_varsize(size2)]  # size of the mask
-
-        config_value2 = determine_config_value(trace_pc2, access_mode2)
-        dwt_fun2 = 0xe0001048  # Comparator Function registers, DWT_FUNCTIONn
-        dwt_fun2_value = [config_value2]
-
-        jlink.memory_write32(dwt_comp2, dwt_comp2_value)
-        jlink.memory_write32(dwt_mask2, dwt_mask2_value)
-        jlink.memory_write32(dwt_fun2, dwt_fun2_value)
-        if logging_on:
-            log("function2 = " + hex(config_value2))
-            log("new value comp2 = " + hex(jlink.memory_read32(dwt_comp2, 1)[0]) + "\n")
-    else:  # if comparator0 is not used, configure it to not trace anything
-        dwt_fun2 = 0xe0001048  # Comparator Function registers, DWT_FUNCTIONn
-        jlink.memory_write32(dwt_fun2, [0x0])  # zero will disable the comparator
-
-    # comp3
-    if trace_address3:
-        dwt_comp3 = 0xe0001050  # Comparator registers, DWT_COMP3
-        dwt_comp3_value = [trace_address3]
-        dwt_mask3 = 0xe0001054  # Comparator Mask registers, DWT_MASKn
-        dwt_mask3_value = [convert_varsize(size3)]  # size of the mask
-
-        config_value3 = determine_config_value(trace_pc3, access_mode3)
-        dwt_fun3 = 0xe0001058  # Comparator Function registers, DWT_FUNCTIONn
-        dwt_fun3_value = [config_value3]
-
-        jlink.memory_write32(dwt_comp3, dwt_comp3_value)
-        jlink.memory_write32(dwt_mask3, dwt_mask3_value)
-        jlink.memory_write32(dwt_fun3, dwt_fun3_value)
-        if logging_on:
-            log("function3 = " + hex(config_value3))
-            log("new value comp3 = " + hex(jlink.memory_read32(dwt_comp3, 1)[0]) + "\n")
-    else:  # if comparator0 is not used, configure it to not trace anything
-        dwt_fun3 = 0xe0001058  # Comparator Function registers, DWT_FUNCTIONn
-        jlink.memory_write32(dwt_fun3, [0x0])  # zero will disable the comparator
+    # build the register table for all implemented comparators up front
+    # DWT_COMPn, DWT_MASKn and DWT_FUNCTIONn are contiguous -> one write per used comparator
+    num_comp = get_num_comparators(session)
+    max_comp = min(num_comp, dwt_max_trace_comp)    # comparators 4+ cannot be distinguished in the trace packets
+    if len(comparators) > max_comp:
+        log("only %d comparators available for data trace, ignoring variable(s) at %s" % (max_comp, ", ".join([hex(c[0]) if c[0] else "-" for c in comparators[max_comp:]])))
+        comparators = comparators[:max_comp]
+    comp_regs = []
+    verify    = []      # (address, expected value, mask of the relevant bits)
+    for i in range(num_comp):
+        dwt_comp = dwt_comp0 + dwt_comp_stride * i  # Comparator registers, DWT_COMPn
+        dwt_mask = dwt_comp + 0x4                   # Comparator Mask registers, DWT_MASKn
+        dwt_fun  = dwt_comp + 0x8                   # Comparator Function registers, DWT_FUNCTIONn
+        trace_address = None
+        if i < len(comparators):
+            trace_address, access_mode, trace_pc, size = comparators[i]
+        if trace_address:
+            config_value = determine_config_value(trace_pc, access_mode)
+            mask_value   = convert_varsize(size)
+            comp_regs.extend([(dwt_comp, trace_address), (dwt_mask, mask_value), (dwt_fun, config_value)])
+            verify.extend([(dwt_comp, trace_address, 0xffffffff), (dwt_mask, mask_value, 0x1f), (dwt_fun, config_value, 0xf)])
+            if logging_on:
+                log("function%d = %s" % (i, hex(config_value)))
+        else:  # if comparator is not used, configure it to not trace anything
+            comp_regs.append((dwt_fun, 0x0))  # zero will disable the comparator
+            verify.append((dwt_fun, 0x0, 0xf))
+    session.write32(comp_regs)
 
     """unclear registers"""
     dbg_mcu_cr = 0xe0042004  # DBG_MCU_CR configures if for example timers stop when in debug mode
-    dbg_mcu_cr_value = [0x00003337]  # search in stmcubeIDE projects for DBGMCU and find description
+    dbg_mcu_cr_value = 0x00003337  # search in stmcubeIDE projects for DBGMCU and find description
 
     cs_sw_lock = 0xe0000fb0  # coresight lock register
-    cs_sw_lock_unlock = [0xc5acce55]  # c5acce55 will coresight available
-
-    zero = [0x00000000]
-
-    """general registers"""
-    jlink.memory_write32(demcr, enable_dwt_itm)
-    jlink.memory_write32(tpiu_sppr, async_swo_nrz)
-    jlink.memory_write32(tpiu_acpr, swo_rate_prescaler)
-    jlink.memory_write32(itm_tcr, itm_tcr_config)
-    jlink.memory_write32(int_prio1, zero)
-    jlink.memory_write32(int_prio2, zero)
-
-    """code specific registers"""
-    jlink.memory_write32(dwt_ctrl, dwt_ctrl_value)
-    """jlink.memory_write32(0xe0001030, zero)  # DWT_COMP1
-    jlink.memory_write32(0xe0001040, zero)  # DWT_COMP2
-    jlink.memory_write32(0xe0001050, zero)  # DWT_COMP3"""
-
-    """unclear registers"""
-    jlink.memory_write32(dbg_mcu_cr, dbg_mcu_cr_value)
-    value0 = [0x701]
-    jlink.memory_write32(0xe0040304, value0)
-    # ITM trace enable register, Each ITM_TER provides enable bits for 32 ITM_STIM registers.
-    jlink.memory_write32(0xe0000e00, zero)
-    jlink.memory_write32(cs_sw_lock, cs_sw_lock_unlock)
-
-    jlink.memory_write32(0xe0000fd0, zero)
-
-    jlink.reset(halt=False)
-    jlink.close()
-
-    return 0
-
-
-def read_swo_buffer(jlink_serial=None, device_name='STM32L433CC', loop_delay_in_ms=2, filename='swo_read_log', swo_speed=None, cpu_speed=None):
+    cs_sw_lock_unlock = 0xc5acce55  # c5acce55 will coresight available
+
+    zero = 0x00000000
+
+    session.write32([(demcr, enable_dwt_itm),
+                     (tpiu_sppr, async_swo_nrz),
+                     (tpiu_acpr, swo_rate_prescaler),
+                     (itm_tcr, itm_tcr_config),
+                     (int_prio1, zero),
+                     (int_prio2, zero),
+                     (dwt_ctrl, dwt_ctrl_value),
+                     (dbg_mcu_cr, dbg_mcu_cr_value),
+                     (0xe0040304, 0x701),
+                     (0xe0000e00, zero),          # ITM trace enable register, Each ITM_TER provides enable bits for 32 ITM_STIM registers.
+                     (cs_sw_lock, cs_sw_lock_unlock),
+                     (0xe0000fd0, zero)])
+
+    # verify the comparator configuration (one read per contiguous register block)
+    result = flocklab.SUCCESS
+    idx    = 0
+    for addr, values in jlinksession.group_contiguous([(regaddr, expected) for (regaddr, expected, mask) in verify]):
+        for value in session.read32(addr, len(values)):
+            regaddr, expected, mask = verify[idx]
+            idx += 1
+            if (value & mask) != (expected & mask):
+                log("DWT register 0x%08x verification failed (expected 0x%x, read 0x%x)" % (regaddr, expected & mask, value & mask))
+                result = flocklab.FAILED
+
+    session.jlink.reset(halt=False)
+    if own_session:
+        session.close()
+
+    return result
+
+
+def read_swo_buffer(jlink_serial=None, device_name='STM32L433CC', loop_delay_in_ms=2, filename='swo_read_log', swo_speed=None, cpu_speed=None, session=None):
     """
     Starts the SWO reading from the SWO buffer, Resets the MCU but halts the execution
 
-    The function reads the out the whole SWO buffer after every loop_delay_in_ms and saves its raw contents
-    together with the python timestamp (time.time()) in the file "filename".
+    The function reads the out the whole SWO buffer about every loop_delay_in_ms and saves its raw contents
+    together with the python timestamp (time.time_ns()) as binary frames in the file "filename" (see lib/swo.py,
+    use swo.bin_to_text() to convert it into the legacy text format).
     The reset will toggle the reset pin such that it is on high again. The execution will be halted but
     the SWO reading loop is running.
 
     Parameters:
       jlink_serial (int): the serial number of the jlink emulator (eg 801012958)
       device_name (string): the device name (eg STM32L433CC)
-      loop_delay_in_ms (int): the delay between buffer readouts in ms
+      loop_delay_in_ms (int): the nominal delay between buffer readouts in ms (adapted to the buffer fill level
+                              between loop_delay_in_ms * swo_min_delay_factor and loop_delay_in_ms * swo_max_delay_factor)
       filename (string): name of the file where the buffer readouts and timestamps are saved in
+      session (JLinkSession): an open J-Link session to use (if None, a temporary session is opened)
 
     Returns:
       int: True if the program was halted by Key interrupt
@@ -580,25 +417,16 @@ def read_swo_buffer(jlink_serial=None, device_name='STM32L433CC', loop_delay_in_
         filename = 'swo_read_log'
 
     try:
-        buf = StringIO.StringIO()
-        jlinklib = pylink.library.Library(dllpath=jlinklibpath)
-        jlink = pylink.JLink(lib=jlinklib, log=buf.write, detailed_log=buf.write)
-
-        # reconnect
-        if jlink_serial:  # if have several emulators connected, user can specify one by the serial number
-            jlink.open(serial_no=jlink_serial)
-        else:
-            jlink.open()
-        jlink.set_tif(pylink.enums.JLinkInterfaces.SWD)
-
+        # reuse the session of the configuration step if available
+        own_session = session is None
+        if own_session:
+            session = jlinksession.JLinkSession(jlink_serial, device_name)
         try:
-            jlink.connect(device_name, verbose=False)
+            session.open(verbose=False)
         except:
             log('could not connect to the target')
             return 1
-
-        jlink.coresight_configure()
-        jlink.set_reset_strategy(pylink.enums.JLinkResetStrategyCortexM3.RESETPIN)
+        jlink = session.jlink
 
         if not swo_speed:
             if cpu_speed:
@@ -615,6 +443,10 @@ def read_swo_buffer(jlink_serial=None, device_name='STM32L433CC', loop_delay_in_
 
         # Start logging serial wire output.
         #jlink.swo_enable(cpu_speed=cpu_speed, swo_speed=swo_speed, port_mask=0xffffffff)
+        try:
+            jlink.swo_set_host_buffer_size(swo_host_buffer_size)   # set explicitly, required to determine the fill level
+        except:
+            log("failed to set the SWO host buffer size")
         jlink.swo_start(swo_speed)    # same as swo_enable()
         jlink.swo_flush()
 
@@ -622,57 +454,68 @@ def read_swo_buffer(jlink_serial=None, device_name='STM32L433CC', loop_delay_in_
 
         #jlink.reset(ms=10, halt=True)  # -> also seems to work without this (at least if the target is held in reset state)
 
-        file = open(filename, "a")   # append to file
+        file = open(filename, "ab")   # append to file (binary mode)
 
         # determine sleep overhead (this differs on different linux versions by about 0.3ms -> can be used to fingerprint platform)
+        # note: no longer used for the loop timing, but kept in the header for the post-processing
         sleep_overhead = measure_sleep_overhead()
-        file.write(str(sleep_overhead)+"\n") # write sleep_overhead as last element of first line (to distinguish observer platforms (Linux version) for correction of time offset)
+        file.write((str(sleep_overhead)+"\n").encode()) # write sleep_overhead as last element of first line (to distinguish observer platforms (Linux version) for correction of time offset)
+        file.write(swo.bin_magic)         # the remainder of the file consists of binary frames (see lib/swo.py)
+        writer = swo.SwoFrameWriter(file)
 
         # catch the keyboard interrupt telling execution to stop
         try:
-            # # DEBUG START
-            # numSamples = 3000
-            # tmp_arr_global = np.empty([numSamples], dtype=np.float64)
-            # tmp_arr_comp = np.empty([numSamples], dtype=np.float64)
-            # # DEBUG END
-            # vars for loopdelay compensation
-            last_global_time = None
-            last_loop_start = time.time()
-            delta = 5e-6
-            comp_val = 0
-            # for i in range(numSamples): # DEBUG
+            # the loop is scheduled against absolute deadlines on the monotonic clock (no drift)
+            # the poll period adapts to the fill level of the SWO buffer: shorter if the buffer fills up, longer when idle
+            min_delay_in_s = max(loop_delay_in_s * swo_min_delay_factor, 0.001)
+            max_delay_in_s = loop_delay_in_s * swo_max_delay_factor
+            period         = loop_delay_in_s
+            deadline       = time.monotonic()
             while running:
                 # log global timestamp and data (if data is available)
-                global_time = time.time()
-                # tmp_arr_global[i] = global_time # DEBUG
+                global_time_ns = time.time_ns()
                 num_bytes = jlink.swo_num_bytes()
+                fill = num_bytes / swo_host_buffer_size
                 if num_bytes:
                     data = jlink.swo_read(0, num_bytes, remove=True)
-                    file.write(' '.join(str(x) for x in data) + "\n" + str(global_time) + "\n")
-
-                # update loopdelay compensation value (control loop)
-                if last_global_time:
-                    if global_time - last_global_time > loop_delay_in_s:
-                        comp_val -= delta
-                    else:
-                        comp_val += delta
-                # tmp_arr_comp[i] = comp_val # DEBUG
-                last_global_time = global_time
-
-                # sleep
-                time_used = time.time() - last_loop_start
-                time_sleep = (loop_delay_in_s) - sleep_overhead - time_used + comp_val
-                last_loop_start += loop_delay_in_s
+                    writer.write(global_time_ns, bytes(data))
+                    swo_stats['reads'] += 1
+                    if num_bytes > swo_stats['hwm_bytes']:
+                        swo_stats['hwm_bytes'] = num_bytes
+                    if num_bytes >= swo_host_buffer_size:
+                        if not swo_stats['buffer_full']:
+                            log("SWO buffer full (%d bytes), data may have been lost" % num_bytes)
+                        swo_stats['buffer_full'] += 1
+
+                # adjust the poll period
+                if fill >= swo_fill_high:
+                    period = min_delay_in_s
+                elif fill >= swo_fill_low:
+                    period = max(period / 2, min_delay_in_s)
+                elif not num_bytes:
+                    period = min(period * 1.5, max_delay_in_s)
+                elif period < loop_delay_in_s:
+                    period = min(period * 1.25, loop_delay_in_s)
+                else:
+                    period = loop_delay_in_s
+
+                # sleep until the next deadline
+                deadline += period
+                time_sleep = deadline - time.monotonic()
                 if time_sleep > 0:
                     time.sleep(time_sleep)
-            # np.savetxt('/home/flocklab/tmp_arr_global.txt', tmp_arr_global) # DEBUG
-            # np.savetxt('/home/flocklab/tmp_arr_comp.txt', tmp_arr_comp) # DEBUG
+                else:
+                    if -time_sleep > period:
+                        swo_stats['late'] += 1
+                    deadline = time.monotonic()     # do not try to catch up on missed deadlines
         except KeyboardInterrupt:
             pass
         jlink.swo_stop()
         jlink.swo_flush()
-        jlink.close()
-        file.flush()
+        log("SWO read stopped: %d readouts, buffer high-water mark %d bytes (%.1f%%), %d times full, %d deadlines missed" % (swo_stats['reads'], swo_stats['hwm_bytes'], swo_stats['hwm_bytes'] * 100.0 / swo_host_buffer_size, swo_stats['buffer_full'], swo_stats['late']))
+        if own_session:
+            session.close()
+        writer.flush()
         file.close()
 
     except:
@@ -0,0 +1,510 @@
+"""
+Copyright (c) 2020, ETH Zurich, Computer Engineering Group
+All rights reserved.
+
+Redistribution and use in source and binary forms, with or without
+modification, are permitted provided that the following conditions are met:
+
+* Redistributions of source code must retain the above copyright notice, this
+  list of conditions and the following disclaimer.
+
+* Redistributions in binary form must reproduce the above copyright notice,
+  this list of conditions and the following disclaimer in the documentation
+  and/or other materials provided with the distribution.
+
+* Neither the name of the copyright holder nor the names of its
+  contributors may be used to endorse or promote products derived from
+  this software without specific prior written permission.
+
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+POSSIBILITY OF SUCH DAMAGE.
+
+"""
+
+
+"""
+    Parser for the raw tracing data of fl_logic (GPIO tracing service)
+
+    The data file is a sequence of 32-bit samples (little endian):
+        bits 0-7   pin states (bit 7 is the nRST pin for the first and last sample and the PPS pin otherwise)
+        bits 8-31  number of ticks since the previous sample
+    A zero sample marks the end of the valid data.
+    The conversion implements the same time scaling as fl_logic.c (piecewise between PPS pulses, simple or none)
+    but operates on NumPy arrays and processes the samples in chunks. StreamConverter can be used to convert the
+    data while it is being recorded. The output formats are implemented in gpiotrace.py.
+"""
+import os
+import numpy as np
+import lib.gpiotrace as gpiotrace
+
+
+pin_names        = ("LED1", "LED2", "LED3", "INT1", "INT2", "SIG1", "SIG2", "nRST", "PPS")
+pin_names_bb     = ("P845", "P846", "P843", "P844", "P841", "P842", "P839", "P840", "P827")
+pps_pin_bitmask  = 0x80
+nrst_pin         = 7
+pps_pin          = 8
+
+# must match the definitions in fl_logic.c
+sampling_rate_high       = 10000000
+sampling_rate_medium     = 1000000
+sampling_rate_low        = 100000
+cycle_counter_res        = 6250000
+max_time_scaling_dev     = 0.001
+max_time_scale_change    = 0.000005
+extraopt_simple_scaling  = 0x00000004
+extraopt_samp_rate_low   = 0x00000008
+extraopt_samp_rate_med   = 0x00000010
+extraopt_use_pru0_helper = 0x00000040
+extraopt_use_cycle_cnt   = 0x00000080
+extraopt_relative_time   = 0x00000200
+extraopt_use_bb_pinnames = 0x00000400
+extraopt_no_parsing      = 0x00002000
+
+chunk_size = 1 << 20        # number of samples processed at once
+
+
+##############################################################################
+#
+# get_sampling_rate - determines the sampling rate from the extra options
+#
+##############################################################################
+def get_sampling_rate(extra_options=0):
+    if extra_options & extraopt_use_pru0_helper:
+        return sampling_rate_high
+    if extra_options & extraopt_use_cycle_cnt:
+        return cycle_counter_res
+    if extra_options & extraopt_samp_rate_low:
+        return sampling_rate_low
+    if extra_options & extraopt_samp_rate_med:
+        return sampling_rate_medium
+    return sampling_rate_high
+### END get_sampling_rate()
+
+
+##############################################################################
+#
+# has_pps - whether pin 7 is reported as PPS between the first and the last
+#           sample, otherwise it is the nRST pin throughout (relative
+#           timestamps, see parse_tracing_data_noscaling() in fl_logic.c)
+#
+##############################################################################
+def has_pps(extra_options=0):
+    return (extra_options & extraopt_relative_time) == 0
+### END has_pps()
+
+
+##############################################################################
+#
+# read_meta - reads the parameters stored by fl_logic in [filename].meta
+#             (only available if the option extraopt_no_parsing was used)
+#
+##############################################################################
+def read_meta(filename):
+    meta = {}
+    with open(filename + ".meta") as f:
+        for line in f:
+            # skip incomplete lines (file still being written by an older version of fl_logic)
+            if "=" in line and line.endswith("\n"):
+                key, value = line.split("=", 1)
+                try:
+                    meta[key.strip()] = int(value.strip(), 0)
+                except ValueError:
+                    pass
+    return meta
+### END read_meta()
+
+
+##############################################################################
+#
+# load_samples - maps the data file into memory and returns the valid samples
+#
+##############################################################################
+def load_samples(filename):
+    if os.path.getsize(filename) < 4:
+        return np.zeros(0, dtype='<u4')
+    samples = np.memmap(filename, dtype='<u4', mode='r', shape=(os.path.getsize(filename) // 4,))
+    # find the end marker (zero sample)
+    for start in range(0, len(samples), chunk_size):
+        idx = np.flatnonzero(samples[start:start + chunk_size] == 0)
+        if len(idx):
+            return samples[:start + idx[0]]
+    return samples
+### END load_samples()
+
+
+##############################################################################
+#
+# get_ticks - returns the accumulated tick counter for each sample
+#
+##############################################################################
+def get_ticks(samples):
+    ticks = np.empty(len(samples), dtype=np.uint64)
+    carry = np.uint64(0)
+    for start in range(0, len(samples), chunk_size):
+        np.cumsum(samples[start:start + chunk_size] >> 8, dtype=np.uint64, out=ticks[start:start + chunk_size])
+        ticks[start:start + chunk_size] += carry
+        carry = ticks[min(start + chunk_size, len(samples)) - 1]
+    return ticks
+### END get_ticks()
+
+
+##############################################################################
+#
+# find_edges - returns the (index, pin, state) arrays of all pin changes in
+#              a block of pin states (ordered by sample index and pin)
+#              prev: pin states of the sample preceding the block (None if
+#                    the block starts with the first sample -> all pins are
+#                    reported)
+#              last: the block ends with the last sample (-> nRST pin is
+#                    reported)
+#              pps:  pin 7 is reported as nRST for the first and last sample
+#                    and as PPS for all others (see fl_logic.c), otherwise it
+#                    is always reported as nRST (see has_pps())
+#
+##############################################################################
+def find_edges(states, prev=None, last=False, pps=True):
+    if not len(states):
+        return (np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.uint8), np.zeros(0, dtype=np.uint8))
+    before = np.empty_like(states)
+    before[1:] = states[:-1]
+    before[0]  = (~states[0] & 0xff) if prev is None else prev
+    if pps and last and (len(states) > 1 or prev is not None):
+        before[-1] = (before[-1] & 0x7f) | (~states[-1] & 0x80)     # make sure the nRST pin gets logged
+    diff    = states ^ before
+    changed = np.flatnonzero(diff)
+    bits    = np.unpackbits(diff[changed, None], axis=1, bitorder='little')
+    rows, pins = np.nonzero(bits)
+    idx     = changed[rows]
+    values  = (states[idx] >> pins) & 1
+    pins    = pins.astype(np.uint8)
+    if pps:
+        sel = (pins == nrst_pin)
+        if prev is None:
+            sel &= (idx != 0)
+        if last:
+            sel &= (idx != len(states) - 1)
+        pins[sel] = pps_pin
+    return (idx, pins, values.astype(np.uint8))
+### END find_edges()
+
+
+##############################################################################
+#
+# iter_edges - generator which returns (sample index, pin, state) arrays for
+#              all pin changes, in chunks (see find_edges())
+#
+##############################################################################
+def iter_edges(samples, pps=True):
+    prev = None
+    for start in range(0, len(samples), chunk_size):
+        states = (samples[start:start + chunk_size] & 0xff).astype(np.uint8)
+        idx, pins, values = find_edges(states, prev, start + len(states) == len(samples), pps)
+        prev = states[-1]
+        if len(idx):
+            yield (idx + start, pins, values)
+### END iter_edges()
+
+
+##############################################################################
+#
+# get_edges - returns the sample indices and states of the edges per pin
+#             as a dict {pin name: (sample indices, states)}
+#
+##############################################################################
+def get_edges(samples, names=pin_names, pps=True):
+    chunks = list(iter_edges(samples, pps))
+    if not chunks:
+        return {}
+    idx   = np.concatenate([c[0] for c in chunks])
+    pins  = np.concatenate([c[1] for c in chunks])
+    state = np.concatenate([c[2] for c in chunks])
+    edges = {}
+    for pin in np.unique(pins):
+        sel = (pins == pin)
+        edges[names[pin]] = (idx[sel], state[sel])
+    return edges
+### END get_edges()
+
+
+##############################################################################
+#
+# StreamConverter - converts the raw tracing data into one of the output
+#                   formats of gpiotrace.py (default: the CSV format of
+#                   fl_logic) while the data file is still being written
+#
+#                   update() processes the samples appended since the last
+#                   call; with piecewise time scaling, the samples are held
+#                   back until the next PPS pulse (sync point) has been
+#                   received. finish() processes the remaining samples.
+#
+##############################################################################
+class StreamConverter():
+
+    def __init__(self, filename, outputfile=None, meta=None, logger=None, output_format='csv'):
+        self.filename    = filename
+        self.outputfile  = outputfile if outputfile else filename + gpiotrace.output_formats[output_format]
+        self.meta        = meta
+        self.logger      = logger
+        self.format      = output_format
+        self.writer      = None
+        self.offset      = 0        # number of bytes read from the data file
+        self.carry       = 0        # tick counter of the last sample read
+        self.eof         = False    # end marker found?
+        self.prev_pps    = None
+        self.prev_state  = None     # pin states of the last converted sample
+        self.states      = np.zeros(0, dtype=np.uint8)    # samples not yet converted
+        self.ticks       = np.zeros(0, dtype=np.uint64)
+        self.num_samples = 0
+        self.num_lines   = 0
+        self.prev_corr   = 0.0
+
+    def _init(self):
+        if self.meta is None:
+            if not os.path.isfile(self.filename + ".meta"):
+                return False        # not yet available
+            meta = read_meta(self.filename)
+            if 'extraoptions' not in meta:
+                return False        # file is still being written
+            self.meta = meta
+        self.options       = self.meta.get('extraoptions', 0)
+        self.sampling_rate = self.meta.get('samplingrate') or get_sampling_rate(self.options)
+        self.starttime     = self.meta.get('starttime', 0)
+        self.time_offset   = self.meta.get('offset', 0)
+        self.relative      = (self.options & extraopt_relative_time) != 0
+        self.pps           = has_pps(self.options)
+        self.names         = pin_names_bb if (self.relative and (self.options & extraopt_use_bb_pinnames)) else pin_names
+        self.last_tick     = 0
+        self.last_sec      = self.starttime
+        self.writer        = gpiotrace.open_writer(self.outputfile, self.names, self.format)
+        return True
+
+    def update(self):
+        """
+        Reads and converts the samples which have been appended to the data file since the last call.
+
+        Returns:
+          int: number of lines written
+        """
+        if self.writer is None and not self._init():
+            return 0
+        if self.options & extraopt_simple_scaling:
+            return 0                # requires the complete data, conversion is done in finish()
+        num_lines = self.num_lines
+        while not self.eof:
+            count = min((os.path.getsize(self.filename) - self.offset) // 4, chunk_size)
+            if count <= 0:
+                break
+            samples = np.fromfile(self.filename, dtype='<u4', count=count, offset=self.offset)
+            zero    = np.flatnonzero(samples == 0)
+            if len(zero):
+                samples  = samples[:zero[0]]
+                self.eof = True
+            self.offset += 4 * len(samples)
+            if not len(samples):
+                break
+            ticks       = np.cumsum(samples >> 8, dtype=np.uint64) + np.uint64(self.carry)
+            self.carry  = int(ticks[-1])
+            states      = (samples & 0xff).astype(np.uint8)
+            base        = len(self.states)
+            self.states = np.concatenate((self.states, states))
+            self.ticks  = np.concatenate((self.ticks, ticks))
+            if self.relative:
+                # convert all samples but the last one (might be the last sample of the file)
+                self._convert(len(self.states) - 1, None)
+            else:
+                # rising edges of the PPS pin are the sync points
+                pps    = (states & pps_pin_bitmask) != 0
+                rising = np.flatnonzero(pps[1:] & ~pps[:-1]) + 1
+                if self.prev_pps is not None and not self.prev_pps and pps[0]:
+                    rising = np.concatenate(([0], rising))
+                self.prev_pps = pps[-1]
+                removed = 0
+                for idx in rising + base:
+                    removed += self._sync(idx - removed)
+        if self.writer:
+            self.writer.flush()
+        return self.num_lines - num_lines
+
+    def finish(self):
+        """
+        Converts the remaining samples (to be called once the data file is complete) and closes the output file.
+
+        Returns:
+          int: total number of lines written
+        """
+        self.update()
+        if self.writer is None:
+            return 0
+        if self.options & extraopt_simple_scaling:
+            self.writer.close()
+            self.num_lines = convert(self.filename, self.outputfile, meta=self.meta, logger=self.logger, output_format=self.format)
+            return self.num_lines
+        if len(self.states):
+            if self.relative:
+                self._convert(len(self.states), None, True)
+            else:
+                self._sync(len(self.states) - 1, True)
+        self.writer.close()
+        if self.logger:
+            self.logger.debug("Tracing data parsed and stored in %s (%d samples, %d lines)." % (self.outputfile, self.num_samples, self.num_lines))
+        return self.num_lines
+
+    def _sync(self, idx, end=False):
+        # sync point at pending sample idx -> determine the scaling factor and convert the samples up to idx
+        elapsed     = int(self.ticks[idx]) - self.last_tick
+        sec_elapsed = (elapsed + self.sampling_rate // 2) // self.sampling_rate
+        sec_now     = self.last_sec + sec_elapsed
+        # skip the first rising edge (may be shifted slightly due to the offset applied by the PRU)
+        if not end and self.starttime + self.time_offset >= sec_now:
+            return 0
+        corr_factor = 1.0
+        if elapsed > 0:
+            corr_factor = sec_elapsed / (elapsed / self.sampling_rate)
+        if corr_factor < (1.0 - max_time_scaling_dev) or corr_factor > (1.0 + max_time_scaling_dev):
+            if self.logger and not end:
+                self.logger.warning("Timestamp scaling failed, correction factor %.7f is out of valid range." % corr_factor)
+            corr_factor = 1.0
+        elif self.logger and self.prev_corr > 0.0 and abs(corr_factor - self.prev_corr) > max_time_scale_change:
+            self.logger.warning("Correction factor changed from %.7f to %.7f between %u and %u (lost samples?)." % (self.prev_corr, corr_factor, self.last_sec, sec_now))
+        self.prev_corr = corr_factor
+        sync_tick      = int(self.ticks[idx])
+        self._convert(idx + 1, (self.last_tick, self.last_sec, corr_factor), end or (self.eof and idx == len(self.states) - 1))
+        self.last_tick = sync_tick
+        self.last_sec  = sec_now
+        return idx + 1
+
+    def _convert(self, count, scaling, last=False):
+        # convert the first count pending samples and pass the edges to the writer
+        if count <= 0:
+            return
+        states, ticks = self.states[:count], self.ticks[:count]
+        idx, pins, values = find_edges(states, self.prev_state, last, self.pps)
+        self.prev_state   = states[-1]
+        self.states       = self.states[count:]
+        self.ticks        = self.ticks[count:]
+        self.num_samples += count
+        if not len(idx):
+            return
+        if scaling is None:
+            ts = np.round(ticks[idx] * (gpiotrace.resolution / self.sampling_rate)).astype(np.int64)
+        else:
+            base_tick, base_sec, corr_factor = scaling
+            elapsed = (ticks[idx] - np.uint64(base_tick)).astype(np.float64) / self.sampling_rate * corr_factor
+            ts      = np.floor(elapsed * gpiotrace.resolution).astype(np.int64) + base_sec * gpiotrace.resolution
+        self.writer.write(ts, pins, values)
+        self.num_lines += len(idx)
+### END StreamConverter
+
+
+##############################################################################
+#
+# EdgeDecoder - decodes a raw sample stream (e.g. a pipe) into edges with
+#               timestamps relative to the first sample (no time scaling)
+#
+##############################################################################
+class EdgeDecoder():
+
+    def __init__(self, sampling_rate=sampling_rate_high, pps=False):
+        self.sampling_rate = sampling_rate
+        self.pps           = pps        # relative timestamps -> pin 7 is nRST by default (see has_pps())
+        self.buf           = b""        # incomplete sample
+        self.carry         = 0
+        self.prev          = None
+        self.eof           = False
+        self.timestamp     = 0.0        # timestamp of the last decoded sample
+
+    def feed(self, data):
+        """
+        Decodes the given bytes.
+
+        Returns:
+          tuple: (timestamps in seconds, pins, states) arrays of the pin changes
+        """
+        if self.buf:
+            data = self.buf + data
+        count    = len(data) // 4
+        self.buf = data[4 * count:]
+        if self.eof or not count:
+            return (np.zeros(0), np.zeros(0, dtype=np.uint8), np.zeros(0, dtype=np.uint8))
+        samples = np.frombuffer(data, dtype='<u4', count=count)
+        zero    = np.flatnonzero(samples == 0)
+        if len(zero):
+            samples  = samples[:zero[0]]
+            self.eof = True
+            if not len(samples):
+                return (np.zeros(0), np.zeros(0, dtype=np.uint8), np.zeros(0, dtype=np.uint8))
+        ticks      = np.cumsum(samples >> 8, dtype=np.uint64) + np.uint64(self.carry)
+        self.carry = int(ticks[-1])
+        states     = (samples & 0xff).astype(np.uint8)
+        idx, pins, values = find_edges(states, self.prev, self.eof, self.pps)
+        self.prev      = states[-1]
+        self.timestamp = self.carry / self.sampling_rate
+        return (ticks[idx] / self.sampling_rate, pins, values)
+### END EdgeDecoder
+
+
+##############################################################################
+#
+# convert - converts the raw tracing data into one of the output formats of
+#           gpiotrace.py (parameters are read from [filename].meta if not
+#           provided)
+#
+##############################################################################
+def convert(filename, outputfile=None, meta=None, logger=None, output_format='csv'):
+    if meta is None:
+        meta = read_meta(filename)
+    if not outputfile:
+        outputfile = filename + gpiotrace.output_formats[output_format]
+    extra_options = meta.get('extraoptions', 0)
+    if not (extra_options & extraopt_simple_scaling) or (extra_options & extraopt_relative_time):
+        converter = StreamConverter(filename, outputfile, meta, logger, output_format)
+        converter.update()
+        return converter.finish()
+    # simple scaling: one correction factor based on the first and last sample with nRST=1 and nRST=0
+    starttime     = meta.get('starttime', 0)
+    stoptime      = meta.get('stoptime', 0)
+    sampling_rate = meta.get('samplingrate') or get_sampling_rate(extra_options)
+    samples       = load_samples(filename)
+    num_lines     = 0
+    writer        = gpiotrace.open_writer(outputfile, pin_names, output_format)
+    try:
+        if not len(samples):
+            return 0
+        ticks       = get_ticks(samples)
+        nrst        = (samples & pps_pin_bitmask) != 0
+        start_tick  = int(ticks[np.argmax(nrst)]) if np.any(nrst) else 0
+        end_tick    = int(ticks[len(nrst) - 1 - np.argmax(~nrst[::-1])]) if np.any(~nrst) else 0
+        corr_factor = ((stoptime - starttime) + 1.0) / max(0.000001, (end_tick - start_tick) / sampling_rate)
+        if corr_factor < (1.0 - max_time_scaling_dev) or corr_factor > (1.0 + max_time_scaling_dev):
+            if logger:
+                logger.warning("Timestamp scaling failed, correction factor %.7f is out of valid range." % corr_factor)
+            corr_factor = 1.0
+        for idx, pins, values in iter_edges(samples, has_pps(extra_options)):
+            ts = np.floor(ticks[idx] / sampling_rate * corr_factor * gpiotrace.resolution).astype(np.int64) + starttime * gpiotrace.resolution
+            writer.write(ts, pins, values)
+            num_lines += len(idx)
+    finally:
+        writer.close()
+    if logger:
+        logger.debug("Tracing data parsed and stored in %s (%d samples, %d lines)." % (outputfile, len(samples), num_lines))
+    return num_lines
+### END convert()
+
+
+##############################################################################
+#
+# convert_to_csv - converts the raw tracing data into the CSV format of fl_logic
+#
+##############################################################################
+def convert_to_csv(filename, outputfile=None, meta=None, logger=None):
+    return convert(filename, outputfile, meta, logger, 'csv')
+### END convert_to_csv()
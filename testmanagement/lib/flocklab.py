@@ -40,7 +40,7 @@ Author: Reto Da Forno
 ##############################################################################
 
 # needed imports:
-import sys, os, errno, signal, time, configparser, logging, logging.config, subprocess, traceback, glob, shutil, smbus, re
+import sys, os, errno, signal, time, configparser, logging, logging.config, subprocess, traceback, glob, shutil, smbus, re, json, struct, math
 import io, fcntl      # required for I2C I/O
 
 
@@ -108,7 +108,12 @@ tg_baud_rates   = [9600, 19200, 38400, 57600, 115200, 230400, 460800, 921600, 10
 rl_max_rate     = 64000
 rl_default_rate = 1000
 rl_samp_rates   = [1, 10, 100, 1000, 2000, 4000, 8000, 16000, 32000, 64000]
-rl_max_samples  = 100000000
+rl_sample_size  = 20            # bytes per sample in the data file (4 channels + digital channels)
+rl_file_size    = 1000000000    # max. size of a data file segment, the RocketLogger continues in a new file (_p1, _p2, ...)
+rl_disk_reserve = 200000000     # free space in bytes to keep on the SD card
+rl_write_margin = 4.0           # min. ratio of the SD card write throughput to the data rate
+rl_window_lead  = 3             # capture windows: the RocketLogger is started this many seconds ahead of a window
+rl_window_gap   = 5             # capture windows: min. gap in seconds between two windows (time to finish, restart and sync the RocketLogger)
 rl_time_offset  = -0.0037       # rocketlogger is about ~3.7ms behind the actual time
 max_act_events  = 8192          # max. number of actuation events
 i2c_bus         = 2             # I2C2 is used to control the DAC and read the SHT31 sensor
@@ -122,6 +127,15 @@ gmtimerstats = '/sys/devices/platform/ocp/ocp:pps_gmtimer/stats'
 tracinglog   = '/home/flocklab/log/fl_logic.log'
 rllog        = '/home/flocklab/log/rocketlogger.log'
 gdblog       = '/home/flocklab/log/jlinkgdb.log'
+timesynccache  = '/tmp/flocklab_timesync.json'      # latest time sync status, maintained by the timesync monitor
+timesynctarget = '/tmp/flocklab_timesync.target'    # holds the name of the file the timesync monitor logs to (if any)
+
+# time sync series: magic string followed by one record per sample
+# (time, PPS count, adjusted offset of the time source, system clock offset, frequency error in ppm, skew in ppm, estimated error)
+timesync_magic  = b"FLTSY1\n"
+timesync_record = struct.Struct("<dIfffff")
+timesync_fields = ('time', 'pps_count', 'adjusted_offset', 'system_offset', 'frequency', 'skew', 'error')
+sdthroughput = '/home/flocklab/data/sdcard_throughput'   # cached SD card write throughput
 scriptname   = os.path.basename(os.path.abspath(sys.argv[0]))   # name of caller script
 
 # constants
@@ -279,16 +293,11 @@ def log_test_error(testid=None, msg=None):
 def log_timesync_info(testid=None, includepps=False):
     if testid and os.path.isdir("%s/%d" % (config.get("observer", "testresultfolder"), testid)):
         timesynclogfile = "%s/%d/timesync_%s.log" % (config.get("observer", "testresultfolder"), testid, time.strftime("%Y%m%d%H%M%S", time.gmtime()))
-        p = subprocess.Popen(['chronyc', 'sources'], stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
-        out, err = p.communicate(None)
-        if (p.returncode == 0):
-            lines = out.split('\n')
-            for line in lines:
-                res = re.match("^[#^]{1}\*\s+([a-zA-Z0-9.-_]+)[0-9\s]+([+-]{1}[0-9a-z]+)\[\s*([+-]{1}[0-9a-z]+)\]\s+(\+/\-[0-9a-z\s]*)$", line)
-                if res:
-                    with open(timesynclogfile, "a") as tslog:
-                        tslog.write("%s,time source: %s | adjusted offset: %s | measured offset: %s | estimated error: %s\n" % (str(time.time()), res.group(1), res.group(2), res.group(3), res.group(4)))
-                    break;
+        status = get_timesync_status()
+        if status:
+            if status['source']:
+                with open(timesynclogfile, "a") as tslog:
+                    tslog.write("%s,time source: %s | adjusted offset: %+dns | measured offset: %+dns | estimated error: +/- %dns\n" % (str(time.time()), status['source'], int(status['adjusted_offset'] * 1e9), int(status['measured_offset'] * 1e9), int(status['error'] * 1e9)))
         else:
             log_test_error(testid=testid, msg="Failed to query time source.")
         
@@ -862,22 +871,135 @@ def program_target(filename=None, platform=None, core=0, debug=False):
 ### END program_target()
 
 
+##############################################################################
+#
+# get_sd_write_throughput - returns the sustained write throughput of the SD
+#                           card in bytes per second (measured once, then cached)
+#
+##############################################################################
+def get_sd_write_throughput(path=None, size=32000000):
+    try:
+        with open(sdthroughput, "r") as f:
+            return float(f.read().strip())
+    except:
+        pass
+    if not path:
+        path = config.get("observer", "testresultfolder")
+    testfile = "%s/.sdcard_throughput_test" % path
+    try:
+        chunk = os.urandom(1000000)
+        t_start = time.time()
+        with open(testfile, "wb") as f:
+            for i in range(size // len(chunk)):
+                f.write(chunk)
+            f.flush()
+            os.fsync(f.fileno())
+        throughput = (size // len(chunk)) * len(chunk) / (time.time() - t_start)
+        with open(sdthroughput, "w") as f:
+            f.write("%.0f\n" % throughput)
+        return throughput
+    except:
+        if logger:
+            logger.warning("Failed to measure the SD card write throughput: %s, %s" % (str(sys.exc_info()[0]), str(sys.exc_info()[1])))
+        return None
+    finally:
+        if os.path.isfile(testfile):
+            os.remove(testfile)
+### END get_sd_write_throughput()
+
+
+##############################################################################
+#
+# plan_pwr_measurement - chooses the sampling rate, aggregation, sample count
+#                        and file segmentation of a power measurement
+#
+# The highest supported rate not above the requested one is used for which the
+# SD card can sustain the data rate and the data of the whole test fits onto
+# the SD card. Data exceeding rl_file_size is continued in a new file segment.
+# Only if even the lowest rate does not fit, the measurement is truncated.
+#
+##############################################################################
+def plan_pwr_measurement(duration, sampling_rate=rl_default_rate, out_dir=None):
+    if not out_dir:
+        out_dir = config.get("observer", "testresultfolder")
+    st = os.statvfs(out_dir)
+    diskfree = max(st.f_bavail * st.f_frsize - rl_disk_reserve, 0)
+    throughput = get_sd_write_throughput(out_dir)
+    plan = { 'duration': duration, 'requested_rate': sampling_rate, 'disk_free': diskfree, 'write_throughput': throughput, 'truncated': False, 'notes': [] }
+    # data size of a measurement: samples, one timestamp block (32 bytes) per second and a header per segment
+    datasize = lambda samples, rate: samples * rl_sample_size + (samples // rate + 1) * 32 + (samples * rl_sample_size // rl_file_size + 1) * 1000
+    rates = [r for r in rl_samp_rates if r <= sampling_rate] or [rl_samp_rates[0]]
+    if sampling_rate not in rl_samp_rates:
+        plan['notes'].append("sampling rate %s not supported, using %dHz" % (str(sampling_rate), rates[-1]))
+    rate = None
+    for r in reversed(rates):
+        if throughput and r * rl_sample_size * rl_write_margin > throughput:
+            continue
+        rate = r
+        if datasize((duration + 1) * r, r) <= diskfree:
+            break
+    if rate is None:
+        rate = rates[0]
+        plan['notes'].append("SD card write throughput too low for the requested sampling rate")
+    if rate < rates[-1]:
+        plan['notes'].append("sampling rate reduced from %dHz to %dHz" % (rates[-1], rate))
+    num_samples = (duration + 1) * rate
+    if datasize(num_samples, rate) > diskfree:
+        num_samples = max(int(diskfree / (rl_sample_size * 1.01)), rate)
+        plan['truncated'] = True
+        plan['notes'].append("not enough free disk space, measurement truncated to %ds" % (num_samples // rate))
+    plan['rate']        = rate
+    plan['aggregation'] = "average" if rate < 1000 else None    # rates below the lowest ADC rate of 1kHz are aggregated
+    plan['num_samples'] = num_samples
+    plan['data_size']   = datasize(num_samples, rate)
+    plan['file_size']   = rl_file_size
+    plan['segments']    = plan['data_size'] // rl_file_size + 1
+    return plan
+### END plan_pwr_measurement()
+
+
+##############################################################################
+#
+# get_pwr_capture_windows - converts a list of [start, stop] intervals (UNIX
+#                           timestamps) into a list of [tstart, duration] power
+#                           capture windows
+#
+# The RocketLogger starts sampling at a full second only and needs some time
+# to restart, therefore each interval is extended by the margin, the start is
+# aligned to the second and windows closer than rl_window_gap are merged.
+#
+##############################################################################
+def get_pwr_capture_windows(intervals=[], margin=0.001):
+    windows = []
+    for start, stop in sorted(intervals):
+        tstart = int(start - margin)
+        tstop  = stop + margin
+        if windows and tstart <= windows[-1][0] + windows[-1][1] + rl_window_gap:
+            windows[-1][1] = max(windows[-1][1], tstop - windows[-1][0])
+        else:
+            windows.append([tstart, tstop - tstart])
+    return windows
+### END get_pwr_capture_windows()
+
+
 ##############################################################################
 #
 # start_pwr_measurement
 #
 ##############################################################################
-def start_pwr_measurement(out_file=None, sampling_rate=rl_default_rate, num_samples=0, start_time=0):
+def start_pwr_measurement(out_file=None, sampling_rate=rl_default_rate, num_samples=0, start_time=0, aggregation=None, file_size=rl_file_size):
     if sampling_rate not in rl_samp_rates:
         if logger:
             logger.warn("Invalid sampling rate '%s'" % str(sampling_rate))
         return errno.EINVAL
     if not out_file:
         out_file = "%s/powerprofiling_%s.rld" % (config.get("observer", "testresultfolder"), time.strftime("%Y%m%d%H%M%S", time.gmtime()))
-    cmd = ["rocketlogger", "start", "-b", "--channel=V1,V2,I1L,I1H", "--output=%s" % out_file, "--rate=%d" % int(sampling_rate), "--offset=%f" % rl_time_offset, "--web=0", "--digital=0"] #, "--aggregate=average"]
+    cmd = ["rocketlogger", "start", "-b", "--channel=V1,V2,I1L,I1H", "--output=%s" % out_file, "--rate=%d" % int(sampling_rate), "--offset=%f" % rl_time_offset, "--web=0", "--digital=0"]
+    if aggregation:
+        cmd.append("--aggregate=%s" % aggregation)
+    if file_size:
+        cmd.append("--size=%d" % int(file_size))
     if num_samples:
-        if num_samples > rl_max_samples:
-            num_samples = rl_max_samples
         cmd.append(("--samples=%d" % int(num_samples)))
     if start_time > 0:
         cmd.append(("--tstart=%d" % int(start_time)))
@@ -1065,6 +1187,120 @@ def stop_gpio_tracing(timeout=30):
 ### END stop_gpio_tracing()
 
 
+##############################################################################
+#
+# start_gpio_converter
+#
+##############################################################################
+def start_gpio_converter(infile=None, outfile=None, debug=False, outputformat=None):
+    if not infile or not config:
+        return FAILED
+    cmd = [config.get("observer", "gpioconverter"), '--input=%s' % infile]
+    if outfile:
+        cmd.append('--output=%s' % outfile)
+    if outputformat:
+        cmd.append('--format=%s' % outputformat)
+    if debug:
+        cmd.append('--debug')
+    p = subprocess.Popen(cmd)
+    rs = p.wait()
+    if rs != SUCCESS:
+        return FAILED
+    return SUCCESS
+### END start_gpio_converter()
+
+
+##############################################################################
+#
+# stop_gpio_converter
+#
+##############################################################################
+def stop_gpio_converter():
+    if not config:
+        return FAILED
+    cmd = [config.get("observer", "gpioconverter"), '--stop']
+    p = subprocess.Popen(cmd)
+    rs = p.wait()
+    if rs not in (SUCCESS, errno.ENOPKG):
+        return FAILED
+    return SUCCESS
+### END stop_gpio_converter()
+
+
+##############################################################################
+#
+# start_energy_monitor
+#
+##############################################################################
+def start_energy_monitor(infile=None, gpiofile=None, debug=False):
+    if not infile or not config:
+        return FAILED
+    cmd = [config.get("observer", "energymonitor"), '--input=%s' % infile]
+    if gpiofile:
+        cmd.append('--gpio=%s' % gpiofile)
+    if debug:
+        cmd.append('--debug')
+    p = subprocess.Popen(cmd)
+    rs = p.wait()
+    if rs != SUCCESS:
+        return FAILED
+    return SUCCESS
+### END start_energy_monitor()
+
+
+##############################################################################
+#
+# stop_energy_monitor
+#
+##############################################################################
+def stop_energy_monitor():
+    if not config:
+        return FAILED
+    cmd = [config.get("observer", "energymonitor"), '--stop']
+    p = subprocess.Popen(cmd)
+    rs = p.wait()
+    if rs not in (SUCCESS, errno.ENOPKG):
+        return FAILED
+    return SUCCESS
+### END stop_energy_monitor()
+
+
+##############################################################################
+#
+# start_pwr_scheduler
+#
+##############################################################################
+def start_pwr_scheduler(planfile=None, debug=False):
+    if not planfile or not config:
+        return FAILED
+    cmd = [config.get("observer", "powerscheduler"), '--input=%s' % planfile]
+    if debug:
+        cmd.append('--debug')
+    p = subprocess.Popen(cmd)
+    rs = p.wait()
+    if rs != SUCCESS:
+        return FAILED
+    return SUCCESS
+### END start_pwr_scheduler()
+
+
+##############################################################################
+#
+# stop_pwr_scheduler
+#
+##############################################################################
+def stop_pwr_scheduler():
+    if not config:
+        return FAILED
+    cmd = [config.get("observer", "powerscheduler"), '--stop']
+    p = subprocess.Popen(cmd)
+    rs = p.wait()
+    if rs not in (SUCCESS, errno.ENOPKG):
+        return FAILED
+    return SUCCESS
+### END stop_pwr_scheduler()
+
+
 ##############################################################################
 #
 # start_gpio_actuation
@@ -1223,7 +1459,7 @@ def stop_data_trace():
 # start_swo_logger
 #
 ##############################################################################
-def start_swo_logger(platform=None, outputfile=None, cpuspeed=None, swospeed=None, debug=False):
+def start_swo_logger(platform=None, outputfile=None, cpuspeed=None, swospeed=None, debug=False, textports=None, binports=None):
     if not platform or not outputfile or not config:
         return FAILED
     # note: MUX must be enabled for this to work
@@ -1232,6 +1468,10 @@ def start_swo_logger(platform=None, outputfile=None, cpuspeed=None, swospeed=Non
         cmd.append('--cpuspeed=%d' % parse_int(cpuspeed))
     if swospeed:
         cmd.append('--swospeed=%d' % parse_int(swospeed))
+    if textports is not None:
+        cmd.append('--textports=0x%x' % textports)
+    if binports is not None:
+        cmd.append('--binports=0x%x' % binports)
     if debug:
         cmd.append('--debug')
     p = subprocess.Popen(cmd)
@@ -1352,19 +1592,190 @@ def parse_float(s):
 #
 ##############################################################################
 def get_timesync_method():
-    p = subprocess.Popen(['chronyc', 'sources'], stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
-    out, err = p.communicate(None)
-    if p.returncode == 0:
-        lines = out.split('\n')
-        for line in lines:
-            if "* PTP" in line:
-                return "PTP"
-            elif "* PPS" in line:
-                return "GPS"
+    status = get_timesync_status()
+    if status:
+        if status['source'] == "PTP":
+            return "PTP"
+        elif status['source'] == "PPS":
+            return "GPS"
     return "NTP"
 ### END get_timesync_method
 
 
+##############################################################################
+#
+# query_chronyc()   runs a chronyc command with CSV output, returns the output
+#                   or None on failure or timeout
+#
+##############################################################################
+def query_chronyc(cmd, timeout=5):
+    try:
+        p = subprocess.Popen(['chronyc', '-c', cmd], stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+        out, err = p.communicate(None, timeout)
+    except subprocess.TimeoutExpired:
+        p.kill()
+        p.communicate()
+        return None
+    except OSError:
+        return None
+    if p.returncode != 0:
+        return None
+    return out
+### END query_chronyc
+
+
+##############################################################################
+#
+# query_timesync_status()   queries the selected time source from chronyd,
+#                           returns a dict (source is None if no source is
+#                           selected) or None on failure, with tracking set the
+#                           clock offset, frequency error and PPS count are
+#                           included as well
+#
+##############################################################################
+def query_timesync_status(timeout=5, tracking=False):
+    out = query_chronyc('sources', timeout)
+    if out is None:
+        return None
+    status = { 'time': time.time(), 'source': None, 'stratum': None, 'reach': None, 'adjusted_offset': None, 'measured_offset': None, 'error': None }
+    if tracking:
+        # CSV format: ref ID,ref name,stratum,ref time,system time offset,last offset,RMS offset,frequency,residual frequency,skew,...
+        status.update({ 'system_offset': None, 'frequency': None, 'skew': None, 'pps_count': None })
+        fields = (query_chronyc('tracking', timeout) or "").strip().split(',')
+        if len(fields) >= 10:
+            status['system_offset'] = float(fields[4])     # positive: system clock is behind
+            status['frequency']     = float(fields[7])     # positive: system clock is slow
+            status['skew']          = float(fields[9])
+        ppscount = get_pps_count()
+        if ppscount not in (None, FAILED):
+            status['pps_count'] = int(ppscount)
+    # CSV format: mode,state,name,stratum,poll,reach,last rx,adjusted offset,measured offset,error
+    for line in out.split('\n'):
+        fields = line.split(',')
+        if len(fields) >= 10 and fields[1] == '*':
+            status['source']          = fields[2]
+            status['stratum']         = int(fields[3])
+            status['reach']           = int(fields[5], 8)
+            status['adjusted_offset'] = float(fields[7])
+            status['measured_offset'] = float(fields[8])
+            status['error']           = float(fields[9])
+            break
+    return status
+### END query_timesync_status
+
+
+##############################################################################
+#
+# get_timesync_status()   returns the cached time sync status of the timesync
+#                         monitor, or queries chronyd if the cache is outdated
+#
+##############################################################################
+def get_timesync_status(maxage=60):
+    try:
+        with open(timesynccache, "r") as f:
+            status = json.load(f)
+        if abs(time.time() - status['time']) <= maxage:
+            return status
+    except:
+        pass
+    return query_timesync_status()
+### END get_timesync_status
+
+
+##############################################################################
+#
+# start_timesync_monitor   starts the timesync monitor (if not yet running)
+#                          the monitor stays resident across tests (the cached
+#                          status is used outside of tests as well), it is not
+#                          stopped by the test scripts (use --stop to stop it)
+#
+##############################################################################
+def start_timesync_monitor(debug=False):
+    if not config:
+        return FAILED
+    if get_pid(os.path.basename(config.get("observer", "timesyncmonitor"))) > 0:
+        return SUCCESS
+    cmd = [config.get("observer", "timesyncmonitor")]
+    if debug:
+        cmd.append('--debug')
+    p = subprocess.Popen(cmd)
+    rs = p.wait()
+    if rs != SUCCESS:
+        return FAILED
+    return SUCCESS
+### END start_timesync_monitor()
+
+
+##############################################################################
+#
+# start_timesync_log   lets the timesync monitor log the time sync status
+#                      of the test into the test results directory
+#
+##############################################################################
+def start_timesync_log(testid=None):
+    if not testid:
+        return FAILED
+    logfile = "%s/%d/timesync_%s.dat" % (config.get("observer", "testresultfolder"), testid, time.strftime("%Y%m%d%H%M%S", time.gmtime()))
+    with open(timesynctarget, "w") as f:
+        f.write(logfile)
+    return SUCCESS
+### END start_timesync_log()
+
+
+##############################################################################
+#
+# stop_timesync_log
+#
+##############################################################################
+def stop_timesync_log():
+    if os.path.isfile(timesynctarget):
+        os.remove(timesynctarget)
+    return SUCCESS
+### END stop_timesync_log()
+
+
+##############################################################################
+#
+# append_timesync_record   appends a time sync status to a series file
+#
+##############################################################################
+def append_timesync_record(filename, status):
+    nan = float('nan')
+    value = lambda key: status.get(key) if status.get(key) is not None else nan
+    with open(filename, "ab") as f:
+        if f.tell() == 0:
+            f.write(timesync_magic)
+        f.write(timesync_record.pack(status['time'], status['pps_count'] if status.get('pps_count') is not None else 0xffffffff,
+                                     value('adjusted_offset'), value('system_offset'), value('frequency'), value('skew'), value('error')))
+### END append_timesync_record()
+
+
+##############################################################################
+#
+# read_timesync_series   reads a time sync series file, returns a list of
+#                        dicts (missing values are None)
+#
+##############################################################################
+def read_timesync_series(filename):
+    with open(filename, "rb") as f:
+        data = f.read()
+    if not data.startswith(timesync_magic):
+        raise ValueError("%s is not a time sync series file" % filename)
+    series = []
+    start  = len(timesync_magic)
+    count  = (len(data) - start) // timesync_record.size    # ignore an incomplete last record
+    for record in timesync_record.iter_unpack(data[start:start + count * timesync_record.size]):
+        sample = dict(zip(timesync_fields, record))
+        for key in timesync_fields[2:]:
+            if math.isnan(sample[key]):
+                sample[key] = None
+        if sample['pps_count'] == 0xffffffff:
+            sample['pps_count'] = None
+        series.append(sample)
+    return series
+### END read_timesync_series()
+
+
 ##############################################################################
 #
 # get_default_serialport()   returns the default serial port of a platform
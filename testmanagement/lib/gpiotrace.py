@@ -0,0 +1,254 @@
+"""
+Copyright (c) 2020, ETH Zurich, Computer Engineering Group
+All rights reserved.
+
+Redistribution and use in source and binary forms, with or without
+modification, are permitted provided that the following conditions are met:
+
+* Redistributions of source code must retain the above copyright notice, this
+  list of conditions and the following disclaimer.
+
+* Redistributions in binary form must reproduce the above copyright notice,
+  this list of conditions and the following disclaimer in the documentation
+  and/or other materials provided with the distribution.
+
+* Neither the name of the copyright holder nor the names of its
+  contributors may be used to endorse or promote products derived from
+  this software without specific prior written permission.
+
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+POSSIBILITY OF SUCH DAMAGE.
+
+"""
+
+"""
+    GPIO trace output formats
+
+    csv:      one text line per edge (timestamp,pin,value), timestamps in seconds with 7 decimal places
+
+    columnar: the magic line below, followed by a text line with the timestamp resolution (ticks per second)
+              and the pin names (space separated), followed by a sequence of blocks:
+                  u8  pin index
+                  u8  flags (see block_flag_*)
+                  u16 reserved
+                  u32 number of edges
+                  i64 timestamp of the first edge in ticks
+                  u32 payload size in bytes
+                  payload (zlib compressed if block_flag_zlib is set):
+                      timestamp deltas to the previous edge (number of edges - 1 values, u32 or u64)
+                      edge values, one bit per edge (LSB first)
+              Each block contains the edges of one pin only. All integers are little endian.
+"""
+import struct
+import zlib
+import numpy as np
+
+
+file_magic         = b"FLGPIO1\n"
+block_header       = struct.Struct("<BBHIqI")
+block_flag_zlib    = 0x01
+block_flag_delta64 = 0x02
+resolution         = 10000000      # ticks per second (100ns, same as the csv format)
+block_size         = 65536         # max. number of edges per block
+zlib_level         = 1
+
+output_formats     = { 'csv': ".csv", 'columnar': ".gpiotrace" }
+
+
+##############################################################################
+#
+# CsvWriter - writes the edges in the csv format
+#
+##############################################################################
+class CsvWriter():
+
+    def __init__(self, filename, names):
+        self.file  = open(filename, "w")
+        self.names = names
+
+    def write(self, timestamps, pins, values):
+        names = self.names
+        self.file.write("".join(["%d.%07d,%s,%u\n" % (sec, frac, names[p], v) for sec, frac, p, v in zip(timestamps // resolution, timestamps % resolution, pins, values)]))
+
+    def flush(self):
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+### END CsvWriter
+
+
+##############################################################################
+#
+# ColumnarWriter - collects the edges per pin and writes them in blocks
+#
+##############################################################################
+class ColumnarWriter():
+
+    def __init__(self, filename, names, compress=True):
+        self.file     = open(filename, "wb")
+        self.names    = names
+        self.compress = compress
+        self.pending  = [[] for i in range(len(names))]     # list of (timestamps, values) array tuples per pin
+        self.counts   = [0] * len(names)
+        self.file.write(file_magic)
+        self.file.write(("%d %s\n" % (resolution, " ".join(names))).encode())
+
+    def write(self, timestamps, pins, values):
+        for pin in np.unique(pins):
+            sel = (pins == pin)
+            self.pending[pin].append((timestamps[sel], values[sel]))
+            self.counts[pin] += np.count_nonzero(sel)
+            if self.counts[pin] >= block_size:
+                self._write_blocks(pin)
+
+    def flush(self):
+        self.file.flush()
+
+    def close(self):
+        for pin in range(len(self.names)):
+            self._write_blocks(pin)
+        self.file.close()
+
+    def _write_blocks(self, pin):
+        if not self.counts[pin]:
+            return
+        timestamps = np.concatenate([p[0] for p in self.pending[pin]]).astype(np.int64)
+        values     = np.concatenate([p[1] for p in self.pending[pin]]).astype(np.uint8)
+        self.pending[pin] = []
+        self.counts[pin]  = 0
+        for start in range(0, len(timestamps), block_size):
+            self._write_block(pin, timestamps[start:start + block_size], values[start:start + block_size])
+
+    def _write_block(self, pin, timestamps, values):
+        flags  = 0
+        deltas = np.diff(timestamps)
+        if len(deltas) and deltas.max() > 0xffffffff:
+            flags |= block_flag_delta64
+            deltas = deltas.astype('<u8')
+        else:
+            deltas = deltas.astype('<u4')
+        payload = deltas.tobytes() + np.packbits(values & 1, bitorder='little').tobytes()
+        if self.compress:
+            flags  |= block_flag_zlib
+            payload = zlib.compress(payload, zlib_level)
+        self.file.write(block_header.pack(pin, flags, 0, len(timestamps), int(timestamps[0]), len(payload)))
+        self.file.write(payload)
+### END ColumnarWriter
+
+
+##############################################################################
+#
+# open_writer - returns a writer for the given output format
+#
+##############################################################################
+def open_writer(filename, names, output_format='csv', compress=True):
+    if output_format == 'csv':
+        return CsvWriter(filename, names)
+    if output_format == 'columnar':
+        return ColumnarWriter(filename, names, compress)
+    raise ValueError("unknown output format '%s'" % output_format)
+### END open_writer()
+
+
+##############################################################################
+#
+# is_columnar - checks whether a file is in the columnar format
+#
+##############################################################################
+def is_columnar(filename):
+    try:
+        with open(filename, "rb") as f:
+            return f.read(len(file_magic)) == file_magic
+    except IOError:
+        return False
+### END is_columnar()
+
+
+##############################################################################
+#
+# iter_blocks - generator which returns (pin index, timestamps, values)
+#               tuples for all complete blocks of an open file positioned
+#               at the start of a block
+#
+##############################################################################
+def iter_blocks(f):
+    while True:
+        hdr = f.read(block_header.size)
+        if len(hdr) < block_header.size:
+            break
+        pin, flags, reserved, count, first, size = block_header.unpack(hdr)
+        payload = f.read(size)
+        if len(payload) < size:
+            break       # truncated block
+        if flags & block_flag_zlib:
+            payload = zlib.decompress(payload)
+        dtype      = '<u8' if flags & block_flag_delta64 else '<u4'
+        deltas     = np.frombuffer(payload, dtype=dtype, count=count - 1)
+        values     = np.unpackbits(np.frombuffer(payload, dtype=np.uint8, offset=deltas.nbytes), count=count, bitorder='little')
+        timestamps = np.empty(count, dtype=np.int64)
+        timestamps[0] = first
+        np.cumsum(deltas, dtype=np.int64, out=timestamps[1:])
+        timestamps[1:] += first
+        yield (pin, timestamps, values)
+### END iter_blocks()
+
+
+##############################################################################
+#
+# read_trace - reads a file in the columnar format and returns the edges per
+#              pin as a dict {pin name: (timestamps in seconds, values)}
+#              (raw=True returns the timestamps in ticks, see resolution)
+#
+##############################################################################
+def read_trace(filename, raw=False):
+    with open(filename, "rb") as f:
+        if f.read(len(file_magic)) != file_magic:
+            raise ValueError("%s is not a columnar GPIO trace file" % filename)
+        fields = f.readline().decode().split()
+        res    = int(fields[0])
+        names  = fields[1:]
+        blocks = {}
+        for pin, timestamps, values in iter_blocks(f):
+            blocks.setdefault(pin, []).append((timestamps, values))
+    edges = {}
+    for pin in sorted(blocks):
+        timestamps = np.concatenate([b[0] for b in blocks[pin]])
+        values     = np.concatenate([b[1] for b in blocks[pin]])
+        edges[names[pin]] = (timestamps if raw else timestamps / res, values)
+    return edges
+### END read_trace()
+
+
+##############################################################################
+#
+# to_csv - exports a file in the columnar format to the csv format
+#
+##############################################################################
+def to_csv(filename, outputfile=None):
+    if not outputfile:
+        outputfile = filename + ".csv"
+    edges = read_trace(filename, raw=True)
+    names = list(edges.keys())
+    if edges:
+        timestamps = np.concatenate([edges[n][0] for n in names])
+        values     = np.concatenate([edges[n][1] for n in names])
+        pins       = np.concatenate([np.full(len(edges[n][0]), i, dtype=np.uint8) for i, n in enumerate(names)])
+        order      = np.argsort(timestamps, kind='stable')   # edges with the same timestamp remain ordered by pin
+    writer = CsvWriter(outputfile, names)
+    if edges:
+        for start in range(0, len(order), block_size):
+            sel = order[start:start + block_size]
+            writer.write(timestamps[sel], pins[sel], values[sel])
+    writer.close()
+    return len(order) if edges else 0
+### END to_csv()
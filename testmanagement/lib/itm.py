@@ -0,0 +1,318 @@
+"""
+Copyright (c) 2020, ETH Zurich, Computer Engineering Group
+All rights reserved.
+
+Redistribution and use in source and binary forms, with or without
+modification, are permitted provided that the following conditions are met:
+
+* Redistributions of source code must retain the above copyright notice, this
+  list of conditions and the following disclaimer.
+
+* Redistributions in binary form must reproduce the above copyright notice,
+  this list of conditions and the following disclaimer in the documentation
+  and/or other materials provided with the distribution.
+
+* Neither the name of the copyright holder nor the names of its
+  contributors may be used to endorse or promote products derived from
+  this software without specific prior written permission.
+
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+POSSIBILITY OF SUCH DAMAGE.
+
+"""
+
+
+"""
+    ITM/DWT packet decoder for SWO data and capture files (see lib/swo.py)
+
+    StimulusDecoder extracts the data written to the ITM stimulus ports (software trace).
+    DataTraceDecoder decodes the data trace packets of the DWT comparators (configured by
+    dwt.config_dwt_for_data_trace()) and the ITM local timestamp packets into a NumPy structured array.
+    The global time of each record is reconstructed from the readout timestamps of the frames (anchors),
+    i.e. by a linear fit of the local timestamps to the global time.
+    The decoder works incrementally: update() decodes the frames appended to the file since the last call.
+"""
+import os
+import numpy as np
+import lib.swo as swo
+
+
+record_dtype = np.dtype([('comparator', 'u1'),     # comparator index
+                         ('write',      '?'),      # True for write access, False for read access
+                         ('value',      'i8'),     # data value (-1 if only the PC was traced)
+                         ('pc',         'i8'),     # program counter (-1 if not traced)
+                         ('local_ts',   'u8'),     # local timestamp (accumulated, in prescaled CPU cycles)
+                         ('global_ts',  'f8')])    # reconstructed global time in seconds (UNIX time, NaN if unknown)
+
+payload_size = (0, 1, 2, 4)
+
+
+##############################################################################
+#
+# ItmPacketParser - splits the SWO byte stream into ITM/DWT packets
+#                   (derived classes implement the packet handlers)
+#
+##############################################################################
+class ItmPacketParser():
+
+    def __init__(self):
+        self.zeros          = 0              # number of consecutive zero bytes (sync detection)
+        self.hdr            = 0              # header of the current packet
+        self.need           = 0              # number of payload bytes still missing (source packets)
+        self.cont           = False          # expecting a continuation byte (timestamp and extension packets)
+        self.val            = 0
+        self.shift          = 0
+        self.num_overflows  = 0
+        self.num_syncs      = 0
+
+    def _feed(self, data):
+        for b in data:
+            if self.need:                   # payload byte of a source packet (little endian)
+                self.val   |= b << self.shift
+                self.shift += 8
+                self.need  -= 1
+                if not self.need:
+                    self._source_packet(self.hdr, self.val)
+                continue
+            if self.cont:                   # continuation byte of a timestamp or extension packet
+                self.val   |= (b & 0x7f) << self.shift
+                self.shift += 7
+                if not (b & 0x80):
+                    self.cont = False
+                    if (self.hdr & 0xcf) == 0xc0:
+                        self._local_timestamp(self.val)
+                continue
+            # header byte
+            if b == 0x00:
+                self.zeros += 1
+                continue
+            if b == 0x80 and self.zeros >= 5:
+                self.num_syncs += 1         # synchronization packet (at least 47 zero bits followed by a one)
+                self.zeros = 0
+                continue
+            self.zeros = 0
+            self.hdr   = b
+            self.val   = 0
+            self.shift = 0
+            if b & 0x03:                    # instrumentation or hardware source packet
+                self.need = payload_size[b & 0x03]
+            elif b == 0x70:
+                self.num_overflows += 1
+            elif (b & 0x0f) == 0:           # local timestamp packet
+                if (b & 0xc0) == 0xc0:
+                    self.cont = True        # format 1: value in the continuation bytes
+                elif not (b & 0x80):
+                    self._local_timestamp((b >> 4) & 0x07)   # format 2: value in the header
+            elif b & 0x80:                  # global timestamp or extension packet with continuation bytes -> skip
+                self.cont = True
+
+    def _source_packet(self, hdr, val):
+        pass
+
+    def _local_timestamp(self, delta):
+        pass
+### END ItmPacketParser
+
+
+##############################################################################
+#
+# StimulusDecoder - extracts the data written to the ITM stimulus ports
+#
+##############################################################################
+class StimulusDecoder(ItmPacketParser):
+
+    def __init__(self, port_mask=0x1):
+        ItmPacketParser.__init__(self)
+        self.port_mask = port_mask
+        self.data      = {}
+
+    def decode(self, data):
+        """
+        Decodes a chunk of SWO data (packets may be split across chunks).
+
+        Returns:
+          dict: {port: bytearray} with the stimulus data contained in this chunk
+        """
+        self._feed(data)
+        result    = self.data
+        self.data = {}
+        return result
+
+    def _source_packet(self, hdr, val):
+        if hdr & 0x04:
+            return                          # hardware source packet
+        port = hdr >> 3
+        if (self.port_mask >> port) & 1:
+            if port not in self.data:
+                self.data[port] = bytearray()
+            self.data[port] += val.to_bytes(payload_size[hdr & 0x03], 'little')
+### END StimulusDecoder
+
+
+##############################################################################
+#
+# DataTraceDecoder
+#
+##############################################################################
+class DataTraceDecoder(ItmPacketParser):
+
+    def __init__(self, filename, prescaler=16, cpu_speed=None):
+        self.filename       = filename
+        self.prescaler      = prescaler      # local timestamp prescaler
+        self.cpu_speed      = cpu_speed      # only used to estimate the global time if there are not enough anchors
+        self.offset         = None           # file offset of the next frame
+        self.varnames       = []
+        self.sleep_overhead = None
+        ItmPacketParser.__init__(self)
+        self.local_ts       = 0
+        self.lts_seen       = False          # local timestamp received in the current frame?
+        self.pending        = []             # records which are waiting for a local timestamp
+        self.pending_pc     = {}             # PC values waiting for the data value of the same comparator
+        self.records        = []
+        self.anchor_local   = []
+        self.anchor_time    = []
+
+    def update(self):
+        """
+        Decodes all complete frames appended to the capture file since the last call.
+
+        Returns:
+          ndarray: the records (record_dtype) which have been assigned a local timestamp since the last call
+        """
+        if self.offset is None:
+            header, self.offset = swo.read_header(self.filename)
+            if self.offset is None:
+                if header.endswith(b"\n") and os.path.getsize(self.filename) >= len(header) + len(swo.bin_magic):
+                    raise ValueError("%s is not a binary SWO capture file" % self.filename)
+                return np.empty(0, dtype=record_dtype)     # header not yet written
+            self.varnames, self.sleep_overhead = swo.parse_header(header)
+        with open(self.filename, "rb") as f:
+            f.seek(self.offset)
+            for timestamp_ns, data in swo.iter_frames(f):
+                self.lts_seen = False
+                self._feed(data)
+                if self.lts_seen:
+                    self.anchor_local.append(self.local_ts)
+                    self.anchor_time.append(timestamp_ns)
+            self.offset = f.tell()
+        return self._collect()
+
+    def flush(self):
+        """
+        Assigns the last local timestamp to all records which are still pending (call at the end of the capture).
+
+        Returns:
+          ndarray: the remaining records (record_dtype)
+        """
+        self._flush_pc()
+        self._assign_timestamp()
+        return self._collect()
+
+    def _source_packet(self, hdr, val):
+        if not (hdr & 0x04):
+            return                          # instrumentation packet (software source)
+        disc = hdr >> 3                     # discriminator ID
+        comp = (disc >> 1) & 0x03
+        if disc >= 16:                      # data value packet
+            pc = self.pending_pc.pop(comp, -1)
+            self.pending.append((comp, bool(disc & 1), val, pc))
+        elif disc >= 8 and not (disc & 1):  # PC value packet (precedes the data value packet if both are traced)
+            if comp in self.pending_pc:
+                self.pending.append((comp, False, -1, self.pending_pc[comp]))
+            self.pending_pc[comp] = val
+        # address offset packets, event counter, exception trace and periodic PC sample packets are ignored
+
+    def _flush_pc(self):
+        for comp, pc in self.pending_pc.items():
+            self.pending.append((comp, False, -1, pc))   # PC only
+        self.pending_pc = {}
+
+    def _local_timestamp(self, delta):
+        # the local timestamp packet follows the packets it relates to
+        self.local_ts += delta
+        self.lts_seen  = True
+        self._flush_pc()
+        self._assign_timestamp()
+
+    def _assign_timestamp(self):
+        ts = self.local_ts
+        self.records.extend([rec + (ts, np.nan) for rec in self.pending])
+        self.pending = []
+
+    def _collect(self):
+        arr = np.array(self.records, dtype=record_dtype)
+        self.records = []
+        if len(arr):
+            arr['global_ts'] = self.to_global(arr['local_ts'])
+        return arr
+
+    def fit(self):
+        """
+        Fits the local timestamps to the global time.
+
+        The readout timestamp of a frame is an upper bound for the time of the last local timestamp within that frame.
+        Anchors which are delayed by more than the tolerance (twice the sleep overhead) w.r.t. the fit are considered
+        outliers. The line is then shifted to the lower envelope of the remaining anchors.
+
+        Returns:
+          tuple: (slope in seconds per tick, offset in seconds) or None if there are not enough anchors
+        """
+        num_anchors = len(self.anchor_local)
+        if num_anchors == 0:
+            return None
+        loc = np.asarray(self.anchor_local, dtype=np.float64)
+        glb = np.asarray(self.anchor_time, dtype=np.int64)
+        t0  = glb[0]
+        glb = (glb - t0) / 1e9              # relative time in seconds (keep the precision)
+        if num_anchors < 2 or loc[-1] == loc[0]:
+            if not self.cpu_speed:
+                return None
+            slope  = max(self.prescaler, 1) / self.cpu_speed
+            offset = np.min(glb - slope * loc)
+            return (slope, t0 / 1e9 + offset)
+        tolerance = 2 * abs(self.sleep_overhead) if self.sleep_overhead else 0.001
+        mask = np.ones(num_anchors, dtype=bool)
+        for i in range(3):
+            slope, offset = np.polyfit(loc[mask], glb[mask], 1)
+            res  = glb - (slope * loc + offset)
+            newmask = (res - np.min(res)) <= tolerance
+            if np.count_nonzero(newmask) < 2 or np.array_equal(newmask, mask):
+                break
+            mask = newmask
+        offset += np.min(res[mask])
+        return (slope, t0 / 1e9 + offset)
+
+    def to_global(self, local_ts):
+        """
+        Converts local timestamps into global time (UNIX time in seconds) based on the current fit.
+        """
+        local_ts = np.asarray(local_ts, dtype=np.float64)
+        params = self.fit()
+        if not params:
+            return np.full(local_ts.shape, np.nan)
+        return params[0] * local_ts + params[1]
+### END DataTraceDecoder
+
+
+##############################################################################
+#
+# decode_capture - decodes a complete capture file
+#                  (the global time is reconstructed based on all anchors)
+#
+##############################################################################
+def decode_capture(filename, prescaler=16, cpu_speed=None):
+    decoder = DataTraceDecoder(filename, prescaler, cpu_speed)
+    records = np.concatenate((decoder.update(), decoder.flush()))
+    if len(records):
+        records['global_ts'] = decoder.to_global(records['local_ts'])
+    return records
+### END decode_capture()
@@ -0,0 +1,147 @@
+"""
+Copyright (c) 2020, ETH Zurich, Computer Engineering Group
+All rights reserved.
+
+Redistribution and use in source and binary forms, with or without
+modification, are permitted provided that the following conditions are met:
+
+* Redistributions of source code must retain the above copyright notice, this
+  list of conditions and the following disclaimer.
+
+* Redistributions in binary form must reproduce the above copyright notice,
+  this list of conditions and the following disclaimer in the documentation
+  and/or other materials provided with the distribution.
+
+* Neither the name of the copyright holder nor the names of its
+  contributors may be used to endorse or promote products derived from
+  this software without specific prior written permission.
+
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+POSSIBILITY OF SUCH DAMAGE.
+
+"""
+
+"""
+    J-Link session manager: keeps a single connection to the debug probe open
+    across configuration and SWO streaming, and batches register accesses.
+"""
+import pylink
+try:
+    import StringIO
+except ImportError:
+    import io as StringIO
+
+
+jlinklibpath   = '/opt/jlink/libjlinkarm.so'
+default_device = 'STM32L433CC'
+
+
+##############################################################################
+#
+# group_contiguous - merges (address, value) pairs with consecutive 32-bit
+#                    addresses into runs that can be written in one access
+#
+##############################################################################
+def group_contiguous(regs):
+    """
+    Groups a list of register writes into contiguous blocks. The order of the writes is preserved, i.e. only
+    neighbouring entries are merged.
+
+    Parameters:
+        regs (list): list of (address, value) tuples or a dict {address: value}
+
+    Returns:
+        list of (start address, [values]) tuples
+
+    """
+    if isinstance(regs, dict):
+        regs = regs.items()
+    runs = []
+    for addr, value in regs:
+        if runs and (runs[-1][0] + 4 * len(runs[-1][1])) == addr:
+            runs[-1][1].append(value & 0xffffffff)
+        else:
+            runs.append((addr, [value & 0xffffffff]))
+    return runs
+### END group_contiguous()
+
+
+##############################################################################
+#
+# JLinkSession
+#
+##############################################################################
+class JLinkSession():
+
+    def __init__(self, jlink_serial=None, device_name=default_device):
+        try:
+            self.jlink_serial = int(jlink_serial)
+        except TypeError:   # if the type is None we just pass
+            self.jlink_serial = None
+        if not isinstance(device_name, str):
+            device_name = default_device
+        self.device_name = device_name
+        self.jlink       = None
+        self.logbuf      = StringIO.StringIO()
+        self.num_writes  = 0      # number of memory write accesses issued (for statistics)
+
+    def open(self, verbose=True):
+        """Opens the probe and connects to the target, does nothing if already connected."""
+        if self.is_connected():
+            return self.jlink
+        if not self.jlink:
+            jlinklib   = pylink.library.Library(dllpath=jlinklibpath)
+            self.jlink = pylink.JLink(lib=jlinklib, log=self.logbuf.write, detailed_log=self.logbuf.write)
+        if not self.jlink.opened():
+            if self.jlink_serial:  # if have several emulators connected, user can specify one by the serial number
+                self.jlink.open(serial_no=self.jlink_serial)
+            else:
+                self.jlink.open()
+        self.jlink.set_tif(pylink.enums.JLinkInterfaces.SWD)
+        self.jlink.connect(self.device_name, verbose=verbose)
+        self.jlink.coresight_configure()
+        self.jlink.set_reset_strategy(pylink.enums.JLinkResetStrategyCortexM3.RESETPIN)
+        return self.jlink
+
+    def is_connected(self):
+        try:
+            return self.jlink is not None and self.jlink.opened() and self.jlink.target_connected()
+        except:
+            return False
+
+    def halt(self):
+        """Halts the target, returns False if the target could not be halted."""
+        try:
+            self.jlink.halt()
+        except:
+            return False
+        return True
+
+    def write32(self, regs):
+        """Writes a list of (address, value) tuples, contiguous addresses are written in a single access."""
+        for addr, values in group_contiguous(regs):
+            self.jlink.memory_write32(addr, values)
+            self.num_writes += 1
+
+    def read32(self, addr, num_words=1):
+        return self.jlink.memory_read32(addr, num_words)
+
+    def close(self):
+        if self.jlink:
+            try:
+                if self.jlink.opened():
+                    self.jlink.close()
+            except:
+                pass
+        self.jlink = None
+### END JLinkSession
+
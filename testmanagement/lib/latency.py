@@ -0,0 +1,321 @@
+"""
+Copyright (c) 2020, ETH Zurich, Computer Engineering Group
+All rights reserved.
+
+Redistribution and use in source and binary forms, with or without
+modification, are permitted provided that the following conditions are met:
+
+* Redistributions of source code must retain the above copyright notice, this
+  list of conditions and the following disclaimer.
+
+* Redistributions in binary form must reproduce the above copyright notice,
+  this list of conditions and the following disclaimer in the documentation
+  and/or other materials provided with the distribution.
+
+* Neither the name of the copyright holder nor the names of its
+  contributors may be used to endorse or promote products derived from
+  this software without specific prior written permission.
+
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+POSSIBILITY OF SUCH DAMAGE.
+
+"""
+
+"""
+    End-to-end latency measurement of the capture paths
+
+    The SIG pins are actuated on a known schedule, a reference target image echoes each edge as a text line
+    "<pin> <level>" (e.g. "SIG1 1") over UART and SWO. The timestamps of each capture path (GPIO tracing, serial
+    logging, SWO logger) are matched to the scheduled edges and the latency distribution is computed per path.
+    For tests without hardware, SimulatedActuator replaces the actuation device and generates the GPIO tracing
+    output, the UART echo (into a pty) and the SWO logger output.
+"""
+import os
+import re
+import json
+import time
+import struct
+import threading
+import numpy as np
+
+
+echo_pins   = ['SIG1', 'SIG2']
+edge_dtype  = np.dtype([('time', np.float64), ('pin', 'U8'), ('level', np.int8)])
+max_latency = 0.5               # max. latency in seconds of an observed edge
+percentiles = [1, 50, 90, 99]
+echo_format = re.compile(rb"(SIG[12])\s+([01])")
+act_codes   = { 'SIG1': ('L', 'H'), 'SIG2': ('l', 'h') }    # actuation commands (low, high), see level_str2abbr() in flocklab.py
+
+
+##############################################################################
+#
+# generate_schedule - returns the SIG pin edges as structured array (offset
+#                     relative to the start in seconds, pin, level), the pins
+#                     toggle alternately with a random phase within the period
+#                     (avoids aliasing with the read loops of the capture paths)
+#
+##############################################################################
+def generate_schedule(count=100, period=0.1, pins=echo_pins, seed=None):
+    rng      = np.random.default_rng(seed)
+    schedule = np.zeros(count, dtype=edge_dtype)
+    schedule['time']  = np.arange(count) * period + rng.uniform(0, period / 2, count)
+    schedule['pin']   = [pins[i % len(pins)] for i in range(count)]
+    schedule['level'] = (np.arange(count) // len(pins) + 1) % 2      # each pin starts with a rising edge
+    return schedule
+### END generate_schedule()
+
+
+##############################################################################
+#
+# get_act_events - converts a schedule into actuation events (command, offset
+#                  in us) as used by start_gpio_actuation() in flocklab.py
+#
+##############################################################################
+def get_act_events(schedule):
+    return [[act_codes[str(e['pin'])][int(e['level'])], int(round(e['time'] * 1000000))] for e in schedule]
+### END get_act_events()
+
+
+##############################################################################
+#
+# read_gpio_edges - reads the SIG pin edges from the csv output of the GPIO
+#                   converter (timestamp,pin,level)
+#
+##############################################################################
+def read_gpio_edges(filename, pins=echo_pins):
+    edges = []
+    with open(filename, "r") as f:
+        for line in f:
+            fields = line.strip().split(',')
+            if len(fields) == 3 and fields[1] in pins:
+                try:
+                    edges.append((float(fields[0]), fields[1], int(fields[2])))
+                except ValueError:
+                    pass
+    return np.array(edges, dtype=edge_dtype)
+### END read_gpio_edges()
+
+
+##############################################################################
+#
+# read_echo_csv - reads the echoed edges from a csv output (timestamp,line)
+#                 of the serial logger or the SWO logger
+#
+##############################################################################
+def read_echo_csv(filename):
+    edges = []
+    with open(filename, "rb") as f:
+        for line in f:
+            timestamp, _, text = line.partition(b",")
+            match = echo_format.search(text)
+            if match:
+                try:
+                    edges.append((float(timestamp), match.group(1).decode(), int(match.group(2))))
+                except ValueError:
+                    pass
+    return np.array(edges, dtype=edge_dtype)
+### END read_echo_csv()
+
+
+##############################################################################
+#
+# read_echo_db - reads the echoed edges from the output of the serial service
+#                (see ProcDbBuf() in flocklab_serial.py)
+#
+##############################################################################
+def read_echo_db(filename):
+    edges = []
+    with open(filename, "rb") as f:
+        data = f.read()
+    pos = 0
+    while pos + 16 <= len(data):
+        size, service, sec, usec = struct.unpack_from("<Illl", data, pos)
+        match = echo_format.search(data[pos + 16:pos + 4 + size])
+        if service == 0 and match:
+            edges.append((sec + usec / 1e6, match.group(1).decode(), int(match.group(2))))
+        pos += 4 + size
+    return np.array(edges, dtype=edge_dtype)
+### END read_echo_db()
+
+
+##############################################################################
+#
+# match_edges - returns the latency of the first observed edge after each
+#               reference edge with the same pin and level (NaN if missed)
+#
+##############################################################################
+def match_edges(reference, observed, tolerance=0.001, limit=max_latency):
+    latencies = np.full(len(reference), np.nan)
+    for pin in np.unique(reference['pin']):
+        for level in (0, 1):
+            ref = np.flatnonzero((reference['pin'] == pin) & (reference['level'] == level))
+            obs = np.sort(observed['time'][(observed['pin'] == pin) & (observed['level'] == level)])
+            if len(ref) == 0 or len(obs) == 0:
+                continue
+            # the observed timestamp may be slightly before the reference (clock errors), but not more than the tolerance
+            idx   = np.searchsorted(obs, reference['time'][ref] - tolerance)
+            valid = idx < len(obs)
+            delta = np.full(len(ref), np.nan)
+            delta[valid] = obs[idx[valid]] - reference['time'][ref[valid]]
+            delta[delta > limit] = np.nan
+            latencies[ref] = delta
+    return latencies
+### END match_edges()
+
+
+##############################################################################
+#
+# get_stats - returns the statistics of a latency distribution in seconds
+#
+##############################################################################
+def get_stats(latencies):
+    valid = latencies[~np.isnan(latencies)]
+    stats = { 'count': int(len(latencies)), 'missed': int(len(latencies) - len(valid)) }
+    if len(valid):
+        stats.update({ 'min': float(np.min(valid)), 'mean': float(np.mean(valid)), 'std': float(np.std(valid)), 'max': float(np.max(valid)) })
+        stats.update({ 'p%d' % p: float(v) for p, v in zip(percentiles, np.percentile(valid, percentiles)) })
+    return stats
+### END get_stats()
+
+
+##############################################################################
+#
+# analyze - computes the latency distributions of the capture paths
+#
+# schedule: scheduled edges with absolute timestamps
+# paths:    dict with the observed edges per capture path ('gpio', 'serial',
+#           'swo', ...), the latencies are given relative to the schedule and,
+#           if available, relative to the GPIO trace (excludes the actuation
+#           and tracing latency)
+#
+##############################################################################
+def analyze(schedule, paths):
+    results = { 'edges': int(len(schedule)), 'paths': {} }
+    gpio    = None
+    if paths.get('gpio') is not None and len(paths['gpio']):
+        gpio = paths['gpio']
+    for name, edges in paths.items():
+        if edges is None:
+            continue
+        result = { 'schedule': get_stats(match_edges(schedule, edges)) }
+        if gpio is not None and name != 'gpio':
+            # reference: the traced edge of the same scheduled edge
+            traced = schedule.copy()
+            traced['time'] = schedule['time'] + match_edges(schedule, gpio)
+            traced = traced[~np.isnan(traced['time'])]
+            result['gpio'] = get_stats(match_edges(traced, edges))
+        results['paths'][name] = result
+    # suggested latency constants for the timestamp correction (median latency relative to the GPIO trace)
+    results['corrections'] = { name: r['gpio']['p50'] for name, r in results['paths'].items() if 'p50' in r.get('gpio', {}) }
+    return results
+### END analyze()
+
+
+##############################################################################
+#
+# store_results - writes the results into a file named after the observer
+#                 and the kernel version, returns the filename
+#
+##############################################################################
+def store_results(results, folder):
+    uname = os.uname()
+    results['observer'] = uname.nodename
+    results['kernel']   = uname.release
+    results['time']     = time.time()
+    filename = os.path.join(folder, "latency_%s_%s_%s.json" % (uname.nodename, uname.release, time.strftime("%Y%m%d%H%M%S", time.gmtime())))
+    os.makedirs(folder, exist_ok=True)
+    with open(filename, "w") as f:
+        json.dump(results, f, indent=2)
+    return filename
+### END store_results()
+
+
+##############################################################################
+#
+# SimulatedActuator - replaces the actuation device: accepts the same command
+#                     string and emulates the actuated target running the
+#                     reference image together with the capture paths
+#
+# Each edge is written to the GPIO tracing output (with the tracing latency),
+# echoed by the "target" over the UART (pty master, after the response time)
+# and written to the SWO output at the next readout of the SWO logger.
+#
+##############################################################################
+class SimulatedActuator():
+
+    def __init__(self, gpiofile, uartfd=None, swofile=None, trace_latency=2e-6, response_time=50e-6, swo_period=0.01):
+        self.gpiofile      = gpiofile
+        self.uartfd        = uartfd
+        self.swofile       = swofile
+        self.trace_latency = trace_latency
+        self.response_time = response_time
+        self.swo_period    = swo_period
+        self.events        = []
+        self.start_time    = None
+        self.status        = ""
+        self.thread        = None
+        self.stopped       = threading.Event()
+
+    def write(self, cmd):
+        """parses an actuation command string (e.g. 'H1000 L2000 S1600000000')"""
+        self.events = []
+        offset      = 0
+        for token in cmd.split():
+            if token[0] == 'S':
+                self.start_time = int(token[1:])
+                continue
+            offset += int(token[1:])
+            for pin, codes in act_codes.items():
+                if token[0] in codes:
+                    self.events.append((offset / 1e6, pin, codes.index(token[0])))
+        self.status = "OK" if self.start_time else "ERROR"
+        if self.start_time:
+            self.thread = threading.Thread(target=self._run, daemon=True)
+            self.thread.start()
+
+    def read(self):
+        return self.status
+
+    def join(self, timeout=None):
+        if self.thread:
+            self.thread.join(timeout)
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+
+    def _run(self):
+        gpio = open(self.gpiofile, "a")
+        swo  = open(self.swofile, "a") if self.swofile else None
+        try:
+            for offset, pin, level in self.events:
+                t_edge = self.start_time + offset
+                while not self.stopped.is_set() and time.time() < t_edge:
+                    time.sleep(min(0.001, max(t_edge - time.time(), 0)))
+                if self.stopped.is_set():
+                    break
+                gpio.write("%.7f,%s,%d\n" % (t_edge + self.trace_latency, pin, level))
+                gpio.flush()
+                line = ("%s %d\n" % (pin, level)).encode()
+                if self.uartfd is not None:
+                    time.sleep(self.response_time)
+                    os.write(self.uartfd, line)
+                if swo:
+                    # the SWO logger timestamps the data at the next readout
+                    t_read = (np.floor((t_edge + self.response_time) / self.swo_period) + 1) * self.swo_period
+                    swo.write("%.7f,%s" % (t_read, line.decode()))
+                    swo.flush()
+        finally:
+            gpio.close()
+            if swo:
+                swo.close()
+### END SimulatedActuator
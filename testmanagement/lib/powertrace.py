@@ -0,0 +1,640 @@
+"""
+Copyright (c) 2020, ETH Zurich, Computer Engineering Group
+All rights reserved.
+
+Redistribution and use in source and binary forms, with or without
+modification, are permitted provided that the following conditions are met:
+
+* Redistributions of source code must retain the above copyright notice, this
+  list of conditions and the following disclaimer.
+
+* Redistributions in binary form must reproduce the above copyright notice,
+  this list of conditions and the following disclaimer in the documentation
+  and/or other materials provided with the distribution.
+
+* Neither the name of the copyright holder nor the names of its
+  contributors may be used to endorse or promote products derived from
+  this software without specific prior written permission.
+
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+POSSIBILITY OF SUCH DAMAGE.
+
+"""
+
+"""
+    Power profiling pyramid file format
+
+    The magic line below, followed by a text line with the start time of the measurement (ns since the epoch),
+    the sampling rate and the number of samples per bucket of each level (space separated),
+    followed by a sequence of blocks:
+        u8  level index
+        u8  flags (see block_flag_*)
+        u16 reserved
+        u32 number of buckets
+        u64 index of the first bucket
+        u32 number of samples of the last bucket (less than the samples per bucket for the very last bucket only)
+        u32 payload size in bytes
+        payload (zlib compressed if block_flag_zlib is set):
+            f32 arrays of the given number of buckets, in this order:
+                current min, mean, max [A], voltage min, mean, max [V], power min, mean, max [W]
+    All integers are little endian. The current is the merged low / high range current (I1L if in range, I1H
+    otherwise), the voltage is the target supply voltage measured between V1 and V2 (V2 - V1).
+"""
+import os
+import re
+import struct
+import time
+import zlib
+import numpy as np
+
+
+file_magic      = b"FLPWR1\n"
+block_header    = struct.Struct("<BBHIQII")
+block_flag_zlib = 0x01
+levels          = [0.001, 0.01, 0.1, 1.0]   # default bucket durations in seconds
+block_size      = 65536                     # max. number of buckets per block
+chunk_size      = 64                        # number of data blocks read at once
+zlib_level      = 1
+file_extension  = ".pyramid"
+signals         = ['current', 'voltage', 'power']
+
+# RocketLogger data file format, see rocketlogger/rl_file.h
+rld_magic       = 0x444C5225
+rld_lead_in     = np.dtype([('file_magic', '<u4'), ('file_version', '<u2'), ('header_length', '<u2'),
+                            ('data_block_size', '<u4'), ('data_block_count', '<u4'), ('sample_count', '<u8'),
+                            ('sample_rate', '<u2'), ('mac_address', 'u1', 6), ('start_time_sec', '<i8'),
+                            ('start_time_ns', '<i8'), ('comment_length', '<u4'), ('channel_binary_count', '<u2'),
+                            ('channel_count', '<u2')])
+rld_channel     = np.dtype([('unit', '<u4'), ('scale', '<i4'), ('data_size', '<u2'), ('valid_link', '<u2'),
+                            ('name', 'S16')])
+rld_timestamps  = 32            # realtime and monotonic timestamp at the start of each data block
+
+
+##############################################################################
+#
+# read_rld_header - returns the header of a RocketLogger data file as dict
+#
+##############################################################################
+def read_rld_header(filename):
+    with open(filename, "rb") as f:
+        lead_in = np.frombuffer(f.read(rld_lead_in.itemsize), dtype=rld_lead_in)
+        if len(lead_in) != 1 or lead_in['file_magic'][0] != rld_magic:
+            raise ValueError("%s is not a RocketLogger data file" % filename)
+        lead_in = lead_in[0]
+        f.seek(int(lead_in['comment_length']), os.SEEK_CUR)
+        channels = np.frombuffer(f.read(rld_channel.itemsize * (int(lead_in['channel_binary_count']) + int(lead_in['channel_count']))), dtype=rld_channel)
+    header = { name: int(lead_in[name]) for name in ('header_length', 'data_block_size', 'sample_count', 'sample_rate', 'channel_binary_count') }
+    header['start_time'] = int(lead_in['start_time_sec']) * 1000000000 + int(lead_in['start_time_ns'])
+    header['channels']   = [(ch['name'].split(b'\x00', 1)[0].decode(), int(ch['scale']), int(ch['valid_link'])) for ch in channels]
+    # one row of a data block: binary channels (packed into one u32), analog channels (i32)
+    fields = [('bin', '<u4')] if header['channel_binary_count'] else []
+    fields += [(name, '<i4') for name, _, _ in header['channels'][header['channel_binary_count']:]]
+    header['row_dtype'] = np.dtype(fields)
+    return header
+### END read_rld_header()
+
+
+##############################################################################
+#
+# read_rld_power_header - returns the header of a RocketLogger data file
+#                         with power profiling channels, or None if the
+#                         header has not been written completely yet
+#
+##############################################################################
+def read_rld_power_header(filename):
+    if not os.path.isfile(filename) or os.path.getsize(filename) < rld_lead_in.itemsize:
+        return None
+    if os.path.getsize(filename) < np.fromfile(filename, dtype=rld_lead_in, count=1)['header_length'][0]:
+        return None
+    header = read_rld_header(filename)
+    names  = [ch[0] for ch in header['channels']]
+    for name in ('V1', 'V2', 'I1L', 'I1H'):
+        if name not in names:
+            raise ValueError("channel %s missing in %s" % (name, filename))
+    header['block_dtype'] = np.dtype([('timestamps', 'u1', rld_timestamps), ('data', header['row_dtype'], header['data_block_size'])])
+    header['scales']      = { ch[0]: 10.0 ** ch[1] for ch in header['channels'] }
+    header['valid_bit']   = header['channels'][names.index('I1L')][2]
+    return header
+### END read_rld_power_header()
+
+
+##############################################################################
+#
+# get_rld_segment - returns the name of a file segment of a RocketLogger
+#                   measurement, the RocketLogger continues in a new file
+#                   ([name]_p1.rld, [name]_p2.rld, ...) when the max. file
+#                   size is reached (index 0 is the first file)
+#
+##############################################################################
+def get_rld_segment(filename, index):
+    if index == 0:
+        return filename
+    base, ext = os.path.splitext(filename)
+    return "%s_p%d%s" % (base, index, ext)
+### END get_rld_segment()
+
+
+##############################################################################
+#
+# is_rld_segment - checks whether a file is a continuation segment
+#                  ([name]_p1.rld, ...) of a RocketLogger measurement
+#
+##############################################################################
+def is_rld_segment(filename):
+    return re.search(r"_p[0-9]+\.rld$", filename) is not None
+### END is_rld_segment()
+
+
+##############################################################################
+#
+# get_signals - returns the current (I1L if in range, I1H otherwise),
+#               the voltage and the power of rows of a data file
+#
+##############################################################################
+def get_signals(rows, header):
+    scales  = header['scales']
+    valid   = (rows['bin'] >> header['valid_bit']) & 1 if 'bin' in rows.dtype.names else np.zeros(len(rows), dtype=np.uint32)
+    current = np.where(valid, rows['I1L'] * scales['I1L'], rows['I1H'] * scales['I1H'])
+    voltage = rows['V2'] * scales['V2'] - rows['V1'] * scales['V1']
+    return (current, voltage, current * voltage)
+### END get_signals()
+
+
+##############################################################################
+#
+# PyramidLevel - aggregates buckets of the next finer level (or samples)
+#                into buckets of this level
+#
+##############################################################################
+class PyramidLevel():
+
+    def __init__(self, samples_per_bucket, ratio):
+        self.samples_per_bucket = samples_per_bucket
+        self.ratio              = ratio     # number of source buckets per bucket
+        self.pending            = None      # incomplete bucket: source buckets (min, mean, max, num samples)
+        self.count              = 0         # number of buckets completed
+
+    def push(self, mins, means, maxs, nums, last=False):
+        """
+        Adds source buckets (arrays of shape (n, number of signals), nums of shape (n,)) and returns the completed buckets.
+        If last is True, the incomplete bucket is returned as well.
+        """
+        if self.pending is not None:
+            mins  = np.concatenate((self.pending[0], mins))
+            means = np.concatenate((self.pending[1], means))
+            maxs  = np.concatenate((self.pending[2], maxs))
+            nums  = np.concatenate((self.pending[3], nums))
+            self.pending = None
+        complete = (len(nums) // self.ratio) * self.ratio
+        if complete < len(nums) and not last:
+            self.pending = (mins[complete:], means[complete:], maxs[complete:], nums[complete:])
+        else:
+            complete = len(nums)
+        if complete == 0:
+            return None
+        # pad the incomplete last bucket (only if last is True)
+        count = -(-complete // self.ratio)
+        pad   = count * self.ratio - complete
+        mins, means, maxs, nums = mins[:complete], means[:complete], maxs[:complete], nums[:complete]
+        if pad:
+            mins  = np.concatenate((mins, np.repeat(mins[-1:], pad, axis=0)))
+            maxs  = np.concatenate((maxs, np.repeat(maxs[-1:], pad, axis=0)))
+            means = np.concatenate((means, np.zeros((pad, means.shape[1]))))
+            nums  = np.concatenate((nums, np.zeros(pad, dtype=nums.dtype)))
+        shape = (count, self.ratio, mins.shape[1])
+        nums  = nums.reshape(count, self.ratio)
+        bnums = nums.sum(axis=1)
+        bmins = mins.reshape(shape).min(axis=1)
+        bmaxs = maxs.reshape(shape).max(axis=1)
+        bmeans = (means.reshape(shape) * nums[:, :, np.newaxis]).sum(axis=1) / bnums[:, np.newaxis]
+        self.count += count
+        return (bmins, bmeans, bmaxs, bnums)
+### END PyramidLevel
+
+
+##############################################################################
+#
+# PyramidBuilder - reads a (growing) RocketLogger data file and writes the
+#                  min/mean/max pyramid of the current, voltage and power
+#                  (one pyramid across all file segments of a measurement,
+#                  see get_rld_segment())
+#
+##############################################################################
+class PyramidBuilder():
+
+    def __init__(self, filename, outputfile=None, level_durations=levels, compress=True):
+        self.filename   = filename
+        self.outputfile = outputfile if outputfile else os.path.splitext(filename)[0] + file_extension
+        self.durations  = level_durations
+        self.compress   = compress
+        self.header     = None
+        self.file       = None
+        self.segment    = 0         # index of the file segment being read
+        self.current    = filename  # file name of this segment
+        self.blocks     = 0         # number of data blocks read from the current segment
+        self.num_samples = 0
+
+    def _init(self):
+        self.header = header = read_rld_power_header(self.filename)
+        if header is None:
+            return False            # not yet available
+        rate = header['sample_rate']
+        self.block_dtype = header['block_dtype']
+        # levels with at least 2 samples per bucket, built from the finest level with a divisible bucket size
+        self.levels = []
+        sources     = []
+        for duration in self.durations:
+            samples = int(round(duration * rate))
+            if samples < 2 or any(samples == l.samples_per_bucket for l in self.levels):
+                continue
+            source = None
+            for i, l in enumerate(self.levels):
+                if samples % l.samples_per_bucket == 0:
+                    source = i
+            ratio = samples // self.levels[source].samples_per_bucket if source is not None else samples
+            self.levels.append(PyramidLevel(samples, ratio))
+            sources.append(source)
+        self.sources = sources
+        self.file = open(self.outputfile, "wb")
+        self.file.write(file_magic)
+        self.file.write(("%d %d %s\n" % (header['start_time'], rate, " ".join([str(l.samples_per_bucket) for l in self.levels]))).encode())
+        return True
+
+    def _process(self, rows, last=False):
+        values  = np.column_stack(get_signals(rows, self.header))
+        self.num_samples += len(rows)
+        outputs = []
+        for index, (level, source) in enumerate(zip(self.levels, self.sources)):
+            if source is None:
+                out = level.push(values, values, values, np.ones(len(values), dtype=np.int64), last)
+            elif outputs[source] is not None:
+                out = level.push(*outputs[source], last=last)
+            elif last:
+                out = level.push(np.zeros((0, 3)), np.zeros((0, 3)), np.zeros((0, 3)), np.zeros(0, dtype=np.int64), last)
+            else:
+                out = None
+            outputs.append(out)
+            if out is not None:
+                self._write_buckets(index, level.count - len(out[3]), out)
+
+    def _write_buckets(self, index, first, buckets):
+        mins, means, maxs, nums = buckets
+        for start in range(0, len(nums), block_size):
+            end     = min(start + block_size, len(nums))
+            arrays  = [a[start:end, s] for s in range(len(signals)) for a in (mins, means, maxs)]
+            payload = b"".join([a.astype('<f4').tobytes() for a in arrays])
+            flags   = 0
+            if self.compress:
+                flags  |= block_flag_zlib
+                payload = zlib.compress(payload, zlib_level)
+            self.file.write(block_header.pack(index, flags, 0, end - start, first + start, int(nums[end - 1]), len(payload)))
+            self.file.write(payload)
+
+    def update(self):
+        """
+        Processes the data blocks which have been appended to the data file since the last call.
+
+        Returns:
+          int: number of samples processed
+        """
+        if self.file is None and not self._init():
+            return 0
+        num_samples = self.num_samples
+        while True:
+            if self._read_blocks() > 0:
+                continue
+            # the current segment is complete once the next one has been created (the start time in its header is
+            # not updated by the RocketLogger, the samples are a continuation of the previous segment)
+            nextfile = get_rld_segment(self.filename, self.segment + 1)
+            if read_rld_power_header(nextfile) is None:
+                break
+            if self._read_blocks() > 0:
+                continue
+            self.segment += 1
+            self.current  = nextfile
+            self.blocks   = 0
+        self.file.flush()
+        return self.num_samples - num_samples
+
+    def _read_blocks(self):
+        # reads the complete data blocks of the current segment (at most chunk_size), returns the number of blocks read
+        available = (os.path.getsize(self.current) - self.header['header_length']) // self.block_dtype.itemsize - self.blocks
+        count     = min(available, chunk_size)
+        if count <= 0:
+            return 0
+        blocks = np.fromfile(self.current, dtype=self.block_dtype, count=count, offset=self.header['header_length'] + self.blocks * self.block_dtype.itemsize)
+        self.blocks += count
+        self._process(blocks['data'].reshape(-1))
+        return count
+
+    def finish(self):
+        """
+        Processes the remaining data of all file segments (incl. the incomplete last data block) and closes the output file.
+
+        Returns:
+          int: total number of samples processed
+        """
+        self.update()
+        if self.file is None:
+            return 0
+        # the sample count in the header is final once the measurement has stopped
+        header = read_rld_header(self.current)
+        offset = header['header_length'] + self.blocks * self.block_dtype.itemsize
+        rows   = max(0, (os.path.getsize(self.current) - offset - rld_timestamps) // header['row_dtype'].itemsize)
+        if header['sample_count'] > 0:
+            rows = max(0, min(rows, header['sample_count'] - self.blocks * header['data_block_size']))
+        data = np.fromfile(self.current, dtype=header['row_dtype'], count=rows, offset=offset + rld_timestamps) if rows else np.zeros(0, dtype=header['row_dtype'])
+        self._process(data, last=True)
+        self.file.close()
+        return self.num_samples
+### END PyramidBuilder
+
+
+##############################################################################
+#
+# build_pyramid - writes the pyramid file of a complete RocketLogger
+#                 measurement (filename: first file segment)
+#
+##############################################################################
+def build_pyramid(filename, outputfile=None, level_durations=levels):
+    builder = PyramidBuilder(filename, outputfile, level_durations)
+    builder.finish()
+    return builder.outputfile if builder.file is not None else None
+### END build_pyramid()
+
+
+##############################################################################
+#
+# read_pyramid - reads a pyramid file, returns the start time (ns since the
+#                epoch), the sampling rate and a list of levels (dicts with
+#                the keys 'samples_per_bucket', 'samples' (number of samples
+#                per bucket) and one (min, mean, max) tuple per signal)
+#
+##############################################################################
+def read_pyramid(filename):
+    with open(filename, "rb") as f:
+        if f.read(len(file_magic)) != file_magic:
+            raise ValueError("%s is not a power profiling pyramid file" % filename)
+        fields  = [int(x) for x in f.readline().decode().split()]
+        blocks  = [[] for i in range(len(fields) - 2)]
+        while True:
+            hdr = f.read(block_header.size)
+            if len(hdr) < block_header.size:
+                break
+            index, flags, reserved, count, first, last_samples, size = block_header.unpack(hdr)
+            payload = f.read(size)
+            if len(payload) < size:
+                break       # truncated block
+            if flags & block_flag_zlib:
+                payload = zlib.decompress(payload)
+            blocks[index].append((first, count, last_samples, np.frombuffer(payload, dtype='<f4').reshape(3 * len(signals), count)))
+    result = []
+    for samples_per_bucket, level in zip(fields[2:], blocks):
+        level.sort(key=lambda b: b[0])
+        data    = np.concatenate([b[3] for b in level], axis=1) if level else np.zeros((3 * len(signals), 0), dtype='<f4')
+        samples = np.full(data.shape[1], samples_per_bucket, dtype=np.int64)
+        if level:
+            samples[-1] = level[-1][2]
+        entry = { 'samples_per_bucket': samples_per_bucket, 'samples': samples }
+        for i, name in enumerate(signals):
+            entry[name] = (data[3 * i], data[3 * i + 1], data[3 * i + 2])
+        result.append(entry)
+    return (fields[0], fields[1], result)
+### END read_pyramid()
+
+
+##############################################################################
+#
+# get_energy - returns the energy in J consumed between start and end
+#              (seconds relative to the start of the measurement, rounded
+#              to the buckets of the finest level)
+#
+##############################################################################
+def get_energy(filename, start=None, end=None):
+    starttime, rate, pyramid = read_pyramid(filename)
+    if not pyramid:
+        return 0.0
+    level = pyramid[0]
+    first = 0 if start is None else int(round(start * rate / level['samples_per_bucket']))
+    last  = len(level['samples']) if end is None else int(round(end * rate / level['samples_per_bucket']))
+    power = level['power'][1][first:last].astype(np.float64)
+    return float(np.dot(power, level['samples'][first:last]) / rate)
+### END get_energy()
+
+
+##############################################################################
+#
+# EnergyMonitor - follows a (growing) RocketLogger data file and keeps
+#                 running totals of the energy, charge and peak values,
+#                 optionally per GPIO state (from the GPIO tracing output
+#                 in the csv format)
+#
+##############################################################################
+class EnergyMonitor():
+
+    def __init__(self, filename, gpiofile=None, gpio_delay=5.0):
+        self.filename     = filename
+        self.gpiofile     = gpiofile
+        self.gpio_delay   = gpio_delay  # max. delay in seconds of the GPIO tracing output w.r.t. the power samples
+        self.header       = None
+        self.segment      = 0           # index of the file segment being read (see get_rld_segment())
+        self.current      = filename    # file name of this segment
+        self.blocks       = 0           # number of data blocks read from the current segment
+        self.num_samples  = 0           # number of samples accounted
+        self.energy       = 0.0         # [J]
+        self.charge       = 0.0         # [As]
+        self.peak_current = 0.0
+        self.peak_power   = 0.0
+        self.pending      = []          # samples waiting for the GPIO tracing output: (first sample index, current, power)
+        self.gpio_offset  = 0           # number of bytes read from the GPIO tracing output
+        self.gpio_line    = b""         # incomplete last line
+        self.gpio_time    = 0.0         # timestamp of the last edge read
+        self.edges        = []          # edges not yet applied: (timestamps, pin bits, values)
+        self.pins         = {}          # pin name -> bit index
+        self.state        = 0           # current GPIO state (bit mask)
+        self.state_energy = {}          # GPIO state -> [energy, time]
+
+    def _init(self):
+        self.header = read_rld_power_header(self.filename)
+        if self.header is None:
+            return False
+        self.rate      = self.header['sample_rate']
+        self.starttime = self.header['start_time'] / 1e9
+        return True
+
+    def _read_gpio(self):
+        if not self.gpiofile or not os.path.isfile(self.gpiofile):
+            return
+        with open(self.gpiofile, "rb") as f:
+            f.seek(self.gpio_offset)
+            data = f.read()
+        self.gpio_offset += len(data)
+        lines = (self.gpio_line + data).split(b"\n")
+        self.gpio_line = lines.pop()
+        lines = [l.split(b",") for l in lines if l.count(b",") == 2]
+        if not lines:
+            return
+        for l in lines:
+            if l[1] not in self.pins:
+                self.pins[l[1]] = len(self.pins)
+        timestamps = np.array([float(l[0]) for l in lines])
+        bits       = np.array([self.pins[l[1]] for l in lines], dtype=np.int64)
+        values     = np.array([int(l[2]) for l in lines], dtype=np.int64)
+        self.edges.append((timestamps, bits, values))
+        self.gpio_time = timestamps[-1]
+
+    def _get_states(self, timestamps):
+        # GPIO state of each sample, applies all edges up to the last sample
+        if self.edges:
+            edge_ts   = np.concatenate([e[0] for e in self.edges])
+            edge_bits = np.concatenate([e[1] for e in self.edges])
+            edge_vals = np.concatenate([e[2] for e in self.edges])
+        else:
+            edge_ts = np.zeros(0)
+        num = np.searchsorted(edge_ts, timestamps[-1], side='right')
+        if num < len(edge_ts):
+            self.edges = [(edge_ts[num:], edge_bits[num:], edge_vals[num:])]
+        else:
+            self.edges = []
+        if num == 0:
+            return np.full(len(timestamps), self.state, dtype=np.int64)
+        # state after each edge: last value of each pin up to the edge
+        after = np.full(num, self.state, dtype=np.int64)
+        index = np.arange(num)
+        for bit in np.unique(edge_bits[:num]):
+            last  = np.maximum.accumulate(np.where(edge_bits[:num] == bit, index, -1))
+            value = np.where(last >= 0, edge_vals[np.maximum(last, 0)], (self.state >> bit) & 1)
+            after = (after & ~(1 << bit)) | (value << bit)
+        states     = np.concatenate(([self.state], after))[np.searchsorted(edge_ts[:num], timestamps, side='right')]
+        self.state = int(after[-1])
+        return states
+
+    def _account(self, first, current, power):
+        self.energy      += np.sum(power) / self.rate
+        self.charge      += np.sum(current) / self.rate
+        self.peak_current = max(self.peak_current, float(np.max(np.abs(current))))
+        self.peak_power   = max(self.peak_power, float(np.max(np.abs(power))))
+        self.num_samples += len(current)
+        if not self.gpiofile:
+            return
+        timestamps = self.starttime + (first + np.arange(len(current))) / self.rate
+        states     = self._get_states(timestamps)
+        unique, inverse = np.unique(states, return_inverse=True)
+        energies = np.bincount(inverse, weights=power) / self.rate
+        counts   = np.bincount(inverse)
+        for state, energy, count in zip(unique, energies, counts):
+            entry = self.state_energy.setdefault(int(state), [0.0, 0.0])
+            entry[0] += energy
+            entry[1] += count / self.rate
+
+    def _process(self, rows, final=False):
+        if len(rows):
+            current, voltage, power = get_signals(rows, self.header)
+            self.pending.append((self.num_samples + sum(len(p[1]) for p in self.pending), current, power))
+        self._read_gpio()
+        # account samples once the GPIO tracing output has caught up (or is late by more than gpio_delay)
+        limit = None
+        if self.gpiofile and not final:
+            limit = int(np.ceil((max(self.gpio_time, time.time() - self.gpio_delay) - self.starttime) * self.rate))
+        while self.pending:
+            first, current, power = self.pending[0]
+            count = len(current) if limit is None else min(len(current), max(0, limit - first))
+            if count <= 0:
+                break
+            self._account(first, current[:count], power[:count])
+            if count < len(current):
+                self.pending[0] = (first + count, current[count:], power[count:])
+                break
+            self.pending.pop(0)
+
+    def update(self):
+        """
+        Processes the data blocks which have been committed to the data file since the last call.
+
+        Returns:
+          int: number of samples accounted
+        """
+        if self.header is None and not self._init():
+            return 0
+        num_samples = self.num_samples
+        while True:
+            if self._read_blocks() > 0:
+                continue
+            # the current segment is complete once the next one has been created -> read the remaining blocks, then continue with the next one
+            nextfile = get_rld_segment(self.filename, self.segment + 1)
+            if read_rld_power_header(nextfile) is None:
+                break
+            if self._read_blocks() > 0:
+                continue
+            self.segment += 1
+            self.current  = nextfile
+            self.blocks   = 0
+        self._process(np.zeros(0, dtype=self.header['row_dtype']))
+        return self.num_samples - num_samples
+
+    def _read_blocks(self):
+        # reads the committed data blocks of the current segment (at most chunk_size), returns the number of blocks read
+        block_dtype = self.header['block_dtype']
+        # the header (block count) is updated after each data block has been written
+        committed = int(np.fromfile(self.current, dtype=rld_lead_in, count=1)['data_block_count'][0])
+        available = (os.path.getsize(self.current) - self.header['header_length']) // block_dtype.itemsize
+        count     = min(min(committed, available) - self.blocks, chunk_size)
+        if count <= 0:
+            return 0
+        blocks = np.fromfile(self.current, dtype=block_dtype, count=count, offset=self.header['header_length'] + self.blocks * block_dtype.itemsize)
+        self.blocks += count
+        self._process(blocks['data'].reshape(-1))
+        return count
+
+    def finish(self):
+        """
+        Processes the remaining data of all file segments (incl. the incomplete last data block), must be called after the
+        measurement has stopped.
+
+        Returns:
+          dict: statistics, see get_stats()
+        """
+        self.update()
+        if self.header is not None:
+            header = read_rld_header(self.current)
+            offset = header['header_length'] + self.blocks * self.header['block_dtype'].itemsize
+            rows   = max(0, (os.path.getsize(self.current) - offset - rld_timestamps) // header['row_dtype'].itemsize)
+            rows   = max(0, min(rows, header['sample_count'] - self.blocks * header['data_block_size']))
+            data   = np.fromfile(self.current, dtype=header['row_dtype'], count=rows, offset=offset + rld_timestamps) if rows else np.zeros(0, dtype=header['row_dtype'])
+            self._process(data, final=True)
+        return self.get_stats()
+
+    def get_stats(self):
+        """
+        Returns:
+          dict: energy [J], charge [As], duration [s], average and peak current [A] and power [W] of the samples
+                accounted so far, and the energy [J] and time [s] per GPIO state (pins high) and per pin (while high)
+        """
+        duration = self.num_samples / self.rate if self.header else 0.0
+        stats = {
+            'starttime':    self.starttime if self.header else None,
+            'samples':      self.num_samples,
+            'duration':     duration,
+            'energy':       self.energy,
+            'charge':       self.charge,
+            'avg_current':  self.charge / duration if duration else 0.0,
+            'peak_current': self.peak_current,
+            'avg_power':    self.energy / duration if duration else 0.0,
+            'peak_power':   self.peak_power,
+        }
+        if self.gpiofile:
+            names = { bit: name.decode() for name, bit in self.pins.items() }
+            stats['states'] = { "+".join([names[b] for b in sorted(names) if (state >> b) & 1]) or "none": { 'energy': e, 'time': t } for state, (e, t) in sorted(self.state_energy.items()) }
+            stats['pins']   = { names[b]: { 'energy': sum([e for s, (e, t) in self.state_energy.items() if (s >> b) & 1]),
+                                            'time':   sum([t for s, (e, t) in self.state_energy.items() if (s >> b) & 1]) } for b in sorted(names) }
+        return stats
+### END EnergyMonitor
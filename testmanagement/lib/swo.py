@@ -0,0 +1,249 @@
+"""
+Copyright (c) 2020, ETH Zurich, Computer Engineering Group
+All rights reserved.
+
+Redistribution and use in source and binary forms, with or without
+modification, are permitted provided that the following conditions are met:
+
+* Redistributions of source code must retain the above copyright notice, this
+  list of conditions and the following disclaimer.
+
+* Redistributions in binary form must reproduce the above copyright notice,
+  this list of conditions and the following disclaimer in the documentation
+  and/or other materials provided with the distribution.
+
+* Neither the name of the copyright holder nor the names of its
+  contributors may be used to endorse or promote products derived from
+  this software without specific prior written permission.
+
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+POSSIBILITY OF SUCH DAMAGE.
+
+"""
+
+"""
+    SWO capture file format
+
+    A capture file starts with a text header line (variable names and the sleep overhead, see read_swo_buffer()),
+    followed by the magic line below and a sequence of binary frames:
+        u64 timestamp in ns (UNIX time, taken before the buffer readout)
+        u32 number of data bytes
+        raw SWO data bytes
+    All integers are little endian.
+"""
+import os
+import struct
+import time
+
+
+bin_magic    = b"SWOBIN1\n"
+frame_header = struct.Struct("<QI")
+
+
+##############################################################################
+#
+# SwoFrameWriter - writes binary frames through a preallocated buffer
+#
+##############################################################################
+class SwoFrameWriter():
+
+    def __init__(self, file, bufsize=65536, flush_interval=1.0):
+        self.file           = file
+        self.buf            = bytearray(bufsize)
+        self.view           = memoryview(self.buf)
+        self.pos            = 0
+        self.flush_interval = flush_interval
+        self.last_flush     = time.monotonic()
+        self.num_frames     = 0
+        self.num_bytes      = 0
+
+    def write(self, timestamp_ns, data):
+        size = len(data)
+        if self.pos + frame_header.size + size > len(self.buf):
+            self.flush()
+            if frame_header.size + size > len(self.buf):
+                # frame does not fit into the buffer -> write directly
+                self.file.write(frame_header.pack(timestamp_ns, size))
+                self.file.write(bytes(data))
+                self.num_frames += 1
+                self.num_bytes  += size
+                return
+        frame_header.pack_into(self.buf, self.pos, timestamp_ns, size)
+        self.pos += frame_header.size
+        self.buf[self.pos:self.pos + size] = data
+        self.pos += size
+        self.num_frames += 1
+        self.num_bytes  += size
+        if self.flush_interval and (time.monotonic() - self.last_flush) > self.flush_interval:
+            self.flush()
+
+    def flush(self):
+        if self.pos:
+            self.file.write(self.view[:self.pos])
+            self.pos = 0
+        self.file.flush()
+        self.last_flush = time.monotonic()
+### END SwoFrameWriter
+
+
+##############################################################################
+#
+# read_header - returns the header line and the offset of the first frame
+#               (offset is None if the file is not in the binary format)
+#
+##############################################################################
+def read_header(filename):
+    with open(filename, "rb") as f:
+        header = f.readline()
+        magic  = f.read(len(bin_magic))
+        if magic != bin_magic:
+            return (header, None)
+        return (header, f.tell())
+### END read_header()
+
+
+##############################################################################
+#
+# is_binary_capture
+#
+##############################################################################
+def is_binary_capture(filename):
+    try:
+        return read_header(filename)[1] is not None
+    except IOError:
+        return False
+### END is_binary_capture()
+
+
+##############################################################################
+#
+# parse_header - returns the variable names and the sleep overhead (None if
+#                not available) from the header line of a capture file
+#
+##############################################################################
+def parse_header(header):
+    if isinstance(header, bytes):
+        header = header.decode(errors='replace')
+    fields = header.split()
+    sleep_overhead = None
+    if fields:
+        try:
+            sleep_overhead = float(fields[-1])
+            fields = fields[:-1]
+        except ValueError:
+            pass
+    return (fields, sleep_overhead)
+### END parse_header()
+
+
+##############################################################################
+#
+# iter_frames - generator which returns (timestamp in ns, data) tuples from an
+#               open file positioned at the start of a frame; on a truncated
+#               frame, the file is rewound to the start of that frame
+#
+##############################################################################
+def iter_frames(f):
+    while True:
+        start = f.tell()
+        hdr   = f.read(frame_header.size)
+        if len(hdr) < frame_header.size:
+            f.seek(start)
+            break       # end of file (or truncated frame header)
+        timestamp_ns, size = frame_header.unpack(hdr)
+        data = f.read(size)
+        if len(data) < size:
+            f.seek(start)
+            break       # truncated frame (may still be in the process of being written)
+        yield (timestamp_ns, data)
+### END iter_frames()
+
+
+##############################################################################
+#
+# read_frames - generator which returns (timestamp in ns, data) tuples
+#
+##############################################################################
+def read_frames(filename, offset=None):
+    if offset is None:
+        offset = read_header(filename)[1]
+        if offset is None:
+            raise ValueError("%s is not a binary SWO capture file" % filename)
+    with open(filename, "rb") as f:
+        f.seek(offset)
+        yield from iter_frames(f)
+### END read_frames()
+
+
+##############################################################################
+#
+# bin_to_text - converts a binary capture file into the legacy text format
+#               (space separated decimal bytes, followed by a timestamp line)
+#               if no output file is given, the file is converted in place
+#
+##############################################################################
+def bin_to_text(filename, outputfile=None):
+    header, offset = read_header(filename)
+    if offset is None:
+        return False        # not a binary file, nothing to do
+    tmpfile = outputfile
+    if not outputfile:
+        tmpfile = filename + ".tmp"
+    with open(tmpfile, "wb") as f:
+        f.write(header)
+        for timestamp_ns, data in read_frames(filename, offset):
+            f.write(("%s\n%s\n" % (" ".join(map(str, data)), str(timestamp_ns / 1e9))).encode())
+    if not outputfile:
+        os.replace(tmpfile, filename)
+    return True
+### END bin_to_text()
+
+
+##############################################################################
+#
+# benchmark - measures loop jitter and CPU load of the legacy text and the
+#             binary output format in a simulated SWO read loop
+#
+##############################################################################
+def benchmark(loop_delay_in_ms=2, duration=5, chunk_size=256, outputfile=os.devnull):
+    results = {}
+    data    = bytes(i & 0xff for i in range(chunk_size))
+    period  = loop_delay_in_ms / 1000
+    for fmt in ("text", "binary"):
+        with open(outputfile, "w" if fmt == "text" else "wb") as f:
+            writer   = SwoFrameWriter(f) if fmt == "binary" else None
+            lateness = []
+            cputime  = time.process_time()
+            start    = time.monotonic()
+            deadline = start
+            while deadline - start < duration:
+                lateness.append(time.monotonic() - deadline)
+                swo_data = list(data)       # pylink returns a list of ints
+                if writer:
+                    writer.write(time.time_ns(), bytes(swo_data))
+                else:
+                    f.write(' '.join(str(x) for x in swo_data) + "\n" + str(time.time()) + "\n")
+                deadline += period
+                sleeptime = deadline - time.monotonic()
+                if sleeptime > 0:
+                    time.sleep(sleeptime)
+            if writer:
+                writer.flush()
+            cputime = time.process_time() - cputime
+        lateness.sort()
+        results[fmt] = { 'loops'       : len(lateness),
+                         'cpu_load'    : cputime / duration,
+                         'jitter_mean' : sum(lateness) / len(lateness),
+                         'jitter_p99'  : lateness[int(len(lateness) * 0.99)],
+                         'jitter_max'  : lateness[-1] }
+    return results
+### END benchmark()
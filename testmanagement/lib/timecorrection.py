@@ -0,0 +1,336 @@
+"""
+Copyright (c) 2020, ETH Zurich, Computer Engineering Group
+All rights reserved.
+
+Redistribution and use in source and binary forms, with or without
+modification, are permitted provided that the following conditions are met:
+
+* Redistributions of source code must retain the above copyright notice, this
+  list of conditions and the following disclaimer.
+
+* Redistributions in binary form must reproduce the above copyright notice,
+  this list of conditions and the following disclaimer in the documentation
+  and/or other materials provided with the distribution.
+
+* Neither the name of the copyright holder nor the names of its
+  contributors may be used to endorse or promote products derived from
+  this software without specific prior written permission.
+
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+POSSIBILITY OF SUCH DAMAGE.
+
+"""
+
+"""
+    Post-processing timestamp correction of the test results
+
+    Each output is timestamped differently, all timestamps are corrected to the true time of the reception at the
+    target side (start of the transmission) as follows:
+        t_corrected = t_raw - latency + clock offset(t_raw)
+    The clock offset of the observer is interpolated from the time sync series recorded by the timesync monitor
+    (system clock offset reported by chronyd, positive if the system clock is behind). The latency depends on the
+    capture path:
+        serial (python service): timestamp taken after a complete line has been received -> UART transmit time
+        serial (serialreader):   transmit time is already subtracted by the serialreader -> no latency
+        SWO (text / binary):     timestamp taken before the buffer readout -> on average half the read period
+        data trace:              corrected during the post-processing on the server -> clock offset only
+        GPIO tracing:            timestamps from the PRU -> clock offset only
+        power profiling:         rl_time_offset is applied by the RocketLogger -> clock offset only
+    The applied corrections are recorded in the results folder, the correction is only applied once.
+"""
+import os
+import glob
+import json
+import struct
+import numpy as np
+import lib.flocklab as flocklab
+import lib.swo as swo
+import lib.powertrace as powertrace
+import lib.gpiotrace as gpiotrace
+
+
+uart_bits_per_byte = 10         # 8N1: start bit, 8 data bits, stop bit
+swo_read_period    = 0.01       # read loop delay of the SWO logger (see flocklab_swologger.py)
+serial_db_header   = struct.Struct("<Illl")    # see ProcDbBuf() in flocklab_serial.py: length, service, sec, usec
+logfile_name       = "timecorrection.json"
+
+
+##############################################################################
+#
+# ClockModel - clock offset of the observer over time, interpolated from
+#              the time sync series
+#
+##############################################################################
+class ClockModel():
+
+    def __init__(self, series=[]):
+        samples = sorted([(s['time'], s['system_offset']) for s in series if s['system_offset'] is not None])
+        self.times   = np.array([t for t, _ in samples], dtype=np.float64)
+        self.offsets = np.array([o for _, o in samples], dtype=np.float64)
+
+    @classmethod
+    def from_files(cls, filenames):
+        series = []
+        for filename in filenames:
+            series.extend(flocklab.read_timesync_series(filename))
+        return cls(series)
+
+    def offset(self, timestamps):
+        """returns the clock offset at the given (raw) timestamps in seconds (constant outside of the series)"""
+        if len(self.times) == 0:
+            return np.zeros(np.shape(timestamps))
+        return np.interp(timestamps, self.times, self.offsets)
+
+    def __len__(self):
+        return len(self.times)
+### END ClockModel
+
+
+##############################################################################
+#
+# uart_latency - returns the transmit time in seconds of messages with the
+#                given lengths in bytes
+#
+##############################################################################
+def uart_latency(lengths, baudrate):
+    return np.asarray(lengths, dtype=np.float64) * uart_bits_per_byte / float(baudrate)
+### END uart_latency()
+
+
+##############################################################################
+#
+# correct_timestamps - applies the latency and the clock offset to an array
+#                      of timestamps in seconds
+#
+##############################################################################
+def correct_timestamps(timestamps, latency=0.0, clock=None):
+    timestamps = np.asarray(timestamps, dtype=np.float64)
+    corrected  = timestamps - latency
+    if clock is not None:
+        corrected = corrected + clock.offset(timestamps)
+    return corrected
+### END correct_timestamps()
+
+
+##############################################################################
+#
+# correct_csv - corrects the timestamps in the first column of a csv file
+#               (lines without a timestamp are left unchanged)
+#
+##############################################################################
+def correct_csv(filename, latency=0.0, clock=None, decimals=None):
+    with open(filename, "rb") as f:
+        lines = f.read().split(b"\n")
+    indices    = []
+    timestamps = []
+    for i, line in enumerate(lines):
+        sep = line.find(b",")
+        if sep > 0:
+            try:
+                timestamps.append(float(line[:sep]))
+                indices.append(i)
+            except ValueError:
+                pass
+    if not indices:
+        return 0
+    if decimals is None:
+        first    = lines[indices[0]]
+        decimals = first.find(b",") - first.find(b".") - 1 if b"." in first[:first.find(b",")] else 0
+    corrected = correct_timestamps(timestamps, latency, clock)
+    fmt = "%%.%df" % decimals
+    for i, t in zip(indices, corrected):
+        line     = lines[i]
+        lines[i] = (fmt % t).encode() + line[line.find(b","):]
+    with open(filename + ".tmp", "wb") as f:
+        f.write(b"\n".join(lines))
+    os.replace(filename + ".tmp", filename)
+    return len(indices)
+### END correct_csv()
+
+
+##############################################################################
+#
+# correct_serial_db - corrects the timestamps in a serial service output file
+#                     (the file is modified in place)
+#
+##############################################################################
+def correct_serial_db(filename, baudrate=None, clock=None):
+    with open(filename, "rb") as f:
+        data = bytearray(f.read())
+    offsets    = []
+    services   = []
+    lengths    = []
+    timestamps = []
+    pos        = 0
+    while pos + serial_db_header.size <= len(data):
+        size, service, sec, usec = serial_db_header.unpack_from(data, pos)
+        if pos + 4 + size > len(data):
+            break   # truncated packet
+        offsets.append(pos)
+        services.append(service)
+        lengths.append(size - 12)
+        timestamps.append(sec + usec / 1e6)
+        pos += 4 + size
+    if not offsets:
+        return 0
+    # only data received from the target (service 0) is timestamped after the reception of the whole line
+    latency = np.zeros(len(offsets))
+    if baudrate:
+        latency = np.where(np.array(services) == 0, uart_latency(lengths, baudrate), 0.0)
+    corrected = correct_timestamps(timestamps, latency, clock)
+    sec  = np.floor(corrected)
+    usec = np.round((corrected - sec) * 1e6)
+    sec  = sec + (usec >= 1000000)
+    usec = np.where(usec >= 1000000, 0, usec)
+    for o, s, u in zip(offsets, sec.astype(np.int64), usec.astype(np.int64)):
+        struct.pack_into("<ll", data, o + 8, int(s), int(u))
+    with open(filename + ".tmp", "wb") as f:
+        f.write(data)
+    os.replace(filename + ".tmp", filename)
+    return len(offsets)
+### END correct_serial_db()
+
+
+##############################################################################
+#
+# correct_swo_frames - corrects the frame timestamps of a binary SWO capture
+#                      file (the file is modified in place)
+#
+##############################################################################
+def correct_swo_frames(filename, latency=0.0, clock=None):
+    offset = swo.read_header(filename)[1]
+    if offset is None:
+        return 0
+    with open(filename, "r+b") as f:
+        data = f.read()
+        positions  = []
+        timestamps = []
+        pos        = offset
+        while pos + swo.frame_header.size <= len(data):
+            timestamp_ns, size = swo.frame_header.unpack_from(data, pos)
+            if pos + swo.frame_header.size + size > len(data):
+                break   # truncated frame
+            positions.append(pos)
+            timestamps.append(timestamp_ns)
+            pos += swo.frame_header.size + size
+        if not positions:
+            return 0
+        timestamps = np.array(timestamps, dtype=np.int64)
+        # correction in ns (the absolute timestamps do not fit into a float64 with ns resolution)
+        delta = np.round((correct_timestamps(timestamps / 1e9, latency, clock) - timestamps / 1e9) * 1e9).astype(np.int64)
+        for pos, timestamp_ns in zip(positions, timestamps + delta):
+            f.seek(pos)
+            f.write(struct.pack("<Q", int(timestamp_ns)))
+    return len(positions)
+### END correct_swo_frames()
+
+
+##############################################################################
+#
+# correct_gpiotrace - corrects the edge timestamps of a GPIO trace in the
+#                     columnar format (the file is rewritten)
+#
+##############################################################################
+def correct_gpiotrace(filename, clock=None):
+    if clock is None or len(clock) == 0 or not gpiotrace.is_columnar(filename):
+        return 0
+    count = 0
+    with open(filename, "rb") as f:
+        f.readline()
+        fields = f.readline().decode().split()
+        res    = int(fields[0])
+        writer = gpiotrace.ColumnarWriter(filename + ".tmp", fields[1:])
+        try:
+            for pin, timestamps, values in gpiotrace.iter_blocks(f):
+                if res != gpiotrace.resolution:
+                    timestamps = (timestamps // res) * gpiotrace.resolution + (timestamps % res) * gpiotrace.resolution // res
+                # correction in ticks, the timestamps must remain monotonic within a pin (unsigned deltas)
+                delta      = np.round(clock.offset(timestamps / gpiotrace.resolution) * gpiotrace.resolution).astype(np.int64)
+                writer.write(np.maximum.accumulate(timestamps + delta), np.full(len(timestamps), pin, dtype=np.uint8), values)
+                count += len(timestamps)
+        finally:
+            writer.close()
+    os.replace(filename + ".tmp", filename)
+    return count
+### END correct_gpiotrace()
+
+
+##############################################################################
+#
+# correct_rld - corrects the start time and the realtime block timestamps of
+#               a RocketLogger data file (the file is modified in place)
+#
+##############################################################################
+def correct_rld(filename, clock=None):
+    if clock is None or len(clock) == 0:
+        return 0
+    header = powertrace.read_rld_header(filename)
+    rows   = header['data_block_size']
+    blocks = -(-header['sample_count'] // rows) if rows else 0
+    bsize  = powertrace.rld_timestamps + rows * header['row_dtype'].itemsize
+    blocks = min(blocks, (os.path.getsize(filename) - header['header_length'] + bsize - powertrace.rld_timestamps) // bsize)    # incl. an incomplete last block
+    data   = np.memmap(filename, dtype=np.uint8, mode="r+")
+    # lead-in: start time (sec, ns)
+    offset = powertrace.rld_lead_in.fields['start_time_sec'][1]
+    start  = data[offset:offset + 16].view(np.int64)
+    # data blocks: realtime timestamp (sec, ns) followed by the monotonic timestamp
+    stamps = np.ndarray((blocks, 2), dtype=np.int64, buffer=data, offset=header['header_length'], strides=(bsize, 8)) if blocks > 0 else np.zeros((0, 2), dtype=np.int64)
+    for ts in (start.reshape(1, 2), stamps):
+        if len(ts) == 0:
+            continue
+        delta = np.round(clock.offset(ts[:, 0] + ts[:, 1] / 1e9) * 1e9).astype(np.int64)
+        ns    = ts[:, 0] * 1000000000 + ts[:, 1] + delta
+        ts[:, 0] = ns // 1000000000
+        ts[:, 1] = ns % 1000000000
+    data.flush()
+    del data
+    return blocks
+### END correct_rld()
+
+
+##############################################################################
+#
+# correct_results - corrects the timestamps of all outputs in a test results
+#                   folder, returns the applied corrections (None if the
+#                   folder has already been corrected)
+#
+##############################################################################
+def correct_results(folder, serialport=None, baudrate=None):
+    logfile = os.path.join(folder, logfile_name)
+    if os.path.isfile(logfile):
+        return None
+    clock  = ClockModel.from_files(sorted(glob.glob(os.path.join(folder, "timesync_*.dat"))))
+    result = { 'clock_samples': len(clock), 'clock_offset_min': float(np.min(clock.offsets)) if len(clock) else 0.0,
+               'clock_offset_max': float(np.max(clock.offsets)) if len(clock) else 0.0, 'files': {} }
+    files = result['files']
+    # serial output: python serial service (db), serialreader or SWO logger (csv and binary SWO ports)
+    for filename in glob.glob(os.path.join(folder, "serial_*.db")):
+        files[os.path.basename(filename)] = { 'count': correct_serial_db(filename, baudrate, clock), 'latency': 'uart' if baudrate else 0.0 }
+    latency = swo_read_period / 2 if (serialport and "swo" in serialport) else 0.0
+    for filename in glob.glob(os.path.join(folder, "serial_*.csv")):
+        files[os.path.basename(filename)] = { 'count': correct_csv(filename, latency, clock), 'latency': latency }
+    for filename in glob.glob(os.path.join(folder, "serial_*_port*.dat")):
+        files[os.path.basename(filename)] = { 'count': correct_swo_frames(filename, latency, clock), 'latency': latency }
+    # clock offset only
+    if len(clock):
+        for filename in glob.glob(os.path.join(folder, "datatrace_*.log")):
+            files[os.path.basename(filename)] = { 'count': correct_swo_frames(filename, 0.0, clock), 'latency': 0.0 }
+        for filename in glob.glob(os.path.join(folder, "gpio_monitor_*.csv")):
+            files[os.path.basename(filename)] = { 'count': correct_csv(filename, 0.0, clock), 'latency': 0.0 }
+        for filename in glob.glob(os.path.join(folder, "gpio_monitor_*" + gpiotrace.output_formats['columnar'])):
+            files[os.path.basename(filename)] = { 'count': correct_gpiotrace(filename, clock), 'latency': 0.0 }
+        for filename in glob.glob(os.path.join(folder, "powerprofiling_*.rld")):
+            files[os.path.basename(filename)] = { 'count': correct_rld(filename, clock), 'latency': 0.0 }
+    with open(logfile, "w") as f:
+        json.dump(result, f, indent=2)
+    return result
+### END correct_results()